@@ -2,68 +2,185 @@ import os
 import numpy as np
 import SimpleITK as sitk
 
-def Aggregates_to_Filtered_Aggregates(input_dir: str = None, filtered_output_dir: str = None, classes_to_suppress: list = None) -> None:
+from Image_IO import SlabReader, geometry_image, is_image_file, iter_slabs, read_array, slab_depth, write_image
+from Label_Index import LabelIndex
+from Label_Maps import labels_present, relabel
+from Label_Registry import LabelRegistry
+from Profiling import phase, profiled_stage
+from Stage_Cache import StageCache
+
+# Rough peak of the per-slab temporaries of the slab-wise filter, per voxel (bincount input and the lookup table gather)
+SLAB_BYTES_PER_VOXEL = 8
+
+def Aggregates_to_Filtered_Aggregates(input_dir: str = None, filtered_output_dir: str = None, classes_to_suppress: list = None,
+                                      label_registry: LabelRegistry = None, max_memory_mb: float = None) -> None:
     # Guarantee that the output path exists
     if not os.path.exists(filtered_output_dir):
         os.mkdir(filtered_output_dir)
 
+    # Aggregates labelled with a registry keep their global IDs, and the classes may be given as 'MODEL:name'
+    contiguous = label_registry is None
+    if label_registry is not None:
+        classes_to_suppress = label_registry.resolve(classes_to_suppress)
+
+    cache = filter_stage_cache(filtered_output_dir, classes_to_suppress, contiguous)
+
     # Iterate over all files in the folder
     for filename in os.listdir(input_dir):
-        if os.path.exists(os.path.join(filtered_output_dir, filename)):
+        if not is_image_file(filename):
             continue
 
-        filter_mask(os.path.join(input_dir, filename), os.path.join(filtered_output_dir, filename), classes_to_suppress)
+        filter_case(os.path.join(input_dir, filename), os.path.join(filtered_output_dir, filename), classes_to_suppress, cache, contiguous,
+                    max_memory_mb)
+
+def filter_stage_cache(filtered_output_dir: str = None, classes_to_suppress: list = None, contiguous: bool = True) -> StageCache:
+    # Outputs are reused only if they were filtered from the same input with the same suppressed classes
+    params = {'classes_to_suppress': sorted(int(cls) for cls in classes_to_suppress or [])}
+    if not contiguous:
+        params['contiguous'] = False
+    return StageCache(filtered_output_dir, 'filter_mask', params)
+
+def filter_case(input_file: str = None, output_file: str = None, classes_to_suppress: list = None, cache: StageCache = None,
+                contiguous: bool = True, max_memory_mb: float = None) -> None:
+    # Check if the output is up to date with its input to avoid redundant work (the slab-wise output is identical)
+    key = cache.key([input_file])
+    if cache.is_fresh(output_file, key):
+        return
 
-def filter_mask(mask_path: str, output_path: str, classes_to_suppress: list = None):
+    filter_mask(input_file, output_file, classes_to_suppress, contiguous, max_memory_mb)
+    cache.record(output_file, key)
+
+@profiled_stage('filter_mask')
+def filter_mask(mask_path: str, output_path: str, classes_to_suppress: list = None, contiguous: bool = True, max_memory_mb: float = None):
     """
     Filters a segmentation mask by:
     1. Suppressing classes (setting them to background) if specified.
     2. Ensuring class labels are continuous (no gaps between classes).
+
+    The labels and their extent come from the label index sidecar of the mask (or one pass over it when there is
+    none): only the bounding box of all the labels is relabelled, and the index of the output is derived from it.
     
     Parameters:
     - mask_path: str, path to the segmentation mask file (e.g., .nii.gz or .nrrd).
     - output_path: str, path to save the modified mask.
     - classes_to_suppress: list of int (optional), the classes that need to be suppressed (set to background).
+    - contiguous: bool, make the remaining labels continuous (default True); False keeps them, e.g. global registry IDs.
+    - max_memory_mb: float (optional), memory ceiling in MiB: the mask is then filtered slab by slab with `filter_mask_slabs`.
     
     Returns:
     - filtered_mask: np.ndarray, the modified mask after suppression and class rearrangement.
     """
-    # Read the mask image using SimpleITK
-    mask_img = sitk.ReadImage(mask_path)
-    mask_arr = sitk.GetArrayFromImage(mask_img)
+    if max_memory_mb is not None:
+        return filter_mask_slabs(mask_path, output_path, classes_to_suppress, contiguous, max_memory_mb)
+
+    # Read the mask voxels (memory-mapped for an .npy mask)
+    with phase('read'):
+        mask_arr, geometry = read_array(mask_path)
+
+    with phase('index'):
+        index = LabelIndex.for_mask(mask_path, mask_arr)
+
+    with phase('relabel'):
+        # Everything outside the bounding box of the labels is background, which filtering keeps
+        class_mapping = filter_mapping(index.labels, classes_to_suppress, contiguous)
+        box = index.union_slices()
+        filtered_mask = np.zeros_like(mask_arr)
+        relabel(mask_arr[box], class_mapping, out=filtered_mask[box])
+
+    # Save the filtered mask to the specified output path
+    with phase('write'):
+        write_image(geometry_image(filtered_mask, geometry), output_path, use_compression=True)
+        index.relabel(class_mapping).save(output_path)
+    
+    return filtered_mask
+
+def filter_mask_image(mask_img: sitk.Image, classes_to_suppress: list = None, contiguous: bool = True) -> sitk.Image:
+    """
+    In-memory counterpart of `filter_mask`: suppresses the given classes and makes the remaining labels continuous.
+    
+    Parameters:
+    - mask_img: sitk.Image, the segmentation mask.
+    - classes_to_suppress: list of int (optional), the classes that need to be suppressed (set to background).
+    - contiguous: bool, make the remaining labels continuous (default True); False only suppresses, with no label search.
+    
+    Returns:
+    - filtered_mask_img: sitk.Image, the filtered mask with the spatial information of mask_img.
+    """
+    filtered_mask = filter_mask_array(sitk.GetArrayViewFromImage(mask_img), classes_to_suppress, contiguous)
     
+    # Convert the modified array back to a SimpleITK image
+    filtered_mask_img = sitk.GetImageFromArray(filtered_mask)
+    filtered_mask_img.CopyInformation(mask_img)  # Preserve spatial information from the original image
+
+    return filtered_mask_img
+
+def filter_mask_array(mask_arr: np.ndarray, classes_to_suppress: list = None, contiguous: bool = True) -> np.ndarray:
+    """
+    Array counterpart of `filter_mask_image`. mask_arr is only read (it may be a read-only view of an image), and the
+    filtered mask is a new array of the same dtype.
+    """
+    class_mapping = filter_mapping(labels_present(mask_arr) if contiguous else None, classes_to_suppress, contiguous)
+
+    # Apply the suppression and the mapping to the mask in a single lookup-table pass, into a new array
+    return relabel(mask_arr, class_mapping)
+
+def filter_mapping(labels: np.ndarray = None, classes_to_suppress: list = None, contiguous: bool = True) -> dict:
+    """
+    The label mapping of the filter, for a mask with the given non-zero labels (only needed when contiguous).
+    """
     # Step 1: Suppress specified classes if provided
-    if classes_to_suppress:
-        for cls in classes_to_suppress:
-            mask_arr[mask_arr == cls] = 0
+    suppressed = set(int(cls) for cls in classes_to_suppress) if classes_to_suppress else set()
+    class_mapping = {cls: 0 for cls in suppressed}
     
     # Step 2: Ensure the classes are continuous (no gaps)
-    # Get the unique class labels in the mask, sorted
-    unique_classes = sorted(np.unique(mask_arr))
-    
-    # Initialize a dictionary to map the old classes to new continuous classes
-    class_mapping = {}
-    current_label = 1  # Start with 1 as the first label
+    # Map the remaining class labels, sorted, to new continuous classes starting at 1
+    current_label = 1
 
-    for cls in unique_classes:
-        if cls == 0:
-            continue  # Skip the background class
+    for cls in (sorted(int(label) for label in labels) if contiguous else []):
+        if cls in suppressed:
+            continue
         
         class_mapping[cls] = current_label
         current_label += 1
 
-    # Apply the mapping to the mask
-    filtered_mask = np.copy(mask_arr)
-    for old_class, new_class in class_mapping.items():
-        filtered_mask[mask_arr == old_class] = new_class
-    
-    # Convert the modified array back to a SimpleITK image
-    filtered_mask_img = sitk.GetImageFromArray(filtered_mask)
-    filtered_mask_img.CopyInformation(mask_img)  # Preserve spatial information from the original image
+    return class_mapping
+
+def filter_mask_slabs(mask_path: str, output_path: str, classes_to_suppress: list = None, contiguous: bool = True,
+                      max_memory_mb: float = None) -> np.ndarray:
+    """
+    Slab-wise counterpart of `filter_mask`, with the same output: the labels present are counted slab by slab (only
+    when they are made continuous), then the mapping is applied to every slab in z-slabs sized to stay under
+    `max_memory_mb`. Only the filtered mask is held in full. With a label index sidecar, the counting pass is skipped
+    and only the slabs within the z extent of the labels are read.
+    """
+    reader = SlabReader(mask_path)
+    depth = slab_depth([reader], SLAB_BYTES_PER_VOXEL, max_memory_mb, reader.dtype.itemsize)
+    index = LabelIndex.load(mask_path)
+
+    with phase('relabel'):
+        if index is not None:
+            labels = index.labels
+            z_box = index.union_slices()[0]
+        else:
+            # Count the labels of the whole mask, then map the remaining ones, sorted, to continuous classes from 1
+            present = set()
+            for _, (slab,) in iter_slabs([reader], depth) if contiguous else []:
+                present.update(labels_present(slab).tolist())
+            labels = sorted(present)
+            z_box = slice(0, reader.GetSize()[2])
+        class_mapping = filter_mapping(labels, classes_to_suppress, contiguous)
+
+        filtered_mask = np.zeros(reader.GetSize()[::-1], dtype=reader.dtype)
+        for z_start, (slab,) in iter_slabs([reader], depth, z_box.start, z_box.stop):
+            relabel(slab, class_mapping, out=filtered_mask[z_start:z_start + slab.shape[0]])
+
+    with phase('write'):
+        write_image(reader.copy_information(sitk.GetImageFromArray(filtered_mask)), output_path, use_compression=True)
+        if index is not None:
+            index.relabel(class_mapping).save(output_path)
+        else:
+            LabelIndex.from_array(filtered_mask, depth * reader.GetSize()[0] * reader.GetSize()[1]).save(output_path)
 
-    # Save the filtered mask to the specified output path
-    sitk.WriteImage(filtered_mask_img, output_path, useCompression=True)
-    
     return filtered_mask
 
 if __name__ == '__main__':
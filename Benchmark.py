@@ -0,0 +1,348 @@
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+import Masks_to_Aggregates
+import Aggregates_to_Filtered_Aggregates
+import Filtered_Aggregates_to_Statistics
+
+# Statistics compared between the current and the reference statistics engines
+STATISTICS_KEYS = ('volume', 'mean_density', 'median_density', 'std_dev')
+
+# The functions one patient goes through from the masks to the statistics
+PIPELINE_FUNCTIONS = ('aggregate_scans', 'filter_mask', 'extract_baseline_features_InHouse')
+
+def synthetic_case(shape: tuple = (256, 256, 256), n_labels: int = 10, spacing: tuple = (0.5, 0.5, 1.0),
+                   seed: int = 0, block_size: int = 16) -> dict:
+    """
+    Generates a synthetic CT-like head volume with the three masks the aggregation stage expects.
+
+    The CT is air (-1000 HU) around an ellipsoidal head of noisy soft tissue in a bone shell. The TOTAL mask tiles
+    the head with blocks of n_labels random labels; the BS mask covers the centre of the head with labels that
+    overlap the TOTAL labels (so class shifting is exercised); the TEMP mask marks two lateral regions with labels 1-2.
+
+    Parameters:
+    - shape: tuple of int, the volume size as (x, y, z), in the order SimpleITK reports it.
+    - n_labels: int, the number of TOTAL labels.
+    - spacing: tuple of float, the voxel spacing (x, y, z) in mm.
+    - seed: int, seed of the random generator.
+    - block_size: int, the edge length in voxels of the blocks the label maps are tiled with.
+
+    Returns:
+    - case: dict, 'CT', 'TOTAL', 'BS' and 'TEMP' sitk.Images on the same grid.
+    """
+    rng = np.random.default_rng(seed)
+    size_z, size_y, size_x = shape[2], shape[1], shape[0]
+
+    # Normalized coordinates of every voxel, built by broadcasting so no full-size index grids are allocated
+    z = np.linspace(-1, 1, size_z, dtype=np.float32)[:, None, None]
+    y = np.linspace(-1, 1, size_y, dtype=np.float32)[None, :, None]
+    x = np.linspace(-1, 1, size_x, dtype=np.float32)[None, None, :]
+    radius = (z / 0.9) ** 2 + (y / 0.8) ** 2 + (x / 0.7) ** 2
+    head = radius < 1
+    brain = radius < 0.8
+
+    ct = np.full((size_z, size_y, size_x), -1000, dtype=np.int16)
+    ct[head] = 1000
+    ct[brain] = 40
+    ct += rng.normal(0, 20, ct.shape).astype(np.int16)
+
+    # Blocky label fields: a coarse random grid expanded to full resolution
+    def block_labels(n: int) -> np.ndarray:
+        coarse = rng.integers(1, n + 1, (-(-size_z // block_size), -(-size_y // block_size), -(-size_x // block_size)))
+        index = np.ix_(np.arange(size_z) // block_size, np.arange(size_y) // block_size, np.arange(size_x) // block_size)
+        return coarse[index].astype(np.uint8 if n < 256 else np.uint16)
+
+    total = block_labels(n_labels)
+    total[~head] = 0
+
+    bs = block_labels(max(n_labels // 4, 1))
+    bs[radius >= 0.3] = 0
+
+    temp = np.zeros(ct.shape, dtype=np.uint8)
+    temporal = (radius < 1) & (radius > 0.6) & (np.abs(y) < 0.3)
+    temp[temporal & (x < 0)] = 1
+    temp[temporal & (x > 0)] = 2
+
+    case = {}
+    for name, array in (('CT', ct), ('TOTAL', total), ('BS', bs), ('TEMP', temp)):
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing(spacing)
+        case[name] = image
+    return case
+
+def write_case(case: dict = None, case_dir: str = None) -> dict:
+    # Writes a synthetic case as <case_dir>/<name>.nii.gz and returns name -> path
+    os.makedirs(case_dir, exist_ok=True)
+    paths = {}
+    for name, image in case.items():
+        paths[name] = os.path.join(case_dir, f'{name}.nii.gz')
+        sitk.WriteImage(image, paths[name], useCompression=True)
+    return paths
+
+def time_call(function: Callable, *args, repeats: int = 3) -> tuple:
+    # Median wall time of `repeats` calls, and the result of the last call
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+def reference_overlay_scans(send_to_back_path: str, overlay_scan_path: str, output_path: str) -> None:
+    # The original per-class loop implementation of Masks_to_Aggregates.overlay_scans
+    send_to_back = sitk.ReadImage(send_to_back_path)
+    overlay_scan = sitk.ReadImage(overlay_scan_path)
+    overlay_scan = sitk.Resample(overlay_scan, send_to_back, sitk.Transform(), sitk.sitkNearestNeighbor, 0, overlay_scan.GetPixelID())
+
+    send_to_back_array = sitk.GetArrayFromImage(send_to_back)
+    overlay_scan_array = sitk.GetArrayFromImage(overlay_scan)
+
+    back_classes = [cls for cls in np.unique(send_to_back_array) if cls != 0]
+    overlay_classes = [cls for cls in np.unique(overlay_scan_array) if cls != 0]
+    overlapping_classes = np.intersect1d(back_classes, overlay_classes)
+    if overlapping_classes.size > 0:
+        shift_amount = np.max(overlay_classes) + 1
+        for cls in overlapping_classes:
+            send_to_back_array[send_to_back_array == cls] += shift_amount
+
+    combined_image = sitk.GetImageFromArray(np.where(overlay_scan_array != 0, overlay_scan_array, send_to_back_array))
+    combined_image.CopyInformation(send_to_back)
+    sitk.WriteImage(combined_image, output_path, useCompression=True)
+
+def reference_underlay_scans(send_to_front_path: str, underlay_scan_path: str, output_path: str) -> None:
+    # The original per-class loop implementation of Masks_to_Aggregates.underlay_scans
+    send_to_front = sitk.ReadImage(send_to_front_path)
+    underlay_scan = sitk.ReadImage(underlay_scan_path)
+    underlay_scan = sitk.Resample(underlay_scan, send_to_front, sitk.Transform(), sitk.sitkNearestNeighbor, 0, underlay_scan.GetPixelID())
+
+    send_to_front_array = sitk.GetArrayFromImage(send_to_front)
+    underlay_scan_array = sitk.GetArrayFromImage(underlay_scan)
+
+    front_classes = [cls for cls in np.unique(send_to_front_array) if cls != 0]
+    underlay_classes = [cls for cls in np.unique(underlay_scan_array) if cls != 0]
+    overlapping_classes = np.intersect1d(front_classes, underlay_classes)
+    if overlapping_classes.size > 0:
+        shift_amount = np.max(underlay_classes) + 1
+        for cls in overlapping_classes:
+            send_to_front_array[send_to_front_array == cls] += shift_amount
+
+    combined_image = sitk.GetImageFromArray(np.where(send_to_front_array != 0, send_to_front_array, underlay_scan_array))
+    combined_image.CopyInformation(send_to_front)
+    sitk.WriteImage(combined_image, output_path, useCompression=True)
+
+def reference_aggregate_scans(mask_paths: list, output_path: str) -> None:
+    # The original two-step aggregation: BS over TOTAL, written and read back, then TEMP over the result
+    total_path, bs_path, temp_path = mask_paths
+    stem = output_path[:-len('.nii.gz')] if output_path.endswith('.nii.gz') else output_path
+    reference_overlay_scans(total_path, bs_path, f'{stem}_PARTIAL.nii.gz')
+    reference_underlay_scans(temp_path, f'{stem}_PARTIAL.nii.gz', output_path)
+
+def reference_filter_mask(mask_path: str, output_path: str, classes_to_suppress: list = None) -> np.ndarray:
+    # The original per-class loop implementation of Aggregates_to_Filtered_Aggregates.filter_mask
+    mask_img = sitk.ReadImage(mask_path)
+    mask_arr = sitk.GetArrayFromImage(mask_img)
+
+    if classes_to_suppress:
+        for cls in classes_to_suppress:
+            mask_arr[mask_arr == cls] = 0
+
+    class_mapping = {}
+    current_label = 1
+    for cls in sorted(np.unique(mask_arr)):
+        if cls == 0:
+            continue
+        class_mapping[cls] = current_label
+        current_label += 1
+
+    filtered_mask = np.copy(mask_arr)
+    for old_class, new_class in class_mapping.items():
+        filtered_mask[mask_arr == old_class] = new_class
+
+    filtered_mask_img = sitk.GetImageFromArray(filtered_mask)
+    filtered_mask_img.CopyInformation(mask_img)
+    sitk.WriteImage(filtered_mask_img, output_path, useCompression=True)
+    return filtered_mask
+
+def reference_extract_baseline_features_InHouse(image_path: str, mask_path: str) -> dict:
+    # The original per-segment loop implementation of Filtered_Aggregates_to_Statistics.extract_baseline_features_InHouse
+    image = sitk.ReadImage(image_path)
+    image_arr = sitk.GetArrayFromImage(image)
+    mask_arr = sitk.GetArrayFromImage(sitk.ReadImage(mask_path))
+    dx, dy, dz = image.GetSpacing()
+    voxel_volume = dx * dy * dz
+
+    unique_segments = np.unique(mask_arr)
+    result_dict = {}
+    for segment_id in unique_segments[unique_segments != 0]:
+        segment_mask = (mask_arr == segment_id)
+        segment_intensities = image_arr[segment_mask]
+        result_dict[segment_id] = {
+            'volume': np.sum(segment_mask) * voxel_volume,
+            'mean_density': np.mean(segment_intensities),
+            'median_density': np.median(segment_intensities),
+            'std_dev': np.std(segment_intensities)
+        }
+    return result_dict
+
+def same_image(path: str = None, reference_path: str = None) -> bool:
+    # Same voxels, pixel type and geometry
+    image, reference = sitk.ReadImage(path), sitk.ReadImage(reference_path)
+    return (image.GetPixelID() == reference.GetPixelID()
+            and image.GetSize() == reference.GetSize()
+            and np.allclose(image.GetSpacing(), reference.GetSpacing())
+            and np.allclose(image.GetOrigin(), reference.GetOrigin())
+            and np.allclose(image.GetDirection(), reference.GetDirection())
+            and np.array_equal(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(reference)))
+
+def same_statistics(stats: dict = None, reference_stats: dict = None, rtol: float = 1e-9) -> bool:
+    # Same segments, and every reference statistic equal up to floating point summation order
+    if sorted(int(segment) for segment in stats) != sorted(int(segment) for segment in reference_stats):
+        return False
+    stats = {int(segment): features for segment, features in stats.items()}
+    return all(np.isclose(float(stats[int(segment)][key]), float(features[key]), rtol=rtol, atol=1e-9)
+               for segment, features in reference_stats.items() for key in STATISTICS_KEYS)
+
+def benchmark_case(case_dir: str = None, n_voxels: int = None, classes_to_suppress: list = None, repeats: int = 3,
+                   check: bool = True, include_pyradiomics: bool = False) -> List[dict]:
+    """
+    Times the aggregation, filtering and statistics functions on one written synthetic case, chained like the
+    pipeline (aggregate -> filter -> statistics, with the pairwise overlay and underlay timed as well), and
+    optionally checks every output against the reference implementation.
+
+    Parameters:
+    - case_dir: str, folder of a case written by `write_case`; outputs are written next to the inputs.
+    - n_voxels: int, the number of voxels of the case.
+    - classes_to_suppress: list of int (optional), the classes suppressed by filter_mask.
+    - repeats: int, calls per function; the median time is reported.
+    - check: bool, also run the reference implementations and compare the outputs.
+    - include_pyradiomics: bool, also time extract_baseline_features_PyRads (slow on large volumes).
+
+    Returns:
+    - rows: list of dict, one record per function.
+    """
+    path = lambda name: os.path.join(case_dir, f'{name}.nii.gz')
+
+    # (name, current function, reference function, arguments, reference arguments, output to compare)
+    calls = [
+        ('overlay_scans', Masks_to_Aggregates.overlay_scans, reference_overlay_scans,
+         (path('TOTAL'), path('BS'), path('AGG')), (path('TOTAL'), path('BS'), path('AGG_REF')), 'AGG'),
+        ('underlay_scans', Masks_to_Aggregates.underlay_scans, reference_underlay_scans,
+         (path('TEMP'), path('AGG'), path('FINAL')), (path('TEMP'), path('AGG_REF'), path('FINAL_REF')), 'FINAL'),
+        ('aggregate_scans', Masks_to_Aggregates.aggregate_scans, reference_aggregate_scans,
+         ([path('TOTAL'), path('BS'), path('TEMP')], path('FUSED')), ([path('TOTAL'), path('BS'), path('TEMP')], path('FUSED_REF')), 'FUSED'),
+        ('filter_mask', Aggregates_to_Filtered_Aggregates.filter_mask, reference_filter_mask,
+         (path('FINAL'), path('FILTERED'), classes_to_suppress), (path('FINAL_REF'), path('FILTERED_REF'), classes_to_suppress), 'FILTERED'),
+        ('extract_baseline_features_InHouse', Filtered_Aggregates_to_Statistics.extract_baseline_features_InHouse, reference_extract_baseline_features_InHouse,
+         (path('CT'), path('FILTERED')), (path('CT'), path('FILTERED_REF')), None),
+    ]
+    if include_pyradiomics:
+        calls.append(('extract_baseline_features_PyRads', Filtered_Aggregates_to_Statistics.extract_baseline_features_PyRads, None,
+                      (path('CT'), path('FILTERED')), None, None))
+
+    rows = []
+    for name, function, reference, args, reference_args, output in calls:
+        seconds, result = time_call(function, *args, repeats=repeats)
+        row = {'function': name, 'seconds': seconds, 'voxels_per_s': n_voxels / seconds, 'patients_per_hour': 3600 / seconds}
+
+        if check and reference is not None:
+            reference_seconds, reference_result = time_call(reference, *reference_args, repeats=1)
+            row['reference_seconds'] = reference_seconds
+            row['speedup'] = reference_seconds / seconds
+            if output is not None:
+                row['equivalent'] = same_image(path(output), path(f'{output}_REF'))
+            else:
+                row['equivalent'] = same_statistics(result, reference_result)
+        rows.append(row)
+
+    # The CPU stages of one patient end to end, as Masks_to_Aggregates runs them
+    pipeline = [row for row in rows if row['function'] in PIPELINE_FUNCTIONS]
+    seconds = sum(row['seconds'] for row in pipeline)
+    total = {'function': 'aggregate + filter + statistics', 'seconds': seconds, 'voxels_per_s': n_voxels / seconds, 'patients_per_hour': 3600 / seconds}
+    if check:
+        total['reference_seconds'] = sum(row['reference_seconds'] for row in pipeline)
+        total['speedup'] = total['reference_seconds'] / seconds
+        total['equivalent'] = all(row['equivalent'] for row in pipeline)
+    rows.append(total)
+    return rows
+
+def run_benchmark(shapes: List[tuple] = ((256, 256, 256),), label_counts: List[int] = (10, 200), work_dir: str = None,
+                  classes_to_suppress: list = None, repeats: int = 3, check: bool = True, include_pyradiomics: bool = False,
+                  seed: int = 0) -> pd.DataFrame:
+    """
+    Runs the benchmark for every combination of volume size and label count.
+
+    Parameters:
+    - shapes: list of tuple of int, volume sizes as (x, y, z).
+    - label_counts: list of int, numbers of TOTAL labels.
+    - work_dir: str (optional), folder for the synthetic cases (default: a temporary folder, removed afterwards).
+    - classes_to_suppress: list of int (optional), the classes suppressed by filter_mask (default: [2, 3]).
+    - repeats, check, include_pyradiomics: see `benchmark_case`.
+    - seed: int, seed of the synthetic data.
+
+    Returns:
+    - results: pd.DataFrame, one row per size, label count and function.
+    """
+    if classes_to_suppress is None:
+        classes_to_suppress = [2, 3]
+
+    remove_work_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        rows = []
+        for shape in shapes:
+            for n_labels in label_counts:
+                case_dir = os.path.join(work_dir, f'{"x".join(str(size) for size in shape)}_{n_labels}')
+                write_case(synthetic_case(shape, n_labels, seed=seed), case_dir)
+
+                for row in benchmark_case(case_dir, int(np.prod(shape)), classes_to_suppress, repeats, check, include_pyradiomics):
+                    rows.append(dict(shape='x'.join(str(size) for size in shape), n_labels=n_labels, **row))
+                    print(f'{rows[-1]["shape"]:>13} {n_labels:>4} labels  {row["function"]:<34} {row["seconds"]:8.3f} s'
+                          + (f'  x{row["speedup"]:.1f} vs reference, equivalent: {row["equivalent"]}' if 'equivalent' in row else ''),
+                          flush=True)
+        return pd.DataFrame(rows)
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def parse_shape(text: str = None) -> tuple:
+    # '512x512x800' -> (512, 512, 800)
+    try:
+        shape = tuple(int(size) for size in text.lower().split('x'))
+    except ValueError:
+        shape = ()
+    if len(shape) != 3:
+        raise argparse.ArgumentTypeError(f"Invalid shape '{text}', expected XxYxZ, e.g. 512x512x800")
+    return shape
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the aggregation, filtering and statistics stages on synthetic CT volumes.')
+    parser.add_argument('--shapes', type=parse_shape, nargs='+', default=[(256, 256, 256)], help='volume sizes, e.g. 256x256x256 512x512x800')
+    parser.add_argument('--labels', type=int, nargs='+', default=[10, 200], help='numbers of labels in the TOTAL mask')
+    parser.add_argument('--repeats', type=int, default=3, help='calls per function; the median is reported')
+    parser.add_argument('--suppress', type=int, nargs='*', default=[2, 3], help='classes suppressed by filter_mask')
+    parser.add_argument('--work-dir', help='keep the synthetic cases and outputs in this folder')
+    parser.add_argument('--pyradiomics', action='store_true', help='also time extract_baseline_features_PyRads')
+    parser.add_argument('--no-check', action='store_true', help='skip the comparison with the reference implementations')
+    parser.add_argument('--csv', help='save the results as CSV')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.shapes, args.labels, args.work_dir, args.suppress, args.repeats,
+                            not args.no_check, args.pyradiomics)
+    if args.csv:
+        results.to_csv(args.csv, index=False)
+
+    # Fail when any implementation is not equivalent to its reference
+    return 1 if 'equivalent' in results and not results['equivalent'].dropna().all() else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,49 +1,135 @@
 import os
 import SimpleITK as sitk
-from typing import Union
+from typing import Dict, Iterable, List, Union
 import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-def DCM_folder_to_nnUNet(input_dir: str = None, nnUNet_output_dir: str = None, n_inputs: int = 0, desired_format: str = None) -> None:
-    # Guarantee that the output path exists
-    if not os.path.exists(nnUNet_output_dir):
-        os.mkdir(nnUNet_output_dir)
+from DICOM_Index import DICOMIndex
+from Image_IO import write_image
+from Profiling import phase, profiled_stage, record_io
+from Stage_Cache import StageCache
+
+# File ending written for each supported output format
+FILE_ENDINGS = {'nrrd': 'nrrd', 'nifti': 'nii.gz'}
+
+def DCM_folder_to_nnUNet(input_dir: str = None, nnUNet_output_dir: Union[str, Dict[str, str]] = None, n_inputs: int = 0,
+                         desired_format: Union[str, Iterable[str]] = None, num_workers: int = 1, use_processes: bool = False,
+                         index_path: str = None, modality: str = 'CT', min_slices: int = 1) -> None:
+    """
+    Converts every DICOM series in input_dir to nnU-Net inputs (<case>_0000.<ending>) in one or more formats.
+    Each series is decoded once and all requested formats are written from the same in-memory image.
     
-    if desired_format == 'nrrd':
-        file_ending = 'nrrd'
-        intermediate_output_dir = f'{input_dir} - NRRD'
-        if not os.path.exists(intermediate_output_dir):
-            os.mkdir(intermediate_output_dir)
-    elif desired_format == "nifti":
-        file_ending == 'nii.gz'
-        intermediate_output_dir = f'{input_dir} - NIfTI'
-        if not os.path.exists(intermediate_output_dir):
-            os.mkdir(intermediate_output_dir)
-
-    # Iterate over all files in the folder
-    for filename in os.listdir(input_dir):
-        if os.path.exists(os.path.join(intermediate_output_dir, filename)): # MAY NEED TO BE ADAPTED FOR MULTIPLE INPUTS
-            if os.path.exists(os.path.join(intermediate_output_dir, filename,  f'{filename}.{file_ending}')):
-                continue
-        
-        dcm_dir = os.path.join(input_dir, filename, 'DICOM', 'EXP00000')
-        convert_DCM_to_desired_format(dcm_dir, intermediate_output_dir, desired_format, filename)
+    Parameters:
+    - input_dir: str, folder with one <case>/DICOM/EXP00000 series per case.
+    - nnUNet_output_dir: str, or dict of format -> output folder when several formats are requested.
+    - desired_format: str or iterable of str, any of 'nrrd' (temporalis 2D model) and 'nifti' (TOTAL/BS models).
+    - num_workers: int, number of series converted concurrently (default 1, serial).
+    - use_processes: bool, use a process pool instead of a thread pool (default False).
+    - index_path: str (optional), a DICOM index (see DICOM_Index.py) of input_dir: the series are found from their
+      headers in any folder layout, and the selected series of every study is converted (of the given modality, with
+      the most slices and at least min_slices slices) instead of <case>/DICOM/EXP00000.
+    """
+    formats = format_set(desired_format)
 
-    for filename in os.listdir(intermediate_output_dir):
-        if os.path.exists(os.path.join(nnUNet_output_dir, f'{filename.split(".")[0]}_0000.{file_ending}')): # MAY NEED TO BE ADAPTED FOR MULTIPLE INPUTS
+    # Pair every requested format with its output folder
+    if isinstance(nnUNet_output_dir, dict):
+        output_dirs = {desired: nnUNet_output_dir[desired] for desired in formats}
+    elif len(formats) == 1:
+        output_dirs = {formats[0]: nnUNet_output_dir}
+    else:
+        raise ValueError('nnUNet_output_dir must map each format to a folder when several formats are requested')
+
+    # Guarantee that the output paths exist
+    for output_dir in output_dirs.values():
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
+    caches = conversion_stage_caches(output_dirs)
+
+    # Collect the series that still need to be converted, each written directly to its final nnU-Net names
+    tasks = []
+    records = []
+    for case_name, (dcm_dir, series_uid) in DCM_series(input_dir, index_path, modality, min_slices).items():
+        outdated = outdated_outputs(dcm_dir, case_name, output_dirs, caches, series_uid)
+        if not outdated:
             continue
+        
+        tasks.append((dcm_dir, [nnUNet_file for _, nnUNet_file, _ in outdated], series_uid))
+        records.append(outdated)
+
+    if num_workers <= 1 or len(tasks) <= 1:
+        results = (convert_DCM_series(*task) for task in tasks)
+        for _, outdated in zip(results, records):
+            record_outputs(outdated)
+        return
 
-        original_file = os.path.join(intermediate_output_dir, filename, f'{filename}.{file_ending}')
-        to_nnUNet_name(original_file, nnUNet_output_dir, file_ending) # MAY NEED TO BE ADAPTED FOR MULTIPLE INPUTS
+    # GDCM decoding and gzip compression release the GIL, so threads are usually enough to convert series concurrently
+    executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor(max_workers=num_workers) as pool:
+        for _, outdated in zip(pool.map(convert_DCM_series, *zip(*tasks)), records):
+            record_outputs(outdated)
 
-def convert_DCM_to_desired_format(dcm_dir: str = None, output_dir: str = None, desired_format: str = None, case_name: str = None) -> Union[None, int]:
-    # Read the DICOM series
+def DCM_series(input_dir: str = None, index_path: str = None, modality: str = 'CT', min_slices: int = 1) -> Dict[str, tuple]:
+    # Case name -> (series folder, series UID), from the index of input_dir or from the fixed layout (any series of the folder)
+    if index_path is None:
+        return {filename: (os.path.join(input_dir, filename, 'DICOM', 'EXP00000'), None) for filename in sorted(os.listdir(input_dir))}
+    with DICOMIndex(index_path, input_dir) as index:
+        index.scan(quiet_seconds=0)
+        return {series['patient_id']: (series['directory'], series['series_uid'])
+                for series in index.ready_series(0, modality, min_slices, include_ingested=True)}
+
+def conversion_stage_caches(output_dirs: Dict[str, str] = None) -> Dict[str, StageCache]:
+    # One stage manifest per output format and folder
+    return {desired: StageCache(output_dir, 'convert_DCM_series', {'format': desired}) for desired, output_dir in output_dirs.items()}
+
+def outdated_outputs(dcm_dir: str = None, case_name: str = None, output_dirs: Dict[str, str] = None,
+                     caches: Dict[str, StageCache] = None, series_uid: str = None) -> List[tuple]:
+    # The (cache, nnU-Net file, key) of every output of a case that is missing or older than its series
+    outdated = []
+    for desired, output_dir in output_dirs.items():
+        nnUNet_file = os.path.join(output_dir, f'{case_name.split(".")[0]}_0000.{FILE_ENDINGS[desired]}') # MAY NEED TO BE ADAPTED FOR MULTIPLE INPUTS
+
+        # Outputs are reused only if the series files and the format (and the selected series, if any) are unchanged
+        key = caches[desired].key([dcm_dir], **({'series_uid': series_uid} if series_uid is not None else {}))
+        if not caches[desired].is_fresh(nnUNet_file, key):
+            outdated.append((caches[desired], nnUNet_file, key))
+    return outdated
+
+def record_outputs(outdated: List[tuple] = None) -> None:
+    # Record the converted outputs of one series in their stage manifests
+    for cache, nnUNet_file, key in outdated:
+        cache.record(nnUNet_file, key)
+
+def format_set(desired_format: Union[str, Iterable[str]] = None) -> List[str]:
+    # Accept a single format or any collection of them, in a stable order without duplicates
+    formats = [desired_format] if isinstance(desired_format, str) else list(dict.fromkeys(desired_format or []))
+    if not formats:
+        raise ValueError("No output format requested, expected 'nrrd' and/or 'nifti'")
+    for desired in formats:
+        if desired not in FILE_ENDINGS:
+            raise ValueError(f"Unsupported format '{desired}', expected 'nrrd' or 'nifti'")
+    return formats
+
+def read_DCM_series(dcm_dir: str = None, series_uid: str = None) -> sitk.Image:
+    # Read the DICOM series (the given one, else the first series of the folder)
     reader = sitk.ImageSeriesReader()
-    dcm_series = reader.GetGDCMSeriesFileNames(dcm_dir)
+    dcm_series = reader.GetGDCMSeriesFileNames(dcm_dir, series_uid) if series_uid else reader.GetGDCMSeriesFileNames(dcm_dir)
     reader.SetFileNames(dcm_series)
     
     # Load the DICOM series into an image
     image = reader.Execute()
+    record_io('read', sum(os.path.getsize(dcm_file) for dcm_file in dcm_series))
+    return image
+
+@profiled_stage('convert_DCM_series', patient_argument='output_files')
+def convert_DCM_series(dcm_dir: str = None, output_files: Union[str, List[str]] = None, series_uid: str = None) -> None:
+    # Decode the series once, then save it to every output; the format follows the file ending of each output file
+    with phase('read'):
+        image = read_DCM_series(dcm_dir, series_uid)
+    with phase('write'):
+        for output_file in ([output_files] if isinstance(output_files, str) else output_files):
+            write_image(image, output_file, use_compression=False)
 
+def convert_DCM_to_desired_format(dcm_dir: str = None, output_dir: str = None, desired_format: Union[str, Iterable[str]] = None, case_name: str = None) -> Union[None, int]:
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
 
@@ -52,17 +138,13 @@ def convert_DCM_to_desired_format(dcm_dir: str = None, output_dir: str = None, d
     if not os.path.exists(subdir):
         os.mkdir(subdir)  
 
-    # Save the image
-    if desired_format == 'nrrd':
-        if not os.path.exists(os.path.join(subdir, f'{case_name}.nrrd')):
-            sitk.WriteImage(image, os.path.join(subdir, f'{case_name}.nrrd'))
-        else:
-            return -1
-    elif desired_format == 'nifti':
-        if not os.path.exists(os.path.join(subdir, f'{case_name}.nii.gz')):
-            sitk.WriteImage(image, os.path.join(subdir, f'{case_name}.nii.gz'))
-        else:
-            return -1
+    # Save the image in every requested format that does not exist yet
+    output_files = [os.path.join(subdir, f'{case_name}.{FILE_ENDINGS[desired]}') for desired in format_set(desired_format)]
+    output_files = [output_file for output_file in output_files if not os.path.exists(output_file)]
+    if not output_files:
+        return -1
+
+    convert_DCM_series(dcm_dir, output_files)
 
 def to_nnUNet_name(input_file: str = None, nnUNet_output_dir: str = None, file_ending: str = None) -> None:
     filename = os.path.basename(input_file)
@@ -6,48 +6,32 @@ import Filtered_Aggregates_to_Statistics
 
 if __name__ == '__main__':
     
-    ##### 1 ^ 2 --> Can be Concurrent #####
+    ##### 1 + 2 --> One decode per series, both formats #####
     
-    ##### 3 ^ 4 ^ 5 --> Can be Concurrent #####
+    ##### 3 ^ 4 ^ 5 --> Run concurrently by Model_Inputs_to_All_Masks #####
 
     ##### 6 ^ 7 ^ 8 --> Must be Sequential #####
 
-    # 1
-    
-    input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Batch 5 - DCM"
-    output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NIfTI"
-    desired_format = 'nifti'
-
-    DCM_to_Model_Input.DCM_folder_to_nnUNet(input_dir, output_dir, desired_format)
+    ##### 6 --> Writes the final aggregates only (<aggregates_output_dir> - FINAL), there is no intermediate folder #####
 
-    # 2
+    # 1 + 2 --> Each DICOM series is decoded once and written in both formats
 
     input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Batch 5 - DCM"
-    output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NRRD"
-    desired_format = 'nrrd'
-    
-    DCM_to_Model_Input.DCM_folder_to_nnUNet(input_dir, output_dir, desired_format)
-
-    # 3
-
-    input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NRRD"
-    output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - TEMP"
-
-    Model_Input_to_Masks.NRRD_to_Temporal_Masks(input_dir, output_dir)
-
-    # 4
-
-    input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NIfTI"
-    output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - TOTAL"
+    output_dirs = {'nifti': r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NIfTI",
+                   'nrrd': r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NRRD"}
+    desired_format = {'nifti', 'nrrd'}
 
-    Model_Input_to_Masks.NIfTI_to_Total_Masks(input_dir, output_dir)
+    DCM_to_Model_Input.DCM_folder_to_nnUNet(input_dir, output_dirs, desired_format=desired_format)
 
-    # 5
+    # 3 + 4 + 5 --> One scheduler, shared preprocessing and export pools
 
-    input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - NIfTI"
-    output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - NEURO"
+    nrrd_input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NRRD"
+    nifti_input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - nnUNet - NIfTI"
+    temp_output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - TEMP"
+    total_output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - TOTAL"
+    bs_output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - NEURO"
 
-    Model_Input_to_Masks.NIfTI_to_Neuroanatomy_Masks(input_dir, output_dir)
+    Model_Input_to_Masks.Model_Inputs_to_All_Masks(nrrd_input_dir, nifti_input_dir, temp_output_dir, total_output_dir, bs_output_dir)
 
     # 6
 
@@ -60,7 +44,7 @@ if __name__ == '__main__':
 
     # 7
 
-    input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - Aggregates"
+    input_dir = f'{aggregates_output_dir} - FINAL'
     filtered_output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Test\Batch 5 - Aggregates - FILTERED"
     classes_to_suppress = [22, 28]
 
@@ -0,0 +1,314 @@
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import SimpleITK as sitk
+
+# Case key prefix of the files directly in the watch folder, grouped by PatientID: no folder name contains it, so such
+# a case never merges with a case folder of the same name
+ROOT_CASE_PREFIX = os.sep
+
+# DICOM tags read from the header of every file
+DICOM_TAGS = {
+    'patient_id': '0010|0020',
+    'study_uid': '0020|000d',
+    'series_uid': '0020|000e',
+    'study_date': '0008|0020',
+    'modality': '0008|0060',
+    'series_description': '0008|103e',
+    'instance_number': '0020|0013',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER, newest_ns INTEGER);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY, directory TEXT, case_name TEXT, size INTEGER, mtime_ns INTEGER, seen_at REAL,
+    patient_id TEXT, study_uid TEXT, series_uid TEXT, study_date TEXT, modality TEXT, series_description TEXT,
+    instance_number INTEGER);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_case ON files (case_name);
+CREATE TABLE IF NOT EXISTS names (
+    study_uid TEXT PRIMARY KEY, case_name TEXT, patient_id TEXT UNIQUE, series_uid TEXT, assigned_at REAL);
+CREATE TABLE IF NOT EXISTS ingested (
+    study_uid TEXT PRIMARY KEY, case_name TEXT, patient_id TEXT, series_uid TEXT, directory TEXT, slices INTEGER,
+    status TEXT, ingested_at REAL);
+"""
+
+class DICOMIndex(object):
+    """
+    SQLite index of the DICOM files under a watch folder: the study, series, modality and description of every file,
+    read from its header only (no pixel data), with its size and modification time.
+
+    A scan only lists the folders whose modification time changed since the previous scan (a file added, removed or
+    renamed changes the time of its folder), plus the folders that changed within the quiet period, whose files may
+    still be being written. Every other folder costs one stat, so a scan of a folder of 100k unchanged files takes a
+    fraction of a second, and only new or changed files have their header read. A file rewritten in place in a folder
+    that has been quiet for longer than the quiet period is not noticed until its folder changes.
+
+    A case is a top-level folder of the watch folder (files directly in it are grouped by their PatientID). A case is
+    ready once none of its files and folders was modified during the quiet period, judged by their modification
+    times (so the clocks of the file server and of this machine should agree). The best series of each of its
+    studies is then selected (see select_series), whatever the folder layout and the number of series per study.
+    The patient ID and series of a study are recorded when the study is first selected and never change afterwards,
+    so a study that arrives later (even with an earlier date) never takes over the name of another one. Ingested
+    studies are recorded too, so each study is queued once.
+    """
+    def __init__(self, index_path: str = None, root: str = None) -> None:
+        """
+        Parameters:
+        - index_path: str, the SQLite file (created if needed).
+        - root: str, the watch folder; the index stores paths relative to it.
+        """
+        self.index_path = index_path
+        self.root = os.path.abspath(root)
+        self.connection = sqlite3.connect(index_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(SCHEMA)
+        # Studies ingested before names were recorded keep the name they were ingested as
+        self.connection.execute('INSERT OR IGNORE INTO names SELECT study_uid, case_name, patient_id, series_uid, ingested_at FROM ingested')
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def scan(self, quiet_seconds: float = 60, num_threads: int = 4) -> int:
+        """
+        Brings the index up to date with the watch folder. Returns the number of files added, changed or removed.
+
+        Parameters:
+        - quiet_seconds: float, folders changed more recently than this are listed again at every scan.
+        - num_threads: int, headers read concurrently.
+        """
+        now_ns = time.time_ns()
+        known = {row['path']: row for row in self.connection.execute('SELECT * FROM directories')}
+        children = {}
+        for row in known.values():
+            children.setdefault(row['parent'], []).append(row['path'])
+
+        changes = 0
+        visited = set()
+        stack = ['']
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            while stack:
+                directory = stack.pop()
+                try:
+                    mtime_ns = os.stat(os.path.join(self.root, directory)).st_mtime_ns
+                except OSError:
+                    continue
+                visited.add(directory)
+
+                # An unchanged, quiet folder: its subfolders are known, its files are not listed
+                entry = known.get(directory)
+                if entry is not None and entry['mtime_ns'] == mtime_ns and now_ns - entry['newest_ns'] >= quiet_seconds * 1e9:
+                    stack.extend(children.get(directory, []))
+                    continue
+
+                subdirectories, file_changes, newest_ns = self.update_directory(directory, pool)
+                stack.extend(subdirectories)
+                changes += file_changes
+                self.connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)',
+                                        (directory, os.path.dirname(directory) if directory else None, mtime_ns, max(mtime_ns, newest_ns)))
+                self.connection.commit()
+
+        # Folders that disappeared
+        for directory in set(known) - visited:
+            changes += self.connection.execute('DELETE FROM files WHERE directory = ?', (directory,)).rowcount
+            self.connection.execute('DELETE FROM directories WHERE path = ?', (directory,))
+        self.connection.commit()
+        return changes
+
+    def update_directory(self, directory: str = None, pool: ThreadPoolExecutor = None) -> tuple:
+        # Lists one folder: reads the headers of its new and changed files and drops its removed files.
+        # Returns its subfolders, the number of changed files and the newest modification time of its files.
+        known = {row['path']: (row['size'], row['mtime_ns']) for row in
+                 self.connection.execute('SELECT path, size, mtime_ns FROM files WHERE directory = ?', (directory,))}
+        subdirectories, listed, changed = [], set(), []
+        newest_ns = 0
+        with os.scandir(os.path.join(self.root, directory)) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                path = os.path.join(directory, entry.name)
+                if entry.is_dir():
+                    subdirectories.append(path)
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                listed.add(path)
+                newest_ns = max(newest_ns, stat.st_mtime_ns)
+                if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                    changed.append((path, stat.st_size, stat.st_mtime_ns))
+
+        seen_at = time.time()
+        case_name = directory.split(os.sep)[0] if directory else None
+        headers = pool.map(read_header, [os.path.join(self.root, path) for path, _, _ in changed])
+        for (path, size, mtime_ns), header in zip(changed, headers):
+            header = header or {}
+            self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (path, directory, case_name or root_case_name(header.get('patient_id')), size, mtime_ns, seen_at,
+                                     *[header.get(field) for field in DICOM_TAGS]))
+
+        removed = set(known) - listed
+        self.connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+        return subdirectories, len(changed) + len(removed), newest_ns
+
+    def series(self, case_name: str = None) -> List[dict]:
+        # Every series of a case (per folder, when one is split across folders), with its number of slices
+        return [dict(row) for row in self.connection.execute(
+            'SELECT study_uid, series_uid, directory, MIN(patient_id) AS patient_id, MIN(study_date) AS study_date, '
+            'MIN(modality) AS modality, MIN(series_description) AS series_description, COUNT(*) AS slices '
+            'FROM files WHERE case_name = ? AND series_uid IS NOT NULL GROUP BY study_uid, series_uid, directory '
+            'ORDER BY study_date, study_uid, series_uid', (case_name,))]
+
+    def ready_cases(self, quiet_seconds: float = 60) -> List[str]:
+        # The cases none of whose files or folders were modified during the last quiet_seconds. Folder times cover the
+        # copies that keep the times of the original files (a file added to a folder updates the folder's time), and
+        # already complete cases are ready on the first scan of an existing archive
+        last_change = {row['case_name']: row['mtime_ns'] for row in self.connection.execute(
+            'SELECT case_name, MAX(mtime_ns) AS mtime_ns FROM files WHERE case_name IS NOT NULL GROUP BY case_name')}
+        for row in self.connection.execute("SELECT path, mtime_ns FROM directories WHERE path != ''"):
+            case_name = row['path'].split(os.sep)[0]
+            if case_name in last_change:
+                last_change[case_name] = max(last_change[case_name], row['mtime_ns'])
+        threshold_ns = time.time_ns() - quiet_seconds * 1e9
+        return sorted(case_name for case_name, mtime_ns in last_change.items() if mtime_ns <= threshold_ns)
+
+    def ready_series(self, quiet_seconds: float = 60, modality: str = 'CT', min_slices: int = 1, include_ingested: bool = False) -> List[dict]:
+        """
+        The selected series of every study of the ready cases that has not been ingested yet.
+
+        Parameters:
+        - quiet_seconds: float, how long the files of a case must be unchanged for its series to be complete.
+        - modality: str (optional), the modality of the series to select (None for any).
+        - min_slices: int, smaller series (localizers, dose reports, ...) are never selected.
+        - include_ingested: bool, also return the studies already ingested.
+
+        Returns:
+        - series: list of dict, with the patient_id the pipeline uses, the case_name, study_uid, series_uid, directory
+          (absolute), slices, modality and series_description of each selected series.
+        """
+        ingested = {row['study_uid'] for row in self.connection.execute('SELECT study_uid FROM ingested')}
+        assigned = {row['study_uid']: dict(row) for row in self.connection.execute('SELECT * FROM names')}
+        taken = {entry['patient_id'] for entry in assigned.values()}
+        selected = []
+        for case_name in self.ready_cases(quiet_seconds):
+            studies = {}
+            for series in self.series(case_name):
+                studies.setdefault(series['study_uid'], []).append(series)
+
+            for study_uid, candidates in studies.items():
+                if study_uid in ingested and not include_ingested:
+                    continue
+
+                # A named study keeps its series while it exists; otherwise the best series is selected and recorded
+                entry = assigned.get(study_uid)
+                series = next((series for series in candidates if entry is not None and series['series_uid'] == entry['series_uid']), None)
+                series = series or select_series(candidates, modality, min_slices)
+                if series is None:
+                    continue
+                if entry is None or entry['series_uid'] != series['series_uid']:
+                    # The first study of a case is named after it, later ones <case>_1, <case>_2, ... in order of arrival
+                    if entry is not None:
+                        patient_id = entry['patient_id']
+                    else:
+                        base = case_name[len(ROOT_CASE_PREFIX):] if case_name.startswith(ROOT_CASE_PREFIX) else case_name
+                        patient_id = base if base not in taken else study_patient_id(base, taken)
+                    entry = {'study_uid': study_uid, 'case_name': case_name, 'patient_id': patient_id, 'series_uid': series['series_uid']}
+                    self.connection.execute('INSERT OR REPLACE INTO names VALUES (?, ?, ?, ?, ?)',
+                                            (study_uid, case_name, patient_id, series['series_uid'], time.time()))
+                    self.connection.commit()
+                    assigned[study_uid] = entry
+                    taken.add(patient_id)
+                selected.append(dict(series, patient_id=entry['patient_id'], case_name=case_name,
+                                     directory=os.path.join(self.root, series['directory'])))
+        return selected
+
+    def mark_ingested(self, series: dict = None, status: str = 'done') -> None:
+        """
+        Records that the study of a selected series was queued ('done' or 'failed'), so it is not queued again.
+        """
+        self.connection.execute('INSERT OR REPLACE INTO ingested VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (series['study_uid'], series['case_name'], series['patient_id'], series['series_uid'],
+                                 os.path.relpath(series['directory'], self.root), series['slices'], status, time.time()))
+        self.connection.commit()
+
+    def forget(self, patient_ids: List[str] = None) -> int:
+        # Drops the ingestion records of patients, so their studies are queued again
+        removed = self.connection.executemany('DELETE FROM ingested WHERE patient_id = ?', [(patient_id,) for patient_id in patient_ids]).rowcount
+        self.connection.commit()
+        return removed
+
+    def ingested(self) -> List[dict]:
+        return [dict(row) for row in self.connection.execute('SELECT * FROM ingested ORDER BY ingested_at')]
+
+def read_header(path: str = None) -> dict:
+    # The DICOM_TAGS of a file, reading its header only; None for files that are not (or not yet entirely) DICOM
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    reader.SetFileName(path)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None
+    header = {field: reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else None for field, tag in DICOM_TAGS.items()}
+    if not header['series_uid']:
+        return None
+    try:
+        header['instance_number'] = int(header['instance_number'])
+    except (TypeError, ValueError):
+        header['instance_number'] = None
+    return header
+
+def select_series(candidates: List[dict] = None, modality: str = 'CT', min_slices: int = 1) -> dict:
+    """
+    The series to segment among the series of one study: the one of the given modality with the most slices
+    (ties go to the first series UID), or None when no series qualifies.
+    """
+    eligible = [series for series in candidates
+                if series['slices'] >= min_slices and (modality is None or (series['modality'] or '').upper() == modality.upper())]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda series: (-series['slices'], series['series_uid']))
+
+def root_case_name(patient_id: str = None) -> str:
+    # Case key of the files directly in the watch folder (None when the header could not be read)
+    return f'{ROOT_CASE_PREFIX}{patient_id}' if patient_id else None
+
+def study_patient_id(case_name: str = None, taken: set = None) -> str:
+    # The first free <case>_<n> patient ID for another study of a case
+    number = 1
+    while f'{case_name}_{number}' in taken:
+        number += 1
+    return f'{case_name}_{number}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update and print the DICOM index of a watch folder.')
+    parser.add_argument('watch_dir')
+    parser.add_argument('--index', required=True, help='SQLite index file')
+    parser.add_argument('--quiet-seconds', type=float, default=60, help='a case is complete once its files are unchanged for this long')
+    parser.add_argument('--modality', default='CT')
+    parser.add_argument('--min-slices', type=int, default=20)
+    parser.add_argument('--forget', nargs='*', default=[], help='patients whose studies are queued again')
+    args = parser.parse_args()
+
+    with DICOMIndex(args.index, args.watch_dir) as index:
+        if args.forget:
+            print(f'{index.forget(args.forget)} ingestion records removed')
+        start = time.perf_counter()
+        changes = index.scan(args.quiet_seconds)
+        print(f'{changes} files changed ({time.perf_counter() - start:.2f} s)')
+        for series in index.ready_series(args.quiet_seconds, args.modality, args.min_slices):
+            print(f"{series['patient_id']}: {series['modality']} '{series['series_description']}', {series['slices']} slices in {series['directory']}")
@@ -1,14 +1,39 @@
 import SimpleITK as sitk
 import numpy as np
-from radiomics import featureextractor
+from radiomics import featureextractor, getFeatureClasses
 import pandas as pd
+import json
 import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+from Image_IO import NPY_ENDING, SlabReader, geometry_image, is_image_file, iter_slabs, read_array, slab_depth
+from Label_Histograms import LabelHistograms, label_histograms_path
+from Label_Index import LabelIndex
+from Label_Registry import LabelRegistry
+from Profiling import phase, profiled_stage
+from Statistics_Store import ParquetStatisticsWriter
+
+# Rough peak of the per-slab temporaries of the slab-wise statistics, per voxel (foreground mask, gathers, histogram keys)
+SLAB_BYTES_PER_VOXEL = 24
+
+# PyRadiomics features extracted by default: feature class -> feature names (None enables the whole class)
+RADIOMICS_FEATURE_CLASSES = {'firstorder': ['Mean', 'Median', 'RobustMeanAbsoluteDeviation'], 'shape': ['VoxelVolume']}
+
+# Extractors of the current thread, by feature settings (see radiomics_extractor)
+_radiomics_extractors = threading.local()
 
 def Filtered_Aggregates_to_Statistics(mask_folder: str, image_folder: str, output_csv: str, cohort: str = 'NSP', site: str = 'JGH', modality: str = 'CT',
-                         model_name = 'TotalSegmentatorV2[total, brain_structures]_InHouseTemporalis') -> None:
+                         model_name = 'TotalSegmentatorV2[total, brain_structures]_InHouseTemporalis',
+                         num_workers: int = 1, max_in_flight: int = None, resume: bool = True, label_registry: LabelRegistry = None,
+                         max_memory_mb: float = None, radiomics_features: dict = None, radiomics_workers: int = 1,
+                         save_histograms: bool = False, statistics_dataset: str = None) -> None:
     """
     Iterates through the image and mask folders, extracts statistics for each segment,
-    aggregates them into a dictionary, and saves them into a single CSV file.
+    and streams them into a single CSV file (or a Parquet dataset) as each patient finishes.
     
     Parameters:
     - mask_folder: str, path to the folder containing masks.
@@ -17,15 +42,35 @@ def Filtered_Aggregates_to_Statistics(mask_folder: str, image_folder: str, outpu
     - cohort: str, the cohort name (default 'NSP').
     - site: str, the site name (default 'JGH').
     - modality: str, the modality type (default 'CT').
+    - num_workers: int, number of patients processed in parallel worker processes (default 1, serial).
+    - max_in_flight: int, maximum number of patients queued or held in memory at once (default 2 x num_workers).
+    - resume: bool, keep the patients already written to output_csv by a previous run and skip them (default True).
+    - label_registry: LabelRegistry (optional), the registry the masks were aggregated with; adds a segment_name column.
+    - max_memory_mb: float (optional), memory ceiling of each worker in MiB; the statistics are then computed slab by slab.
+    - radiomics_features: dict (optional), PyRadiomics feature class -> feature names (None for the whole class); the
+      statistics are then extracted with PyRadiomics, one extra column per feature (see parse_radiomics_features).
+    - radiomics_workers: int, worker processes that extract the segments of each patient with PyRadiomics (default 1).
+    - save_histograms: bool, also save the per-label HU histograms of every patient next to its mask, for
+      `Label_Histograms.cohort_statistics` (default False: the mask folder is left untouched).
+    - statistics_dataset: str (optional), write the rows to this Parquet dataset folder, partitioned by cohort, site and
+      model (see Statistics_Store.py), instead of output_csv.
     """
-    # Define the list to hold all records for the CSV
-    rows = []
+    # Open the output, recovering the patients completed by a previous run
+    segment_names = label_registry.names() if label_registry is not None else None
+    writer = open_statistics_writer(output_csv, statistics_dataset, resume,
+                                    StatisticsCSVWriter.columns_for(segment_names is not None, radiomics_features),
+                                    {'cohort': cohort, 'site': site, 'model_name': model_name})
+
+    # Define the list of patients to process, in a stable order
+    tasks = []
     
     # Iterate through each mask file in the mask folder
-    for mask_file in os.listdir(mask_folder):
-        if mask_file.endswith('.nii.gz'):
+    for mask_file in sorted(os.listdir(mask_folder)):
+        if is_image_file(mask_file) and mask_file.endswith(('.nii.gz', NPY_ENDING)):
             # Extract the base patient ID from the mask file (removing the extension)
             patient_id = mask_file.split('.')[0]
+            if patient_id in writer.completed:
+                continue
             mask_path = os.path.join(mask_folder, mask_file)
             
             # Locate the corresponding image file based on the patient ID
@@ -36,82 +81,329 @@ def Filtered_Aggregates_to_Statistics(mask_folder: str, image_folder: str, outpu
             if not os.path.exists(image_path):
                 print(f"Image for patient {patient_id} not found! Skipping...")
                 continue
-            
-            # Extract statistics for each segment in the mask
-            stats = extract_baseline_features_InHouse(image_path, mask_path)
-            
-            # Create rows for each segment in the mask
-            for segment_id, features in stats.items():
-                row = {
-                    'segment': segment_id,
-                    'segment_feature': 'size',  # Placeholder, can be updated as needed
-                    'cohort': cohort,
-                    'site': site,
-                    'modality': modality,
-                    'model_name': model_name,
-                    'patient_id': patient_id,
-                    'series_description': os.path.basename(image_path).replace('_0000.nii.gz', ''),
-                    'volume': features.get('volume', None),
-                    'mean_density': features.get('mean_density', None),
-                    'median_density': features.get('median_density', None),
-                    'std_dev': features.get('std_dev', None),
-                }
-                rows.append(row)
-
-    # Convert the rows to a DataFrame and save as CSV
-    df = pd.DataFrame(rows)
-    df.to_csv(output_csv, index=False)
-
-def extract_baseline_features_PyRads(image_path, mask_path):
-    """
-    Extracts baseline statistics (volume, surface area, mean intensity, std intensity, and median intensity)
-    for each segment in the mask using PyRadiomics.
+
+            tasks.append((patient_id, mask_path, image_path, cohort, site, modality, model_name, segment_names, max_memory_mb,
+                          radiomics_features, radiomics_workers, save_histograms))
+
+    # Extract the statistics of every patient, appending the row blocks to the CSV in the order of the tasks
+    with writer:
+        for task, patient_rows in zip(tasks, map_in_order(patient_statistics_rows, tasks, num_workers, max_in_flight)):
+            writer.write_patient(task[0], patient_rows)
+
+def open_statistics_writer(output_csv: str = None, statistics_dataset: str = None, resume: bool = True, columns: list = None,
+                           partition: dict = None):
+    # The statistics sink: a Parquet dataset when statistics_dataset is given (resuming within partition), else the CSV
+    if statistics_dataset is not None:
+        return ParquetStatisticsWriter(statistics_dataset, resume=resume, columns=columns, partition=partition)
+    return StatisticsCSVWriter(output_csv, resume=resume, columns=columns)
+
+def patient_statistics_rows(patient_id: str, mask_path: str, image_path: str, cohort: str = 'NSP', site: str = 'JGH', modality: str = 'CT',
+                            model_name = 'TotalSegmentatorV2[total, brain_structures]_InHouseTemporalis', segment_names: dict = None,
+                            max_memory_mb: float = None, radiomics_features: dict = None, radiomics_workers: int = 1,
+                            save_histograms: bool = False) -> list:
+    """
+    Extracts the statistics of one patient and formats them as one CSV row per segment.
     
     Parameters:
-    - image_path: str, path to the input image (e.g., .nii.gz).
-    - mask_path: str, path to the segmentation mask file (e.g., .nii.gz).
+    - patient_id: str, the patient ID written to every row.
+    - mask_path: str, path to the filtered aggregate mask of the patient.
+    - image_path: str, path to the corresponding image.
+    - cohort, site, modality, model_name: str, descriptive columns written to every row.
+    - segment_names: dict (optional), segment ID -> name, written to a segment_name column.
+    - max_memory_mb: float (optional), memory ceiling in MiB, to compute the statistics slab by slab.
+    - radiomics_features: dict (optional), extract the statistics with PyRadiomics with these feature classes instead
+      (max_memory_mb does not apply: PyRadiomics works on whole volumes).
+    - radiomics_workers: int, worker processes that extract the segments with PyRadiomics (default 1).
+    - save_histograms: bool, save the per-label HU histograms next to the mask (in-house statistics only; default False).
     
     Returns:
-    - result_dict: dict, containing statistics for each segment.
+    - rows: list of dict, one record per segment.
+    """
+    # Extract statistics for each segment in the mask
+    if radiomics_features is not None:
+        stats = extract_baseline_features_PyRads(image_path, mask_path, radiomics_features, radiomics_workers)
+    else:
+        stats = extract_baseline_features_InHouse(image_path, mask_path, max_memory_mb, save_histograms)
+
+    series_description = os.path.basename(image_path).replace('_0000.nii.gz', '')
+    return statistics_to_rows(stats, patient_id, series_description, cohort, site, modality, model_name, segment_names)
+
+def statistics_to_rows(stats: dict, patient_id: str, series_description: str, cohort: str = 'NSP', site: str = 'JGH', modality: str = 'CT',
+                       model_name = 'TotalSegmentatorV2[total, brain_structures]_InHouseTemporalis', segment_names: dict = None) -> list:
     """
-    # Initialize the PyRadiomics extractor
-    extractor = featureextractor.RadiomicsFeatureExtractor()
+    Formats the per-segment statistics of one patient as one CSV row per segment.
     
-    # Disable all features except for the basics we're interested in
-    extractor.enableFeatureClassByName('firstorder')
-    extractor.enableFeatureClassByName('shape')
+    Parameters:
+    - stats: dict, the per-segment statistics returned by extract_baseline_features_InHouse.
+    - patient_id: str, the patient ID written to every row.
+    - series_description: str, the series description written to every row.
+    - cohort, site, modality, model_name: str, descriptive columns written to every row.
+    - segment_names: dict (optional), segment ID -> name, written to a segment_name column.
+    
+    Returns:
+    - rows: list of dict, one record per segment.
+    """
+    rows = []
+
+    # Create rows for each segment in the mask
+    for segment_id, features in stats.items():
+        row = {
+            'segment': segment_id,
+            'segment_feature': 'size',  # Placeholder, can be updated as needed
+            'cohort': cohort,
+            'site': site,
+            'modality': modality,
+            'model_name': model_name,
+            'patient_id': patient_id,
+            'series_description': series_description,
+            'volume': features.get('volume', None),
+            'mean_density': features.get('mean_density', None),
+            'median_density': features.get('median_density', None),
+            'std_dev': features.get('std_dev', None),
+        }
+        if segment_names is not None:
+            row['segment_name'] = segment_names.get(int(segment_id))
+        row.update({name: value for name, value in features.items() if name.startswith('original_')})
+        rows.append(row)
+
+    return rows
+
+class StatisticsCSVWriter(object):
+    """
+    Append-only CSV writer for the statistics rows, one block of rows per patient.
+
+    After each patient's rows are flushed to disk, the patient ID and the CSV size are appended to a
+    small `<output_csv>.progress` sidecar. On resume the sidecar is read once into a set, so checking
+    whether a patient is done is an O(1) lookup, and the CSV is truncated to the last completed patient
+    so rows from a run that crashed mid-patient are never duplicated. A CSV without a sidecar (e.g. written
+    before sidecars existed) is renamed aside rather than overwritten, and resuming a CSV whose header differs
+    from the columns of the run is refused.
+    """
+    columns = ['segment', 'segment_feature', 'cohort', 'site', 'modality', 'model_name', 'patient_id',
+               'series_description', 'volume', 'mean_density', 'median_density', 'std_dev']
+    named_columns = columns[:1] + ['segment_name'] + columns[1:]
+
+    @classmethod
+    def columns_for(cls, named: bool = False, radiomics_features: dict = None) -> list:
+        # The columns of a statistics CSV, with the segment_name column and the PyRadiomics feature columns as needed
+        columns = cls.named_columns if named else cls.columns
+        if radiomics_features is not None:
+            columns = columns + radiomics_columns(radiomics_features)
+        return columns
+
+    def __init__(self, output_csv: str = None, resume: bool = True, columns: list = None) -> None:
+        self.output_csv = output_csv
+        self.columns = columns or self.columns
+        self.progress_path = f'{output_csv}.progress'
+        self.completed = set()
+
+        # Keep the results of a CSV that has no progress sidecar, which cannot be resumed
+        if resume and not os.path.exists(self.progress_path) and os.path.exists(self.output_csv) and os.path.getsize(self.output_csv):
+            kept_path = f'{output_csv}.{time.strftime("%Y%m%d-%H%M%S")}.bak'
+            os.replace(self.output_csv, kept_path)
+            print(f'{output_csv} has no progress sidecar and cannot be resumed, moved it to {kept_path}')
+
+        # Recover the completed patients and the CSV size after the last of them
+        valid_size = 0
+        if resume and os.path.exists(self.progress_path) and os.path.exists(self.output_csv):
+            with open(self.progress_path, 'r') as progress:
+                for line in progress:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 2 or not line.endswith('\n'):
+                        break  # Torn last line from a crash
+                    self.completed.add(fields[0])
+                    valid_size = int(fields[1])
+            if valid_size:
+                header = list(pd.read_csv(self.output_csv, nrows=0).columns)
+                if header != list(self.columns):
+                    raise ValueError(f'Cannot resume {output_csv}: its columns differ from those of this run (radiomics features or '
+                                     f'label registry changed); write to another CSV or disable resume')
 
-    # Specify the features we want from PyRadiomics
-    extractor.enableFeaturesByName(firstorder=['Mean', 'Median', 'RobustMeanAbsoluteDeviation'])
-    extractor.enableFeaturesByName(shape=['VoxelVolume'])
+        # Drop anything written after the last completed patient (or everything, when not resuming)
+        self.csv_file = open(self.output_csv, 'a+b')
+        self.csv_file.truncate(valid_size)
+        self.csv_file.seek(valid_size)
+        self.progress_file = open(self.progress_path, 'a' if self.completed else 'w')
+
+    def write_patient(self, patient_id: str, rows: list) -> None:
+        # Append the rows, with the header if the CSV is still empty
+        if rows:
+            df = pd.DataFrame(rows, columns=self.columns)
+            self.csv_file.write(df.to_csv(index=False, header=self.csv_file.tell() == 0, lineterminator='\n').encode('utf-8'))
+        self.csv_file.flush()
+        os.fsync(self.csv_file.fileno())
+
+        # Only mark the patient as completed once its rows are on disk
+        self.progress_file.write(f'{patient_id}\t{self.csv_file.tell()}\n')
+        self.progress_file.flush()
+        os.fsync(self.progress_file.fileno())
+        self.completed.add(patient_id)
+
+    def close(self) -> None:
+        self.csv_file.close()
+        self.progress_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def map_in_order(function: Callable, tasks: Iterable[tuple], num_workers: int = 1, max_in_flight: int = None) -> Iterator:
+    """
+    Applies `function` to every argument tuple in `tasks` and yields the results in the order of the tasks.
+    With more than one worker the tasks run in a process pool, and at most `max_in_flight` tasks are
+    submitted or waiting to be consumed at any time, which caps the memory held by finished results.
     
-    # Create an empty dictionary to store results for each segment
-    result_dict = {}
+    Parameters:
+    - function: callable, a module-level (picklable) function.
+    - tasks: iterable of tuple, the positional arguments of each call.
+    - num_workers: int, number of worker processes (1 runs everything in the current process).
+    - max_in_flight: int, bound on outstanding tasks (default 2 x num_workers).
+    
+    Returns:
+    - iterator over the results, in task order.
+    """
+    if num_workers is None or num_workers <= 1:
+        for task in tasks:
+            yield function(*task)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    max_in_flight = max(max_in_flight, 1)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(function, *task))
+
+            # Wait for the oldest task before submitting more work
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+@profiled_stage('extract_baseline_features_PyRads')
+def extract_baseline_features_PyRads(image_path, mask_path, feature_classes: dict = None, num_workers: int = 1):
+    """
+    Extracts baseline statistics (volume, mean intensity, median intensity, and robust mean absolute deviation),
+    and any further enabled PyRadiomics features, for each segment in the mask using PyRadiomics.
+
+    The image and mask are read once; each segment is cropped to its bounding box (plus the extractor's padDistance)
+    before extraction, and the segments are spread over `num_workers` processes with `map_in_order`, each with its own
+    cached extractor (PyRadiomics computes most features in Python, holding the GIL, so threads would not run them in
+    parallel). Only the crop of each segment is sent to a worker.
     
-    # Read the segmentation mask
-    mask_img = sitk.ReadImage(mask_path)
-    mask_arr = sitk.GetArrayFromImage(mask_img)
-    unique_segments = [int(x) for x in set(mask_arr.flatten()) if x != 0]  # Get unique non-zero segment IDs
+    Parameters:
+    - image_path: str, path to the input image (e.g., .nii.gz).
+    - mask_path: str, path to the segmentation mask file (e.g., .nii.gz), on the grid of the image.
+    - feature_classes: dict (optional), feature class -> list of feature names, or None for all the features of the
+      class (default RADIOMICS_FEATURE_CLASSES).
+    - num_workers: int, number of worker processes extracting segments (default 1, in this process).
     
-    # Loop through each segment and extract features
-    for segment_id in unique_segments:
-        segment_specific_mask = sitk.BinaryThreshold(mask_img, segment_id, segment_id, 1, 0)
-        # Execute feature extraction for the specific segment
-        result = extractor.execute(image_path, segment_specific_mask)
-        
-        # Gather the relevant statistics for this segment
-        features = {
-            'volume': result.get(f'original_shape_VoxelVolume', None),
-            'mean_density': result.get(f'original_firstorder_Mean', None),
-            'median_density': result.get(f'original_firstorder_Median', None),
-            'robust_mad': result.get(f'original_firstorder_RobustMeanAbsoluteDeviation', None)
-        }
-        
-        result_dict[segment_id] = features
+    Returns:
+    - result_dict: dict, containing statistics for each segment, with every PyRadiomics feature under its
+      `original_<class>_<feature>` name next to the baseline keys.
+    """
+    # Read the image and segmentation mask voxels once (memory-mapped for .npy intermediates)
+    with phase('read'):
+        image_arr, geometry = read_array(image_path)
+        mask_arr = read_array(mask_path)[0]
 
-    return result_dict
+    with phase('compute'):
+        # Bounding box of every segment, from the label index of the mask (or one pass over it)
+        index = LabelIndex.for_mask(mask_path, mask_arr)
+        pad = int(radiomics_extractor(feature_classes).settings.get('padDistance', 0))
+
+        segment_ids = index.labels.tolist()
+        boxes = [index.slices(segment_id, pad) for segment_id in segment_ids]
+        # The crops are only taken as the tasks are submitted, so at most the in-flight ones are held in memory
+        tasks = ((image_arr[box], mask_arr[box] == segment_id, geometry, [axis.start for axis in box], feature_classes)
+                 for segment_id, box in zip(segment_ids, boxes))
+        results = list(map_in_order(extract_segment_features_PyRads, tasks, num_workers))
+
+    return dict(zip(segment_ids, results))
+
+def extract_segment_features_PyRads(image_crop: np.ndarray, segment_crop: np.ndarray, geometry: dict, lower: list,
+                                    feature_classes: dict = None) -> dict:
+    """
+    Extracts the PyRadiomics features of one segment from the crop of its [z, y, x] bounding box.
+    
+    Parameters:
+    - image_crop: np.ndarray, the image voxels of the box.
+    - segment_crop: np.ndarray of bool, the voxels of the box in the segment.
+    - geometry: dict, the spacing, origin and direction of the whole image.
+    - lower: list of int, the [z, y, x] index of the box in the image.
+    - feature_classes: dict (optional), the enabled feature classes (see radiomics_extractor).
+    
+    Returns:
+    - features: dict, the baseline statistics and every `original_` feature of the segment.
+    """
+    # The crops become SimpleITK images at the physical position of the box
+    image_crop = geometry_image(image_crop, geometry, lower)
+    segment_specific_mask = geometry_image(segment_crop.astype(np.uint8), geometry, lower)
+
+    # Execute feature extraction for the specific segment
+    result = radiomics_extractor(feature_classes).execute(image_crop, segment_specific_mask)
+
+    # Gather the relevant statistics for this segment
+    features = {
+        'volume': result.get(f'original_shape_VoxelVolume', None),
+        'mean_density': result.get(f'original_firstorder_Mean', None),
+        'median_density': result.get(f'original_firstorder_Median', None),
+        'robust_mad': result.get(f'original_firstorder_RobustMeanAbsoluteDeviation', None)
+    }
+    features.update({name: float(value) for name, value in result.items() if name.startswith('original_')})
+    return features
+
+def radiomics_extractor(feature_classes: dict = None) -> 'featureextractor.RadiomicsFeatureExtractor':
+    """
+    Returns a PyRadiomics extractor with the given feature classes enabled, built once per process, thread and settings:
+    building one parses the default parameters and checks every feature class, which is wasted work per segment.
+    """
+    if feature_classes is None:
+        feature_classes = RADIOMICS_FEATURE_CLASSES
+    key = json.dumps(feature_classes, sort_keys=True)
+    extractors = _radiomics_extractors.__dict__.setdefault('extractors', {})
+    if key not in extractors:
+        # Initialize the PyRadiomics extractor, with only the requested features enabled
+        extractor = featureextractor.RadiomicsFeatureExtractor()
+        extractor.disableAllFeatures()
+        for feature_class, feature_names in feature_classes.items():
+            if feature_names:
+                extractor.enableFeaturesByName(**{feature_class: list(feature_names)})
+            else:
+                extractor.enableFeatureClassByName(feature_class)
+        extractors[key] = extractor
+    return extractors[key]
+
+def radiomics_columns(feature_classes: dict = None) -> list:
+    # The `original_<class>_<feature>` statistics CSV columns of the enabled PyRadiomics features
+    extractor = radiomics_extractor(feature_classes)
+    columns = []
+    for feature_class, feature_names in extractor.enabledFeatures.items():
+        if not feature_names:
+            feature_names = [name for name, deprecated in getFeatureClasses()[feature_class].getFeatureNames().items() if not deprecated]
+        columns.extend(f'original_{feature_class}_{name}' for name in feature_names)
+    return columns
+
+def parse_radiomics_features(specs: list) -> dict:
+    """
+    Parses feature class specifications of the form `class` (all features) or `class:Feature1,Feature2`.
+    
+    Returns:
+    - feature_classes: dict, feature class -> list of feature names, or None for all its features.
+    """
+    feature_classes = {}
+    for spec in specs:
+        feature_class, _, feature_names = spec.partition(':')
+        feature_classes[feature_class] = feature_names.split(',') if feature_names else None
+    return feature_classes
 
-def extract_baseline_features_InHouse(image_path, mask_path):
+@profiled_stage('extract_baseline_features_InHouse')
+def extract_baseline_features_InHouse(image_path, mask_path, max_memory_mb: float = None, save_histograms: bool = False):
     """
     Extracts baseline statistics (volume, surface area, mean intensity, median intensity, and standard deviation)
     for each segment in the mask by directly calculating the parameters without relying on external libraries.
@@ -119,58 +411,302 @@ def extract_baseline_features_InHouse(image_path, mask_path):
     Parameters:
     - image_path: str, path to the input image (e.g., .nii.gz).
     - mask_path: str, path to the segmentation mask file (e.g., .nii.gz).
+    - max_memory_mb: float (optional), memory ceiling in MiB: the statistics are then accumulated slab by slab with
+      `extract_baseline_features_slabs`.
+
+    - save_histograms: bool, also save the per-label HU histograms next to the mask (see Label_Histograms.py), from the
+      histograms the statistics are computed with (default False).
+
+    With a label index sidecar next to the mask, only the bounding box of its labels is scanned.
     
     Returns:
     - result_dict: dict, containing statistics for each segment.
     """
+    if max_memory_mb is not None:
+        return extract_baseline_features_slabs(image_path, mask_path, max_memory_mb, save_histograms)
+    
+    # Read the image and mask voxels (memory-mapped for .npy intermediates)
+    with phase('read'):
+        image_arr, geometry = read_array(image_path)
+        mask_arr = read_array(mask_path)[0]
+
+    accumulator = LabelStatisticsAccumulator() if save_histograms else None
+    with phase('compute'):
+        result_dict = extract_baseline_features_from_arrays(image_arr, mask_arr, geometry['spacing'], LabelIndex.load(mask_path),
+                                                            accumulator)
+
+    if accumulator is not None:
+        with phase('write'):
+            accumulator.histograms(float(np.prod(geometry['spacing']))).save(label_histograms_path(mask_path))
+    return result_dict
+
+def extract_baseline_features_slabs(image_path: str, mask_path: str, max_memory_mb: float = None, save_histograms: bool = False) -> dict:
+    """
+    Slab-wise counterpart of `extract_baseline_features_InHouse`: the image and mask are read in z-slabs sized to stay
+    under `max_memory_mb`, and the statistics (and histograms) are accumulated with a `LabelStatisticsAccumulator`.
+    """
+    readers = [SlabReader(image_path), SlabReader(mask_path)]
+    depth = slab_depth(readers, SLAB_BYTES_PER_VOXEL, max_memory_mb)
+
+    # Only the slabs within the z extent of the labels, when the mask has a label index
+    index = LabelIndex.load(mask_path)
+    z_box = index.union_slices()[0] if index is not None else slice(0, None)
+
+    dx, dy, dz = readers[0].GetSpacing()
+    accumulator = LabelStatisticsAccumulator()
+    with phase('compute'):
+        for _, (image_slab, mask_slab) in iter_slabs(readers, depth, z_box.start, z_box.stop):
+            accumulator.add(image_slab, mask_slab)
+        result_dict = accumulator.result(dx * dy * dz)
+
+    if save_histograms:
+        with phase('write'):
+            accumulator.histograms(dx * dy * dz).save(label_histograms_path(mask_path))
+    return result_dict
+
+def extract_baseline_features_from_images(image: sitk.Image, mask: sitk.Image, index: LabelIndex = None,
+                                          accumulator: 'LabelStatisticsAccumulator' = None) -> dict:
+    """
+    In-memory counterpart of `extract_baseline_features_InHouse`, for an image and mask that are already loaded.
     
-    # Read the image and mask
-    image = sitk.ReadImage(image_path)
-    mask = sitk.ReadImage(mask_path)
+    Parameters:
+    - image: sitk.Image, the input image.
+    - mask: sitk.Image, the segmentation mask, on the same grid as the image.
+    - index: LabelIndex (optional), the label index of the mask, to only scan the bounding box of its labels.
+    - accumulator: LabelStatisticsAccumulator (optional), reduce the voxels with this accumulator (e.g. to keep its
+      histograms) instead of compute_label_statistics.
     
-    # Get the numpy arrays
-    image_arr = sitk.GetArrayFromImage(image)  # Shape: [z, y, x]
-    mask_arr = sitk.GetArrayFromImage(mask)
+    Returns:
+    - result_dict: dict, containing statistics for each segment.
+    """
+    # Read-only views of the voxels, without copying them: Shape: [z, y, x]
+    return extract_baseline_features_from_arrays(sitk.GetArrayViewFromImage(image), sitk.GetArrayViewFromImage(mask),
+                                                 image.GetSpacing(), index, accumulator)
+
+def extract_baseline_features_from_arrays(image_arr: np.ndarray, mask_arr: np.ndarray, spacing: tuple, index: LabelIndex = None,
+                                          accumulator: 'LabelStatisticsAccumulator' = None) -> dict:
+    """
+    Array counterpart of `extract_baseline_features_from_images`, for (z, y, x) voxels, e.g. memory-mapped by
+    `read_array`, and the (dx, dy, dz) spacing of the image.
+    """
+    if index is not None:
+        box = index.union_slices()
+        image_arr, mask_arr = image_arr[box], mask_arr[box]
     
-    # Get image spacing to calculate physical dimensions
-    spacing = image.GetSpacing()  # (dx, dy, dz)
+    # Image spacing to calculate physical dimensions: (dx, dy, dz)
     dx, dy, dz = spacing
     voxel_volume = dx * dy * dz  # Volume of one voxel
     
-    # Get unique segment IDs excluding background (assuming background is 0)
-    unique_segments = np.unique(mask_arr)
-    unique_segments = unique_segments[unique_segments != 0]
+    # Compute the statistics of every segment in a single pass over the volume
+    if accumulator is not None:
+        accumulator.add(image_arr, mask_arr)
+        return accumulator.result(voxel_volume)
+    return compute_label_statistics(image_arr, mask_arr, voxel_volume)
+
+def compute_label_statistics(image_arr: np.ndarray, mask_arr: np.ndarray, voxel_volume: float = 1.0,
+                             max_histogram_bins: int = 2 ** 24) -> dict:
+    """
+    Computes the voxel count, volume, mean, median, standard deviation, minimum and maximum intensity
+    of every labelled segment at once. Instead of building one full-volume boolean mask per segment,
+    the foreground voxels are gathered once and reduced per label with np.bincount, so the cost stays
+    roughly constant as the number of labels grows.
+
+    Medians come from a per-label histogram when the image holds integer values (e.g. CT in HU) and
+    the histogram fits in `max_histogram_bins`, otherwise from a single sort of the voxels by label.
+    
+    Parameters:
+    - image_arr: np.ndarray, the intensity volume.
+    - mask_arr: np.ndarray, the label volume, same shape as image_arr (0 is background).
+    - voxel_volume: float, the physical volume of one voxel (e.g., mm^3).
+    - max_histogram_bins: int, upper bound on (number of labels x intensity range) for the histogram median.
     
+    Returns:
+    - result_dict: dict, containing statistics for each segment, keyed by segment ID.
+    """
+    if image_arr.shape != mask_arr.shape:
+        raise ValueError(f'Image shape {image_arr.shape} does not match mask shape {mask_arr.shape}')
+
+    # Gather the foreground voxels once; every reduction below only touches these
+    labels_flat = mask_arr.ravel()
+    foreground = labels_flat != 0
+    segment_labels = labels_flat[foreground]
+    segment_values = image_arr.ravel()[foreground]
+
+    if segment_labels.size == 0:
+        return {}
+
+    # Map the labels to dense, non-negative bins (label values directly, unless they cannot index an array)
+    if np.issubdtype(segment_labels.dtype, np.integer) and segment_labels.min() >= 0:
+        label_bins = segment_labels.astype(np.intp)
+        counts = np.bincount(label_bins)
+        segment_ids = np.flatnonzero(counts).astype(mask_arr.dtype)
+        counts = counts[segment_ids.astype(np.intp)]
+        bin_ids = segment_ids.astype(np.intp)
+    else:
+        segment_ids, label_bins = np.unique(segment_labels, return_inverse=True)
+        counts = np.bincount(label_bins)
+        bin_ids = np.arange(segment_ids.size)
+    n_bins = int(label_bins.max()) + 1
+
+    # Integer intensities with a small range can be reduced exactly with a per-label histogram
+    use_histogram = False
+    if np.issubdtype(segment_values.dtype, np.integer):
+        min_value = int(segment_values.min())
+        max_value = int(segment_values.max())
+        n_values = max_value - min_value + 1
+        use_histogram = n_bins * n_values <= max_histogram_bins
+
+    if use_histogram:
+        keys = label_bins * n_values + (segment_values.astype(np.intp) - min_value)
+        histogram = np.bincount(keys, minlength=n_bins * n_values).reshape(n_bins, n_values)[bin_ids]
+        sums, sums_sq, min_density, median_lo, median_hi, max_density = histogram_statistics(histogram, counts, min_value)
+    else:
+        values_64 = segment_values.astype(np.float64)
+        sums = np.bincount(label_bins, weights=values_64)[bin_ids]
+        sums_sq = np.bincount(label_bins, weights=values_64 * values_64)[bin_ids]
+
+        # Sort by label, then by intensity within each label, and read the order statistics off the segments
+        order = np.lexsort((segment_values, label_bins))
+        sorted_values = values_64[order]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        min_density = sorted_values[starts]
+        max_density = sorted_values[starts + counts - 1]
+        median_lo = sorted_values[starts + (counts - 1) // 2]
+        median_hi = sorted_values[starts + counts // 2]
+
+    return statistics_to_dict(segment_ids, counts, sums, sums_sq, min_density, median_lo, median_hi, max_density, voxel_volume)
+
+def histogram_statistics(histogram: np.ndarray, counts: np.ndarray, min_value: int = 0) -> tuple:
+    # Sums, sums of squares, and minimum, two middle and maximum values of every row of a per-label intensity histogram
+    # whose first column counts the intensity min_value
+    values = np.arange(min_value, min_value + histogram.shape[1], dtype=np.float64)
+
+    sums = histogram @ values
+    sums_sq = histogram @ (values * values)
+
+    # Rank of the first/last voxel and of the two middle voxels of each segment
+    cumulative = np.cumsum(histogram, axis=1)
+    ranks = np.stack([np.zeros_like(counts), (counts - 1) // 2, counts // 2, counts - 1], axis=1)
+    positions = np.stack([(cumulative <= rank[:, None]).sum(axis=1) for rank in ranks.T], axis=1)
+    min_density, median_lo, median_hi, max_density = values[positions].T
+    return sums, sums_sq, min_density, median_lo, median_hi, max_density
+
+def statistics_to_dict(segment_ids: np.ndarray, counts: np.ndarray, sums: np.ndarray, sums_sq: np.ndarray, min_density: np.ndarray,
+                       median_lo: np.ndarray, median_hi: np.ndarray, max_density: np.ndarray, voxel_volume: float = 1.0) -> dict:
+    # Per-segment features from the per-segment reductions
+    mean_density = sums / counts
+    median_density = (median_lo + median_hi) / 2
+    std_dev = np.sqrt(np.maximum(sums_sq / counts - mean_density * mean_density, 0))
+
     result_dict = {}
     
-    for segment_id in unique_segments:
-        # Create a binary mask for the segment
-        segment_mask = (mask_arr == segment_id)
-        
-        # Calculate volume
-        num_voxels = np.sum(segment_mask)
-        volume = num_voxels * voxel_volume  # in physical units (e.g., mm^3)
-        
-        # Extract intensities within the segment
-        segment_intensities = image_arr[segment_mask]
-        
-        # Compute mean, median, and standard deviation
-        mean_density = np.mean(segment_intensities)
-        median_density = np.median(segment_intensities)
-        std_dev = np.std(segment_intensities)
-        
+    for i, segment_id in enumerate(segment_ids):
         # Store the calculated features in the result dictionary
         features = {
-            'volume': volume,
-            'mean_density': mean_density,
-            'median_density': median_density,
-            'std_dev': std_dev
+            'volume': counts[i] * voxel_volume,
+            'mean_density': mean_density[i],
+            'median_density': median_density[i],
+            'std_dev': std_dev[i],
+            'min_density': min_density[i],
+            'max_density': max_density[i]
         }
         
         result_dict[segment_id] = features
     
     return result_dict
 
+class LabelStatisticsAccumulator(object):
+    """
+    Accumulates the statistics of `compute_label_statistics` over the slabs of an image and its mask, so a volume can
+    be reduced without holding it in memory.
+
+    For integer intensities and non-negative integer labels, every slab is added to a per-label intensity histogram
+    that grows to the labels and intensity range seen so far, which gives exact medians. Otherwise (or once the
+    histogram would exceed `max_histogram_bins`) the foreground labels and intensities are kept, in their own dtypes,
+    and reduced once by compute_label_statistics at the end.
+    """
+    def __init__(self, max_histogram_bins: int = 2 ** 24) -> None:
+        self.max_histogram_bins = max_histogram_bins
+        self.histogram = None
+        self.min_value = 0
+        self.label_dtype = None
+        self.foreground = None
+
+    def add(self, image_arr: np.ndarray, mask_arr: np.ndarray) -> None:
+        if image_arr.shape != mask_arr.shape:
+            raise ValueError(f'Image shape {image_arr.shape} does not match mask shape {mask_arr.shape}')
+
+        labels_flat = mask_arr.ravel()
+        foreground = labels_flat != 0
+        segment_labels = labels_flat[foreground]
+        segment_values = image_arr.ravel()[foreground]
+        self.label_dtype = mask_arr.dtype
+        if segment_labels.size == 0:
+            return
+
+        if self.foreground is None and np.issubdtype(segment_labels.dtype, np.integer) and segment_labels.min() >= 0 \
+                and np.issubdtype(segment_values.dtype, np.integer):
+            if self.grow_histogram(int(segment_labels.max()) + 1, int(segment_values.min()), int(segment_values.max())):
+                n_bins, n_values = self.histogram.shape
+                keys = segment_labels.astype(np.intp) * n_values + (segment_values.astype(np.intp) - self.min_value)
+                self.histogram += np.bincount(keys, minlength=n_bins * n_values).reshape(n_bins, n_values)
+                return
+
+        if self.foreground is None:
+            self.foreground = []
+        self.foreground.append((segment_labels, segment_values))
+
+    def grow_histogram(self, n_bins: int = None, min_value: int = None, max_value: int = None) -> bool:
+        # Pads the histogram to cover the labels and intensities of a slab; when it would grow too large, its content
+        # is moved to the foreground list instead and False is returned
+        if self.histogram is not None:
+            n_bins = max(n_bins, self.histogram.shape[0])
+            max_value = max(max_value, self.min_value + self.histogram.shape[1] - 1)
+            min_value = min(min_value, self.min_value)
+        n_values = max_value - min_value + 1
+
+        if n_bins * n_values > self.max_histogram_bins:
+            self.foreground = []
+            if self.histogram is not None:
+                rows, columns = np.nonzero(self.histogram)
+                repeats = self.histogram[rows, columns]
+                self.foreground.append((np.repeat(rows, repeats).astype(self.label_dtype),
+                                        np.repeat(columns + self.min_value, repeats)))
+                self.histogram = None
+            return False
+
+        histogram = np.zeros((n_bins, n_values), dtype=np.int64)
+        if self.histogram is not None:
+            offset = self.min_value - min_value
+            histogram[:self.histogram.shape[0], offset:offset + self.histogram.shape[1]] = self.histogram
+        self.histogram, self.min_value = histogram, min_value
+        return True
+
+    def result(self, voxel_volume: float = 1.0) -> dict:
+        # The statistics of every segment, as returned by compute_label_statistics
+        if self.foreground is not None:
+            labels = np.concatenate([labels for labels, _ in self.foreground])
+            values = np.concatenate([values for _, values in self.foreground])
+            return compute_label_statistics(values, labels, voxel_volume, self.max_histogram_bins)
+        if self.histogram is None:
+            return {}
+
+        counts = self.histogram.sum(axis=1)
+        bin_ids = np.flatnonzero(counts)
+        histogram = self.histogram[bin_ids]
+        counts = counts[bin_ids]
+        return statistics_to_dict(bin_ids.astype(self.label_dtype), counts, *histogram_statistics(histogram, counts, self.min_value),
+                                  voxel_volume=voxel_volume)
+
+    def histograms(self, voxel_volume: float = 1.0) -> LabelHistograms:
+        # The per-label intensity histograms of everything added so far
+        if self.histogram is not None:
+            return LabelHistograms.from_dense(np.arange(self.histogram.shape[0]), self.histogram, self.min_value, voxel_volume)
+        if self.foreground:
+            return LabelHistograms.from_values(np.concatenate([labels for labels, _ in self.foreground]),
+                                               np.concatenate([values for _, values in self.foreground]), voxel_volume)
+        return LabelHistograms.from_values([], [], voxel_volume)
+
 if __name__ == "__main__":
     mask_folder = r"C:\Users\joshua.onichino\Dropbox\Head\Batch 5 - Aggregates - FILTERED - Copy"
     image_folder = r"C:\Users\joshua.onichino\Dropbox\Head\Batch 5 - nnUNet - TOTAL"
@@ -0,0 +1,334 @@
+import argparse
+import json
+import os
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import SimpleITK as sitk
+
+from Profiling import record_io
+
+# Multi-part file endings that ITK recognizes, longest first, and the memory-mappable intermediate format
+NPY_ENDING = '.npy'
+IMAGE_FILE_ENDINGS = ('.nii.gz', '.nii', '.nrrd', '.nhdr', '.mha', '.mhd', NPY_ENDING)
+
+# Compression settings of every write of the pipeline, set once by `configure_compression`. They are environment
+# variables, so that the worker processes started by the stages inherit them
+COMPRESSION_LEVEL_VARIABLE = 'PIPELINE_COMPRESSION_LEVEL'
+COMPRESSION_THREADS_VARIABLE = 'PIPELINE_COMPRESSION_THREADS'
+
+# Input bytes per gzip member when .nii.gz files are compressed by `gzip_file`
+GZIP_CHUNK_SIZE = 8 * 2 ** 20
+
+# ITK holds the decoded file buffer next to the image while reading, so a read peaks at about twice the image size
+READ_BUFFER_FACTOR = 2
+
+# Numpy dtypes of the scalar SimpleITK pixel types
+PIXEL_DTYPES = {
+    sitk.sitkUInt8: np.uint8, sitk.sitkInt8: np.int8, sitk.sitkUInt16: np.uint16, sitk.sitkInt16: np.int16,
+    sitk.sitkUInt32: np.uint32, sitk.sitkInt32: np.int32, sitk.sitkUInt64: np.uint64, sitk.sitkInt64: np.int64,
+    sitk.sitkFloat32: np.float32, sitk.sitkFloat64: np.float64,
+}
+
+def is_image_file(filename: str) -> bool:
+    # Image files only, skipping hidden files such as stage manifests and in-progress temporary writes
+    return not filename.startswith('.') and filename.endswith(IMAGE_FILE_ENDINGS)
+
+def split_image_ending(path: str) -> tuple:
+    # ('/a/b/case.nii.gz') -> ('/a/b/case', '.nii.gz')
+    for ending in IMAGE_FILE_ENDINGS:
+        if path.endswith(ending):
+            return path[:-len(ending)], ending
+    return os.path.splitext(path)
+
+def geometry_path(npy_path: str) -> str:
+    # The JSON sidecar that holds the geometry of an .npy image: /a/b/case.npy -> /a/b/case.json
+    return f'{split_image_ending(npy_path)[0]}.json'
+
+def read_geometry(npy_path: str) -> dict:
+    with open(geometry_path(npy_path), 'r') as handle:
+        return json.load(handle)
+
+def set_geometry(image: sitk.Image, geometry: dict) -> sitk.Image:
+    image.SetSpacing(geometry['spacing'])
+    image.SetOrigin(geometry['origin'])
+    image.SetDirection(geometry['direction'])
+    return image
+
+def image_geometry(image: sitk.Image) -> dict:
+    return {'spacing': image.GetSpacing(), 'origin': image.GetOrigin(), 'direction': image.GetDirection()}
+
+def geometry_image(array: np.ndarray, geometry: dict, lower: list = None) -> sitk.Image:
+    """
+    An sitk.Image of a (z, y, x) array with the given geometry. The voxels are copied, so with `lower`, the [z, y, x]
+    index of the array within the image of that geometry, only a crop of a large (e.g. memory-mapped) array is.
+    """
+    image = set_geometry(sitk.GetImageFromArray(array), geometry)
+    if lower is not None:
+        # The crop starts at the physical point of its first voxel
+        offset = np.asarray(lower[::-1], dtype=float) * np.asarray(geometry['spacing'])
+        image.SetOrigin(tuple(np.asarray(geometry['origin']) + np.asarray(geometry['direction']).reshape(3, 3) @ offset))
+    return image
+
+class ImageBuffer(object):
+    """
+    Hands the voxels of an sitk.Image to numpy without copying them: the array made from it keeps the image alive.
+    """
+    def __init__(self, image: sitk.Image = None) -> None:
+        self.image = image
+        self.__array_interface__ = sitk.GetArrayViewFromImage(image).__array_interface__
+
+def read_array(input_path: str) -> tuple:
+    """
+    Reads the voxels of an image as a read-only (z, y, x) array, with its geometry (spacing, origin and direction).
+
+    An .npy image is memory-mapped, so nothing is copied or decoded, and only the voxels that are used are paged in;
+    any other image is read with ITK and its buffer is returned as is.
+
+    Returns:
+    - array: np.ndarray, the voxels.
+    - geometry: dict, the spacing, origin and direction of the image.
+    """
+    if input_path.endswith(NPY_ENDING):
+        array, geometry = np.load(input_path, mmap_mode='r'), read_geometry(input_path)
+    else:
+        image = sitk.ReadImage(input_path)
+        array, geometry = np.asarray(ImageBuffer(image)), image_geometry(image)
+        array.flags.writeable = False
+    record_io('read', os.path.getsize(input_path))
+    return array, geometry
+
+def read_image(input_path: str) -> sitk.Image:
+    # sitk.ReadImage, counting the bytes read for the profiler; .npy images are copied into the image (with no
+    # decoding), so consumers of the voxels alone use `read_array`, which keeps them memory-mapped
+    if input_path.endswith(NPY_ENDING):
+        image = set_geometry(sitk.GetImageFromArray(np.load(input_path, mmap_mode='r')), read_geometry(input_path))
+    else:
+        image = sitk.ReadImage(input_path)
+    record_io('read', os.path.getsize(input_path))
+    return image
+
+def configure_compression(level: int = None, threads: int = None) -> None:
+    """
+    Sets the compression of every image written by this process and the worker processes it starts.
+
+    Parameters:
+    - level: int (optional), compression level from 1 (fastest) to 9 (smallest); None keeps the writers' default.
+    - threads: int (optional), threads that compress each .nii.gz output; None or 1 compresses on the writing thread.
+    """
+    for variable, value in ((COMPRESSION_LEVEL_VARIABLE, level), (COMPRESSION_THREADS_VARIABLE, threads)):
+        if value is None:
+            os.environ.pop(variable, None)
+        else:
+            os.environ[variable] = str(int(value))
+
+def compression_settings() -> tuple:
+    # (level or None, threads) of the current configuration
+    level = os.environ.get(COMPRESSION_LEVEL_VARIABLE)
+    return (int(level) if level else None), int(os.environ.get(COMPRESSION_THREADS_VARIABLE) or 1)
+
+def write_image(image: sitk.Image, output_path: str, use_compression: bool = True, compression_level: int = None) -> None:
+    """
+    Writes an image atomically: the image is written to a hidden temporary file next to output_path, which is then
+    renamed over it. A crash mid-write therefore never leaves a truncated file under the final name.
+
+    An .npy output is the fast intermediate format: the uncompressed (z, y, x) voxels, which later stages can
+    memory-map instead of decompressing, with the spacing, origin and direction in a .json sidecar of the same name
+    (renamed into place first, so a finished .npy always has its geometry).
+
+    The compression level and threads come from `configure_compression` unless compression_level is given. ITK's
+    NIfTI writer ignores the level, so when a level or several threads are configured, a .nii.gz is written
+    uncompressed and compressed by `gzip_file`; NRRD and MetaImage writers take the level directly.
+
+    Parameters:
+    - image: sitk.Image, the image to write.
+    - output_path: str, the final path; its file ending selects the format.
+    - use_compression: bool, compress the output (default True; .npy is never compressed, .nii.gz always is).
+    - compression_level: int (optional), overrides the configured compression level for this write.
+    """
+    directory, filename = os.path.split(os.path.abspath(output_path))
+    stem, ending = split_image_ending(filename)
+    temporary_path = os.path.join(directory, f'.{stem}.tmp-{os.getpid()}-{threading.get_ident()}{ending}')
+    temporary_geometry_path = f'{split_image_ending(temporary_path)[0]}.json'
+    temporary_nifti_path = f'{split_image_ending(temporary_path)[0]}.nii'
+
+    level, threads = compression_settings()
+    if compression_level is not None:
+        level = compression_level
+
+    try:
+        if ending == NPY_ENDING:
+            np.save(temporary_path, sitk.GetArrayViewFromImage(image))
+            with open(temporary_geometry_path, 'w') as handle:
+                json.dump(image_geometry(image), handle)
+            os.replace(temporary_geometry_path, geometry_path(output_path))
+        elif ending == '.nii.gz' and (level is not None or threads > 1):
+            sitk.WriteImage(image, temporary_nifti_path)
+            gzip_file(temporary_nifti_path, temporary_path, level if level is not None else zlib.Z_DEFAULT_COMPRESSION, threads)
+        else:
+            sitk.WriteImage(image, temporary_path, useCompression=use_compression, compressionLevel=level if level is not None else -1)
+        os.replace(temporary_path, output_path)
+        record_io('written', os.path.getsize(output_path))
+    finally:
+        for path in (temporary_path, temporary_geometry_path, temporary_nifti_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+def gzip_file(input_path: str, output_path: str, level: int = zlib.Z_DEFAULT_COMPRESSION, threads: int = 1,
+              chunk_size: int = GZIP_CHUNK_SIZE) -> None:
+    """
+    Compresses a file to gzip as concatenated members of chunk_size input bytes, compressed by `threads` threads at
+    once (zlib releases the GIL), like pigz. gzip readers, ITK's included, read the members back as one stream.
+    At most 2 x threads chunks are held in memory.
+    """
+    with open(input_path, 'rb') as source, open(output_path, 'wb') as target, ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        pending = deque()
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            pending.append(pool.submit(gzip_member, chunk, level))
+            if len(pending) >= 2 * threads:
+                target.write(pending.popleft().result())
+        while pending:
+            target.write(pending.popleft().result())
+
+def gzip_member(data: bytes, level: int = zlib.Z_DEFAULT_COMPRESSION) -> bytes:
+    # One complete gzip member (header, deflate stream and trailer)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def convert_image(input_path: str, output_path: str) -> None:
+    # Converts between formats, e.g. an .npy intermediate to NIfTI for export
+    write_image(read_image(input_path), output_path, use_compression=True)
+
+class SlabReader(object):
+    """
+    Reads a 3D image in slabs of z-slices, as read-only (z, y, x) arrays.
+
+    Only the header is read up front. An .npy image is memory-mapped, so every slab is a view of the file and nothing
+    is decoded. Otherwise, unless `stream` is set, the whole image is read on the first slab and every slab is a view
+    into it; with `stream`, each slab is read on its own with ITK's streaming extraction, so only one slab is held in
+    memory. Streaming a compressed file (.nii.gz, compressed NRRD) decompresses it up to the end of each slab, so it
+    costs about (number of slabs / 2) full reads: it trades time for memory.
+
+    The reader has the GetSize/GetSpacing/GetOrigin/GetDirection of the image, so it can stand in for it in grid
+    comparisons, and `copy_information` sets that geometry on an output image.
+    """
+    def __init__(self, path: str = None, stream: bool = False) -> None:
+        self.path = path
+        self.stream = stream
+        self.image = None
+
+        if path.endswith(NPY_ENDING):
+            self.array = np.load(path, mmap_mode='r')
+            if self.array.ndim != 3:
+                raise ValueError(f'{path}: slab reads need a scalar 3D image')
+            geometry = read_geometry(path)
+            self.size = self.array.shape[::-1]
+            self.spacing, self.origin, self.direction = (tuple(geometry[key]) for key in ('spacing', 'origin', 'direction'))
+            self.dtype = self.array.dtype
+        else:
+            self.array = None
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(path)
+            reader.ReadImageInformation()
+            if reader.GetDimension() != 3 or reader.GetNumberOfComponents() != 1:
+                raise ValueError(f'{path}: slab reads need a scalar 3D image')
+            self.reader = reader
+            self.size, self.spacing, self.origin, self.direction = reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection()
+            self.dtype = np.dtype(PIXEL_DTYPES[reader.GetPixelID()])
+        record_io('read', os.path.getsize(path))
+
+    def GetSize(self) -> tuple:
+        return self.size
+
+    def GetSpacing(self) -> tuple:
+        return self.spacing
+
+    def GetOrigin(self) -> tuple:
+        return self.origin
+
+    def GetDirection(self) -> tuple:
+        return self.direction
+
+    def nbytes(self) -> int:
+        return int(np.prod(self.size)) * self.dtype.itemsize
+
+    def whole_read_bytes(self) -> int:
+        # Memory taken by reading the whole image at once (none for a memory map, whose pages are the file cache)
+        return 0 if self.array is not None else READ_BUFFER_FACTOR * self.nbytes()
+
+    def read(self, z_start: int = 0, depth: int = 1) -> np.ndarray:
+        # Slices z_start to z_start + depth, in numpy (z, y, x) order
+        size_x, size_y, size_z = self.size
+        depth = min(depth, size_z - z_start)
+        if self.array is not None:
+            return self.array[z_start:z_start + depth]
+        if not self.stream:
+            if self.image is None:
+                self.image = sitk.ReadImage(self.path)
+            return sitk.GetArrayViewFromImage(self.image)[z_start:z_start + depth]
+
+        self.reader.SetExtractIndex((0, 0, z_start))
+        self.reader.SetExtractSize((size_x, size_y, depth))
+        return sitk.GetArrayFromImage(self.reader.Execute())
+
+    def copy_information(self, image: sitk.Image = None) -> sitk.Image:
+        return set_geometry(image, {'spacing': self.spacing, 'origin': self.origin, 'direction': self.direction})
+
+def slab_depth(readers: list = None, bytes_per_voxel: int = 0, max_memory_mb: float = None, output_bytes_per_voxel: int = 0) -> int:
+    """
+    Picks the slab depth that keeps a slab-wise computation over the images of `readers` under a memory ceiling.
+
+    The whole inputs are read at once when they fit under the ceiling together with the output and at least one
+    slice of temporaries; otherwise the readers are switched to streaming, slab by slab. The ceiling covers the
+    images and temporaries of the computation, not the baseline memory of the process itself.
+
+    Parameters:
+    - readers: list of SlabReader, the inputs, all with the same size.
+    - bytes_per_voxel: int, the peak temporaries of the computation per voxel of a slab.
+    - max_memory_mb: float, the memory ceiling, in MiB.
+    - output_bytes_per_voxel: int, bytes per voxel of a full-size output assembled from the slabs (0 if none).
+
+    Returns:
+    - depth: int, the number of slices per slab.
+    """
+    size_x, size_y, size_z = readers[0].GetSize()
+    slice_voxels = size_x * size_y
+    budget = max_memory_mb * 2 ** 20 - output_bytes_per_voxel * slice_voxels * size_z
+
+    whole_bytes = sum(reader.whole_read_bytes() for reader in readers)
+    depth = int((budget - whole_bytes) // (bytes_per_voxel * slice_voxels))
+    if depth < 1:
+        # Stream the inputs: a slab then also holds the slices it reads
+        for reader in readers:
+            reader.stream = True
+        per_slice = (bytes_per_voxel + READ_BUFFER_FACTOR * sum(reader.dtype.itemsize for reader in readers)) * slice_voxels
+        depth = int(budget // per_slice)
+    return min(max(depth, 1), size_z)
+
+def iter_slabs(readers: list = None, depth: int = 1, z_start: int = 0, z_stop: int = None):
+    # Yields (z_start, [slab of every reader]) over the z extent [z_start, z_stop) (default: the whole volume)
+    size_z = readers[0].GetSize()[2] if z_stop is None else min(z_stop, readers[0].GetSize()[2])
+    for slab_start in range(z_start, size_z, depth):
+        yield slab_start, [reader.read(slab_start, min(depth, size_z - slab_start)) for reader in readers]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert images between formats, e.g. .npy intermediates to NIfTI for export.')
+    parser.add_argument('input_path')
+    parser.add_argument('output_path', help='output file, or folder when input_path is a folder')
+    parser.add_argument('--ending', default='.nii.gz', help='file ending of the outputs when converting a folder')
+    parser.add_argument('--compression-level', type=int, help='compression level, 1 (fastest) to 9 (smallest)')
+    parser.add_argument('--compression-threads', type=int, help='threads that compress each .nii.gz output')
+    args = parser.parse_args()
+
+    configure_compression(args.compression_level, args.compression_threads)
+
+    if os.path.isdir(args.input_path):
+        os.makedirs(args.output_path, exist_ok=True)
+        for filename in sorted(os.listdir(args.input_path)):
+            if is_image_file(filename):
+                convert_image(os.path.join(args.input_path, filename),
+                              os.path.join(args.output_path, split_image_ending(filename)[0] + args.ending))
+    else:
+        convert_image(args.input_path, args.output_path)
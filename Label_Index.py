@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+from Image_IO import read_array, split_image_ending
+from Label_Maps import label_bounding_boxes
+from Stage_Cache import file_stat
+
+# File ending of the label index sidecar of a mask: P001.nii.gz -> P001.labels.json
+LABEL_INDEX_ENDING = '.labels.json'
+
+class LabelIndex(object):
+    """
+    Voxel count and bounding box of every label of a mask, like scipy.ndimage.find_objects.
+
+    The aggregation and filtering stages save the index of every mask they write as a small JSON sidecar next to it,
+    so later stages and ad-hoc analyses touch only the sub-volume of each label (or the bounding box of all of them)
+    instead of scanning the whole volume. The sidecar records the size and modification time of its mask, and is
+    ignored once the mask changes. Boxes are [z, y, x] array indexes, lower inclusive and upper exclusive.
+    """
+    def __init__(self, shape: tuple = None, labels: np.ndarray = None, counts: np.ndarray = None, lower: np.ndarray = None,
+                 upper: np.ndarray = None) -> None:
+        self.shape = tuple(int(size) for size in shape)
+        self.labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        self.counts = np.asarray(counts, dtype=np.int64).reshape(-1)
+        self.lower = np.asarray(lower, dtype=np.int64).reshape(-1, 3)
+        self.upper = np.asarray(upper, dtype=np.int64).reshape(-1, 3)
+        self.rows = {label: row for row, label in enumerate(self.labels.tolist())}
+
+    @classmethod
+    def from_array(cls, label_arr: np.ndarray = None, chunk_voxels: int = 2 ** 22) -> 'LabelIndex':
+        # Index of a label map, in one pass over it (chunk_voxels bounds the temporaries, see label_bounding_boxes)
+        return cls(label_arr.shape, *label_bounding_boxes(label_arr, chunk_voxels))
+
+    @classmethod
+    def load(cls, mask_path: str = None) -> 'LabelIndex':
+        # The saved index of a mask, or None when there is none or the mask changed since it was saved
+        index_path = label_index_path(mask_path)
+        if not os.path.exists(index_path) or not os.path.exists(mask_path):
+            return None
+        try:
+            with open(index_path, 'r') as handle:
+                content = json.load(handle)
+        except ValueError:
+            return None
+        if content.get('mask_stat') != file_stat(mask_path):
+            return None
+
+        entries = content['labels']
+        return cls(content['shape'], [entry['label'] for entry in entries], [entry['voxels'] for entry in entries],
+                   [entry['lower'] for entry in entries], [entry['upper'] for entry in entries])
+
+    @classmethod
+    def for_mask(cls, mask_path: str = None, mask_arr: np.ndarray = None) -> 'LabelIndex':
+        # The saved index of a mask if it is current, else the index of mask_arr (read from mask_path if not given)
+        index = cls.load(mask_path)
+        if index is not None:
+            return index
+        if mask_arr is None:
+            mask_arr = read_array(mask_path)[0]
+        return cls.from_array(mask_arr)
+
+    def save(self, mask_path: str = None) -> None:
+        """
+        Writes the index as the sidecar of mask_path (written atomically, after the mask).
+        """
+        content = {'mask_stat': file_stat(mask_path), 'shape': list(self.shape),
+                   'labels': [{'label': label, 'voxels': voxels, 'lower': lower, 'upper': upper}
+                              for label, voxels, lower, upper in zip(self.labels.tolist(), self.counts.tolist(),
+                                                                     self.lower.tolist(), self.upper.tolist())]}
+        index_path = label_index_path(mask_path)
+        directory, filename = os.path.split(os.path.abspath(index_path))
+        temporary_path = os.path.join(directory, f'.{filename}.tmp-{os.getpid()}-{threading.get_ident()}')
+        try:
+            with open(temporary_path, 'w') as handle:
+                json.dump(content, handle)
+            os.replace(temporary_path, index_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def __len__(self) -> int:
+        return self.labels.size
+
+    def __contains__(self, label: int) -> bool:
+        return int(label) in self.rows
+
+    def voxels(self, label: int = None) -> int:
+        return int(self.counts[self.rows[int(label)]]) if int(label) in self.rows else 0
+
+    def slices(self, label: int = None, pad: int = 0) -> tuple:
+        # [z, y, x] slices of the bounding box of a label, grown by pad voxels and clipped to the volume
+        row = self.rows[int(label)]
+        return self.box_slices(self.lower[row], self.upper[row], pad)
+
+    def union_slices(self, pad: int = 0) -> tuple:
+        # [z, y, x] slices of the bounding box of all the labels (an empty box when there are none)
+        if not len(self):
+            return (slice(0, 0),) * 3
+        return self.box_slices(self.lower.min(axis=0), self.upper.max(axis=0), pad)
+
+    def box_slices(self, lower: np.ndarray = None, upper: np.ndarray = None, pad: int = 0) -> tuple:
+        return tuple(slice(max(int(low) - pad, 0), min(int(high) + pad, size)) for low, high, size in zip(lower, upper, self.shape))
+
+    def crop(self, arr: np.ndarray = None, label: int = None, pad: int = 0) -> np.ndarray:
+        """
+        Returns the sub-volume (a view) of arr, e.g. the mask or its image, within the bounding box of a label.
+        """
+        return arr[self.slices(label, pad)]
+
+    def relabel(self, mapping: dict = None) -> 'LabelIndex':
+        """
+        Returns the index of the mask relabelled with `mapping` (old label -> new label, 0 drops it), e.g. by filtering,
+        without a pass over the mask: labels that merge add their voxels and join their bounding boxes.
+        """
+        new_labels = np.array([int(mapping.get(label, label)) for label in self.labels.tolist()], dtype=np.int64)
+        kept = new_labels != 0
+        labels, inverse = np.unique(new_labels[kept], return_inverse=True)
+        counts = np.zeros(labels.size, dtype=np.int64)
+        lower = np.full((labels.size, 3), np.iinfo(np.int64).max, dtype=np.int64)
+        upper = np.zeros((labels.size, 3), dtype=np.int64)
+        np.add.at(counts, inverse, self.counts[kept])
+        np.minimum.at(lower, inverse, self.lower[kept])
+        np.maximum.at(upper, inverse, self.upper[kept])
+        return LabelIndex(self.shape, labels, counts, lower, upper)
+
+    def to_dict(self) -> dict:
+        # label -> {'voxels', 'lower', 'upper'}, for ad-hoc use
+        return {label: {'voxels': voxels, 'lower': lower, 'upper': upper}
+                for label, voxels, lower, upper in zip(self.labels.tolist(), self.counts.tolist(), self.lower.tolist(), self.upper.tolist())}
+
+def label_index_path(mask_path: str = None) -> str:
+    return split_image_ending(mask_path)[0] + LABEL_INDEX_ENDING
+
+def index_mask(mask_path: str = None) -> LabelIndex:
+    # Builds and saves the index of a mask that has none (e.g. written before indexes existed)
+    index = LabelIndex.for_mask(mask_path)
+    index.save(mask_path)
+    return index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or print the label index sidecars of masks.')
+    parser.add_argument('masks', nargs='+', help='mask files')
+    parser.add_argument('--print', action='store_true', help='print the index of every mask')
+    args = parser.parse_args()
+
+    for mask_path in args.masks:
+        index = index_mask(mask_path)
+        if args.print:
+            print(mask_path)
+            for label, entry in index.to_dict().items():
+                print(f"  {label}: {entry['voxels']} voxels, [{entry['lower']}, {entry['upper']})")
@@ -0,0 +1,379 @@
+import numpy as np
+
+def labels_present(label_arr: np.ndarray) -> np.ndarray:
+    """
+    Returns the sorted, non-zero labels present in a label map.
+
+    For non-negative integer label maps this is one np.bincount pass instead of the sort behind np.unique.
+
+    Parameters:
+    - label_arr: np.ndarray, the label map.
+
+    Returns:
+    - labels: np.ndarray, the non-zero labels, in the dtype of label_arr.
+    """
+    if label_arr.size == 0:
+        return np.zeros(0, dtype=label_arr.dtype)
+
+    if np.issubdtype(label_arr.dtype, np.integer) and label_arr.min() >= 0:
+        counts = np.bincount(label_arr.ravel())
+        counts[0] = 0
+        return np.flatnonzero(counts).astype(label_arr.dtype)
+
+    labels = np.unique(label_arr)
+    return labels[labels != 0]
+
+# Labels up to this value are indexed directly by label_bounding_boxes; larger ones are compacted first
+DENSE_LABELS = 1024
+
+def label_bounding_boxes(label_arr: np.ndarray, chunk_voxels: int = 2 ** 22) -> tuple:
+    """
+    Returns the voxel count and bounding box of every non-zero label of a label map.
+
+    Each chunk of z-slices is reduced with two np.bincount passes, over (label, z, y) and (label, x) keys, instead of a
+    np.nonzero scan per label. Labels above DENSE_LABELS (e.g. global registry IDs) are first compacted to 1..n.
+
+    Parameters:
+    - label_arr: np.ndarray, the non-negative integer label map, of shape [z, y, x].
+    - chunk_voxels: int, voxels per chunk of z-slices, which bounds the temporary key arrays.
+
+    Returns:
+    - labels: np.ndarray, the sorted non-zero labels, in the dtype of label_arr.
+    - counts: np.ndarray of int64, the voxels of each label.
+    - lower: np.ndarray of int64, shape (n, 3), the first [z, y, x] index of each label.
+    - upper: np.ndarray of int64, shape (n, 3), the last [z, y, x] index of each label + 1.
+    """
+    max_label = int(label_arr.max()) if label_arr.size else 0
+    if max_label == 0:
+        return np.zeros(0, dtype=label_arr.dtype), np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int64), np.zeros((0, 3), dtype=np.int64)
+
+    # Compact label index of every label value, 0 for the background, when the labels are sparse
+    compact = None
+    n = max_label + 1
+    if max_label >= DENSE_LABELS:
+        labels = labels_present(label_arr)
+        compact = np.zeros(max_label + 1, dtype=np.intp)
+        compact[labels.astype(np.intp)] = np.arange(1, labels.size + 1)
+        n = labels.size + 1
+
+    nz, ny, nx = label_arr.shape
+    counts = np.zeros(n, dtype=np.int64)
+    present = [np.zeros((n, size), dtype=bool) for size in (nz, ny, nx)]
+    depth = max(1, chunk_voxels // max(ny * nx, 1))
+    x_index = np.arange(nx, dtype=np.intp)[None, None, :]
+    for z_start in range(0, nz, depth):
+        chunk = label_arr[z_start:z_start + depth]
+        keys = compact[chunk] if compact is not None else chunk.astype(np.intp)
+        d = keys.shape[0]
+
+        # (label, z, y) presence gives the z and y extents, (label, x) the x extent
+        zy_keys = keys * (d * ny)
+        zy_keys += np.arange(d * ny, dtype=np.intp).reshape(d, ny, 1)
+        zy_counts = np.bincount(zy_keys.ravel(), minlength=n * d * ny).reshape(n, d, ny)
+        del zy_keys
+        counts += zy_counts.sum(axis=(1, 2))
+        present[0][:, z_start:z_start + d] = zy_counts.any(axis=2)
+        present[1] |= zy_counts.any(axis=1)
+        keys *= nx
+        keys += x_index
+        present[2] |= np.bincount(keys.ravel(), minlength=n * nx).reshape(n, nx) > 0
+
+    # First and last coordinate along each axis, for the non-zero labels
+    rows = np.flatnonzero(counts[1:]) + 1
+    if compact is None:
+        labels = rows.astype(label_arr.dtype)
+    lower = np.stack([axis_present[rows].argmax(axis=1) for axis_present in present], axis=1).astype(np.int64)
+    upper = np.stack([axis_present.shape[1] - axis_present[rows, ::-1].argmax(axis=1) for axis_present in present], axis=1).astype(np.int64)
+    return labels, counts[rows], lower, upper
+
+def build_lut(mapping: dict, max_label: int, dtype: np.dtype = np.int64) -> np.ndarray:
+    """
+    Builds a dense lookup table over the labels 0..max_label: every label maps to itself unless it is in `mapping`.
+
+    Parameters:
+    - mapping: dict, old label -> new label.
+    - max_label: int, the largest label the table has to cover.
+    - dtype: np.dtype, the dtype of the table (new labels that do not fit wrap around, like in-place numpy arithmetic).
+
+    Returns:
+    - lut: np.ndarray, of shape (max_label + 1,).
+    """
+    lut = np.arange(max_label + 1, dtype=np.int64)
+    for old_label, new_label in mapping.items():
+        if 0 <= old_label <= max_label:
+            lut[int(old_label)] = int(new_label)
+    return lut.astype(dtype)
+
+def relabel(label_arr: np.ndarray, mapping: dict, out: np.ndarray = None) -> np.ndarray:
+    """
+    Applies a label mapping to a whole label map in a single memory pass.
+
+    The mapping is turned into a dense lookup table once and applied with one fancy-index gather (`lut[label_arr]`),
+    so the cost does not depend on the number of classes that are remapped. Labels that are not in `mapping` are kept.
+
+    Parameters:
+    - label_arr: np.ndarray, the label map.
+    - mapping: dict, old label -> new label.
+    - out: np.ndarray (optional), preallocated output of the same shape and dtype; may be label_arr itself to relabel in place.
+
+    Returns:
+    - relabelled: np.ndarray, the relabelled map (`out` if it was given), in the dtype of label_arr.
+    """
+    if out is None:
+        out = np.empty_like(label_arr)
+
+    if not mapping or label_arr.size == 0:
+        if out is not label_arr:
+            np.copyto(out, label_arr)
+        return out
+
+    if np.issubdtype(label_arr.dtype, np.integer) and label_arr.min() >= 0:
+        lut = build_lut(mapping, max(int(label_arr.max()), 0), label_arr.dtype)
+        # np.take buffers `out` in its default mode, so relabelling in place is safe
+        np.take(lut, label_arr, out=out)
+        return out
+
+    # Negative or non-integer labels cannot index a table: map the distinct values instead
+    values, inverse = np.unique(label_arr, return_inverse=True)
+    new_values = np.array([mapping.get(value.item(), value) for value in values]).astype(label_arr.dtype)
+    out[...] = new_values[inverse].reshape(label_arr.shape)
+    return out
+
+# How fuse_label_maps resolves labels an incoming layer shares with the labels already fused
+OFFSET_POLICIES = ('shift_existing', 'shift_incoming', 'keep')
+
+def fuse_label_maps(label_maps: list, policies: list = None, names: list = None, luts: list = None) -> tuple:
+    """
+    Fuses any number of label maps on the same grid, in priority order: every layer is drawn over the layers before
+    it wherever its label is non-zero. Labels an incoming layer shares with the labels visible so far are resolved by
+    the layer's offset policy:
+    - 'shift_existing': the visible labels that collide are shifted by (largest incoming label + 1), like overlay_scans.
+    - 'shift_incoming': the incoming labels that collide are shifted by (largest visible label + 1), like underlay_scans.
+    - 'keep': labels are kept as they are.
+
+    The result is identical to chaining the pairwise merges, but no intermediate volume is built: every layer keeps
+    a lookup table from its own labels to fused labels (shifts wrap in the dtype of the merge, as in-place numpy
+    arithmetic does), an owner map records which layer is visible at each voxel, and the visible labels are tracked
+    with label counts that are only updated on the voxels an incoming layer covers.
+
+    Parameters:
+    - label_maps: list of np.ndarray, non-negative integer label maps of the same shape, lowest priority first.
+    - policies: list of str (optional), the offset policy of every layer (the first layer's is ignored; default
+      'shift_existing').
+    - names: list of str (optional), the layer names used in the provenance table (default: the layer indices).
+    - luts: list of np.ndarray (optional), the initial lookup table of every layer, from its labels to fused labels
+      (e.g. from a LabelRegistry). With 'keep' policies, the fusion is then a static lookup table application, and
+      the fused dtype is the smallest that holds every label of the tables, whatever labels the maps contain.
+
+    Returns:
+    - fused: np.ndarray, the fused label map, in the numpy result type of all layers.
+    - provenance: list of dict, one record per fused label: 'label', 'layer', 'source_label' and 'voxels'.
+    """
+    n_layers = len(label_maps)
+    policies = list(policies) if policies is not None else ['shift_existing'] * n_layers
+    names = list(names) if names is not None else list(range(n_layers))
+    for policy in policies[1:]:
+        if policy not in OFFSET_POLICIES:
+            raise ValueError(f"Unknown offset policy '{policy}', expected one of {OFFSET_POLICIES}")
+
+    # Per layer: lookup table from its labels to the fused labels, and the counts of its labels that are visible
+    max_labels = [int(label_map.max(initial=0)) for label_map in label_maps]
+    given_luts = luts is not None
+    if luts is None:
+        luts = [np.arange(max_label + 1, dtype=np.int64) for max_label in max_labels]
+        fused_dtype = label_maps[0].dtype
+    else:
+        for k, (lut, max_label) in enumerate(zip(luts, max_labels)):
+            if max_label >= len(lut):
+                raise ValueError(f"Label {max_label} of layer {names[k]} is not in its lookup table")
+        fused_dtype = lut_dtype(label_maps[0].dtype, luts)
+        luts = [np.asarray(lut, dtype=np.int64)[:max_label + 1].copy() for lut, max_label in zip(luts, max_labels)]
+    counts = [None] * n_layers
+    owner = np.full(label_maps[0].shape, -1, dtype=np.int8 if n_layers < 128 else np.int16)
+
+    base = label_maps[0]
+    owner[np.take(luts[0] != 0, base)] = 0
+    counts[0] = np.bincount(base.ravel(), minlength=luts[0].size)
+    if given_luts:
+        check_lut_coverage(counts[0], luts[0], names[0])
+    counts[0][luts[0] == 0] = 0
+
+    for k in range(1, n_layers):
+        label_map = label_maps[k]
+        incoming_counts = np.bincount(label_map.ravel(), minlength=luts[k].size)
+        if given_luts:
+            check_lut_coverage(incoming_counts, luts[k], names[k])
+        if policies[k] != 'keep':
+            offset_layer(luts, k, policies[k], incoming_counts, visible_labels(luts[:k], counts[:k]), fused_dtype, label_map.dtype)
+
+        # The incoming layer covers the voxels where its (possibly shifted) label is non-zero
+        covered = np.flatnonzero(np.take(luts[k] != 0, label_map))
+        covered_owner = owner.ravel()[covered]
+        for j in range(k):
+            counts[j] -= np.bincount(label_maps[j].ravel()[covered[covered_owner == j]], minlength=counts[j].size)
+        owner.ravel()[covered] = k
+        counts[k] = incoming_counts
+        counts[k][luts[k] == 0] = 0
+        fused_dtype = np.result_type(fused_dtype, label_map.dtype)
+
+    # Gather the fused labels of every layer where it is visible
+    fused = np.zeros(base.shape, dtype=fused_dtype)
+    for j in range(n_layers):
+        np.copyto(fused, np.take(luts[j].astype(fused_dtype), label_maps[j]), where=owner == j)
+
+    provenance = []
+    for j in range(n_layers):
+        for source_label in np.flatnonzero(counts[j]).tolist():
+            label = luts[j][source_label].astype(fused_dtype).item()
+            if label != 0:
+                provenance.append({'label': label, 'layer': names[j], 'source_label': source_label, 'voxels': int(counts[j][source_label])})
+    provenance.sort(key=lambda row: (row['label'], str(row['layer'])))
+    return fused, provenance
+
+def offset_layer(luts: list, k: int, policy: str, incoming_counts: np.ndarray, visible_classes: np.ndarray,
+                 fused_dtype: np.dtype, incoming_dtype: np.dtype) -> None:
+    # Resolves the labels layer k shares with the visible fused labels by its offset policy, updating the lookup tables in place
+    incoming_classes = np.flatnonzero(incoming_counts[1:]) + 1
+    overlapping_classes = np.intersect1d(visible_classes, incoming_classes)
+    if overlapping_classes.size == 0:
+        return
+
+    if policy == 'shift_existing':
+        # Shift the colliding fused labels, in the dtype of the fused map so far
+        shift_amount = int(np.array(incoming_classes.max() + 1).astype(incoming_dtype))
+        for j in range(k):
+            shifted = np.isin(luts[j], overlapping_classes)
+            luts[j] = np.where(shifted, luts[j] + shift_amount, luts[j]).astype(fused_dtype).astype(np.int64)
+    elif policy == 'shift_incoming':
+        # Shift the colliding incoming labels, in the dtype of the incoming layer
+        shift_amount = int(np.array(visible_classes.max() + 1).astype(fused_dtype))
+        shifted = np.isin(luts[k], overlapping_classes)
+        luts[k] = np.where(shifted, luts[k] + shift_amount, luts[k]).astype(incoming_dtype).astype(np.int64)
+
+def lut_dtype(base_dtype: np.dtype, luts: list) -> np.dtype:
+    # The dtype of the first layer, widened to hold every label of the given lookup tables
+    return np.result_type(base_dtype, np.min_scalar_type(max(int(np.max(lut, initial=0)) for lut in luts)))
+
+class SlabLabelFusion(object):
+    """
+    Slab-by-slab counterpart of `fuse_label_maps`, for label maps that are too large to hold at once.
+
+    The offset policies decide the shifts from the labels visible over the whole volume, so with shifting policies
+    the maps are read twice: `count` accumulates, slab by slab, the counts of the labels of every layer that stay
+    visible after each later layer is drawn, `plan` then resolves the lookup tables exactly as fuse_label_maps
+    does, and `fuse` draws the layers of every slab. With 'keep' policies and given lookup tables nothing depends on
+    the whole volume, so `count` and `fuse` are called on the same slab in a single pass.
+
+    The result and provenance are identical to fuse_label_maps, except when a shift wraps a present incoming label
+    around to background in its dtype: `plan` then sets `wraps`, and the caller should fuse in memory instead.
+    """
+    def __init__(self, dtypes: list = None, policies: list = None, names: list = None, luts: list = None) -> None:
+        n_layers = len(dtypes)
+        self.dtypes = [np.dtype(dtype) for dtype in dtypes]
+        self.policies = list(policies) if policies is not None else ['shift_existing'] * n_layers
+        self.names = list(names) if names is not None else list(range(n_layers))
+        for policy in self.policies[1:]:
+            if policy not in OFFSET_POLICIES:
+                raise ValueError(f"Unknown offset policy '{policy}', expected one of {OFFSET_POLICIES}")
+
+        self.given_luts = luts is not None
+        if luts is None:
+            self.luts = [np.zeros(1, dtype=np.int64) for _ in range(n_layers)]
+            self.fused_dtype = self.dtypes[0]
+        else:
+            self.luts = [np.asarray(lut, dtype=np.int64).copy() for lut in luts]
+            self.fused_dtype = lut_dtype(self.dtypes[0], self.luts)
+        # visible[k][j]: counts of the labels of layer j that are not covered by the layers j+1..k (k >= j)
+        self.visible = [[np.zeros(1, dtype=np.int64) for _ in range(k + 1)] for k in range(n_layers)]
+        self.wraps = False
+        self.planned = not self.needs_plan()
+
+    def needs_plan(self) -> bool:
+        # Whether the lookup tables depend on the labels of the whole volume
+        return not self.given_luts or any(policy != 'keep' for policy in self.policies[1:])
+
+    def count(self, slabs: list = None) -> None:
+        n_layers = len(slabs)
+        for j in range(n_layers):
+            uncovered = None
+            for k in range(j, n_layers):
+                if k > j:
+                    uncovered = (slabs[k] == 0) if uncovered is None else uncovered & (slabs[k] == 0)
+                labels = slabs[j] if uncovered is None else slabs[j][uncovered]
+                self.visible[k][j] = add_counts(self.visible[k][j], np.bincount(labels.ravel()))
+
+            # Lookup tables cover every label seen so far: identity by default, background if not in a given table
+            incoming = self.visible[j][j]
+            if self.luts[j].size < incoming.size:
+                extension = np.arange(self.luts[j].size, incoming.size) if not self.given_luts else np.zeros(incoming.size - self.luts[j].size)
+                self.luts[j] = np.concatenate([self.luts[j], extension.astype(np.int64)])
+            if self.given_luts:
+                check_lut_coverage(incoming, self.luts[j][:incoming.size], self.names[j])
+
+    def plan(self) -> None:
+        # Resolve the offset policies layer by layer, like fuse_label_maps, from the counts of the whole volume
+        fused_dtype = self.fused_dtype
+        for k in range(1, len(self.luts)):
+            if self.policies[k] != 'keep':
+                counts = [self.visible_counts(k - 1, j) for j in range(k)]
+                offset_layer(self.luts, k, self.policies[k], self.visible[k][k], visible_labels(self.luts[:k], counts),
+                             fused_dtype, self.dtypes[k])
+                if np.any((self.visible[k][k][1:] > 0) & (self.luts[k][1:self.visible[k][k].size] == 0)):
+                    self.wraps = True
+            fused_dtype = np.result_type(fused_dtype, self.dtypes[k])
+        self.fused_dtype = fused_dtype
+        self.planned = True
+
+    def result_dtype(self) -> np.dtype:
+        # Fused dtype: that of fuse_label_maps, the result type of every layer (and of the given lookup tables)
+        return np.result_type(self.fused_dtype, *self.dtypes)
+
+    def fuse(self, slabs: list = None, out: np.ndarray = None) -> np.ndarray:
+        # Draws the layers of one slab in priority order; later layers win wherever their label is non-zero
+        if not self.planned:
+            raise RuntimeError('Count every slab and plan the lookup tables before fusing')
+        fused_dtype = self.result_dtype()
+        if out is None:
+            out = np.zeros(slabs[0].shape, dtype=fused_dtype)
+        else:
+            out[...] = 0
+        for lut, slab in zip(self.luts, slabs):
+            np.copyto(out, np.take(lut.astype(fused_dtype), slab), where=slab != 0)
+        return out
+
+    def visible_counts(self, k: int, j: int) -> np.ndarray:
+        # Counts of the labels of layer j that are visible after layer k, background labels excluded
+        counts = add_counts(np.zeros(self.luts[j].size, dtype=np.int64), self.visible[k][j])
+        counts[self.luts[j] == 0] = 0
+        return counts
+
+    def provenance(self) -> list:
+        fused_dtype = self.result_dtype()
+        provenance = []
+        last = len(self.luts) - 1
+        for j in range(len(self.luts)):
+            counts = self.visible_counts(last, j)
+            for source_label in np.flatnonzero(counts).tolist():
+                label = np.array(self.luts[j][source_label]).astype(fused_dtype).item()
+                if label != 0:
+                    provenance.append({'label': label, 'layer': self.names[j], 'source_label': source_label, 'voxels': int(counts[source_label])})
+        provenance.sort(key=lambda row: (row['label'], str(row['layer'])))
+        return provenance
+
+def add_counts(total: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # Sum of two bincounts of different lengths
+    if counts.size > total.size:
+        total, counts = counts, total
+    total[:counts.size] += counts
+    return total
+
+def check_lut_coverage(label_counts: np.ndarray, lut: np.ndarray, name: str = None) -> None:
+    # Every non-zero label present in a layer must have a non-zero fused label in the lookup table it was given
+    unmapped = np.flatnonzero((label_counts[1:] > 0) & (lut[1:] == 0)) + 1
+    if unmapped.size > 0:
+        raise ValueError(f"Labels {unmapped.tolist()} of layer {name} are not in its lookup table")
+
+def visible_labels(luts: list, counts: list) -> np.ndarray:
+    # Sorted, non-zero fused labels that are visible in at least one voxel
+    labels = np.unique(np.concatenate([lut[count > 0] for lut, count in zip(luts, counts)]))
+    return labels[labels != 0]
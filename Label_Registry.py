@@ -0,0 +1,137 @@
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Union
+
+import numpy as np
+
+class LabelRegistry(object):
+    """
+    Fixed global label IDs for the classes of every segmentation model.
+
+    Each (model, class) pair gets one global ID the first time its model is registered, and keeps it: registering a
+    model again (e.g. after the registry file is reloaded) only appends the classes that are new, so adding a model or
+    a class never renumbers the existing ones. With a registry, aggregation maps every mask through a static lookup
+    table and filtering only suppresses labels, so the same segment ID means the same anatomy for every patient and no
+    per-patient label search is needed.
+    """
+    def __init__(self, entries: List[dict] = None) -> None:
+        self.entries = []
+        self.by_key = {}
+        self.by_id = {}
+        for entry in entries or []:
+            self.add(entry)
+
+    def add(self, entry: dict) -> None:
+        entry = {'id': int(entry['id']), 'model': entry['model'], 'class': int(entry['class']), 'name': entry['name']}
+        if entry['id'] <= 0 or entry['id'] in self.by_id or (entry['model'], entry['class']) in self.by_key:
+            raise ValueError(f"Duplicate or invalid label registry entry {entry}")
+        self.entries.append(entry)
+        self.by_key[(entry['model'], entry['class'])] = entry
+        self.by_id[entry['id']] = entry
+
+    def register_model(self, model: str = None, labels: Dict[str, Union[int, list]] = None) -> None:
+        """
+        Registers the classes of a model, as listed in the 'labels' of its nnU-Net dataset.json (name -> class).
+        Classes that are already registered keep their global ID.
+        """
+        for name, model_class in sorted(labels.items(), key=lambda item: model_label(item[1])):
+            model_class = model_label(model_class)
+            if model_class == 0:
+                continue  # Background
+            if (model, model_class) not in self.by_key:
+                self.add({'id': self.max_id() + 1, 'model': model, 'class': model_class, 'name': name})
+
+    def register_dataset_json(self, model: str = None, dataset_json: str = None) -> None:
+        # dataset_json may be the file or the model folder that contains it
+        if os.path.isdir(dataset_json):
+            dataset_json = os.path.join(dataset_json, 'dataset.json')
+        with open(dataset_json, 'r') as handle:
+            self.register_model(model, json.load(handle)['labels'])
+
+    def max_id(self) -> int:
+        return max(self.by_id, default=0)
+
+    def dtype(self) -> np.dtype:
+        # Smallest unsigned integer type that holds every global ID
+        return np.min_scalar_type(self.max_id())
+
+    def lut(self, model: str = None) -> np.ndarray:
+        # Lookup table from the classes of a model to their global IDs (0 stays background)
+        classes = [entry for entry in self.entries if entry['model'] == model]
+        if not classes:
+            raise KeyError(f"Model '{model}' is not in the label registry")
+        lut = np.zeros(max(entry['class'] for entry in classes) + 1, dtype=np.int64)
+        for entry in classes:
+            lut[entry['class']] = entry['id']
+        return lut
+
+    def name(self, label_id: int = None) -> str:
+        entry = self.by_id.get(int(label_id))
+        return f"{entry['model']}:{entry['name']}" if entry is not None else None
+
+    def names(self) -> Dict[int, str]:
+        return {label_id: self.name(label_id) for label_id in self.by_id}
+
+    def resolve(self, labels: Iterable[Union[int, str]] = None) -> List[int]:
+        # Global IDs from global IDs or 'MODEL:name' strings
+        resolved = []
+        names = {name: label_id for label_id, name in self.names().items()}
+        for label in labels or []:
+            if isinstance(label, str) and not label.isdigit():
+                if label not in names:
+                    raise KeyError(f"Label '{label}' is not in the label registry")
+                resolved.append(names[label])
+            else:
+                resolved.append(int(label))
+        return resolved
+
+    def fingerprint(self) -> str:
+        # Changes whenever an ID is added or reassigned, so stage caches recompute their outputs
+        return hashlib.sha256(json.dumps(self.entries, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def load(cls, registry_path: str = None) -> 'LabelRegistry':
+        with open(registry_path, 'r') as handle:
+            return cls(json.load(handle)['labels'])
+
+    def save(self, registry_path: str = None) -> None:
+        # Written to a temporary file first, so a crash never leaves a truncated registry
+        temporary_path = f'{registry_path}.tmp-{os.getpid()}'
+        with open(temporary_path, 'w') as handle:
+            json.dump({'labels': self.entries}, handle, indent=2)
+        os.replace(temporary_path, registry_path)
+
+def model_label(value: Union[int, list]) -> int:
+    # nnU-Net region-based datasets list several classes per label; the first one names it
+    return int(value[0] if isinstance(value, (list, tuple)) else value)
+
+def build_label_registry(dataset_jsons: Dict[str, str] = None, registry_path: str = None) -> LabelRegistry:
+    """
+    Loads the registry at registry_path (if it exists), registers the models in the given order and saves it.
+
+    Parameters:
+    - dataset_jsons: dict, model name -> its dataset.json (or model folder), e.g. {'TOTAL': ..., 'BS': ..., 'TEMP': ...}.
+    - registry_path: str (optional), the registry file, kept in sync.
+
+    Returns:
+    - registry: LabelRegistry.
+    """
+    registry = LabelRegistry.load(registry_path) if registry_path and os.path.exists(registry_path) else LabelRegistry()
+    for model, dataset_json in (dataset_jsons or {}).items():
+        registry.register_dataset_json(model, dataset_json)
+    if registry_path:
+        registry.save(registry_path)
+    return registry
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create or extend the global label registry from the dataset.json of every model.')
+    parser.add_argument('registry_path')
+    parser.add_argument('--model', nargs=2, action='append', metavar=('NAME', 'DATASET_JSON'), default=[],
+                        help='model name and its dataset.json or model folder, in registration order, e.g. --model TOTAL path')
+    args = parser.parse_args()
+
+    registry = build_label_registry(dict(args.model), args.registry_path)
+    for entry in registry.entries:
+        print(f"{entry['id']:>4}  {entry['model']}:{entry['name']} ({entry['class']})")
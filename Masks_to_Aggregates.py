@@ -1,127 +1,397 @@
 import SimpleITK as sitk
 import numpy as np
 import os
+import threading
+from collections import OrderedDict
+
+from Image_IO import SlabReader, is_image_file, iter_slabs, read_image, slab_depth, split_image_ending, write_image
+from Label_Index import LabelIndex
+from Label_Maps import SlabLabelFusion, fuse_label_maps, labels_present, relabel
+from Label_Registry import LabelRegistry
+from Profiling import phase, profiled_stage
+from Stage_Cache import StageCache
+
+# Nearest neighbour index maps of recent (mask grid, reference grid) pairs, so the merges of one patient share them
+_INDEX_MAPS = OrderedDict()
+_INDEX_MAPS_LOCK = threading.Lock()
+MAX_CACHED_INDEX_MAPS = 8
+
+# The aggregate layers, lowest priority first, with their offset policies: BS is drawn over TOTAL, shifting the TOTAL
+# labels it collides with (overlay_scans), then TEMP over the result, shifting its own colliding labels (underlay_scans)
+AGGREGATE_LAYERS = (('TOTAL', 'shift_existing'), ('BS', 'shift_existing'), ('TEMP', 'shift_incoming'))
+
+# Rough peak of the per-slab temporaries of the slab-wise fusion, per voxel (visibility masks, gathered labels, bincounts)
+SLAB_BYTES_PER_VOXEL = 24
 
 def Masks_to_Aggregates(temp_input_dir: str = None, bs_input_dir: str = None, total_input_dir: str = None,
-                        aggregates_output_dir: str = None) -> None:
-    
-    # Ensure the output directory exists
-    if not os.path.exists(aggregates_output_dir):
-        os.mkdir(aggregates_output_dir)
+                        aggregates_output_dir: str = None, label_registry: LabelRegistry = None, max_memory_mb: float = None,
+                        output_ending: str = None) -> None:
+    # TOTAL, BS and TEMP are fused in one pass per patient, straight into the final aggregates; with a label registry
+    # every class gets its global ID instead of being shifted per patient, and with a memory ceiling the masks are
+    # fused slab by slab. The aggregates keep the file ending of the TOTAL masks unless output_ending is given
+    # (e.g. '.npy', the memory-mappable intermediate format of Image_IO)
+    final_aggregates_output_dir = f'{aggregates_output_dir} - FINAL'
+    if not os.path.exists(final_aggregates_output_dir):
+        os.makedirs(final_aggregates_output_dir)
+
+    cache = aggregate_stage_cache(final_aggregates_output_dir, label_registry)
 
     # Iterate over all files in the total input directory
     for filename in os.listdir(total_input_dir):
         # Check if the file is either an .nrrd or .nii.gz file
-        if not (filename.endswith('.nrrd') or filename.endswith('.nii.gz')):
-            continue
-        
-        # Check if the output file already exists to avoid redundant work
-        if os.path.exists(os.path.join(aggregates_output_dir, filename)):
+        if not is_image_file(filename) or not (filename.endswith('.nrrd') or filename.endswith('.nii.gz')):
             continue
 
         total_file = os.path.join(total_input_dir, filename)
         bs_file = os.path.join(bs_input_dir, filename)
-        
-        # Call the overlay_scans function with the two files and the output directory
-        overlay_scans(total_file, bs_file, os.path.join(aggregates_output_dir, filename))
-        
-    # Ensure the output directory exists
-    final_aggregates_output_dir = f'{aggregates_output_dir} - FINAL'
-    if not os.path.exists(final_aggregates_output_dir):
-        os.mkdir(final_aggregates_output_dir)
+        temp_file = os.path.join(temp_input_dir, f'{filename.split(".")[0]}.nrrd')
 
-    # Iterate over all files in the aggregates output directory
-    for filename in os.listdir(aggregates_output_dir):
+        output_filename = f'{split_image_ending(filename)[0]}{output_ending}' if output_ending else filename
+        aggregate_case([total_file, bs_file, temp_file], os.path.join(final_aggregates_output_dir, output_filename), cache, label_registry,
+                       max_memory_mb)
 
-        # Check if the output file already exists to avoid redundant work
-        if os.path.exists(os.path.join(final_aggregates_output_dir, filename)):
-            continue
+def aggregate_stage_cache(final_aggregates_output_dir: str = None, label_registry: LabelRegistry = None) -> StageCache:
+    params = {'layers': AGGREGATE_LAYERS}
+    if label_registry is not None:
+        params['label_registry'] = label_registry.fingerprint()
+    return StageCache(final_aggregates_output_dir, 'aggregate_scans', params)
 
-        temp_file = os.path.join(temp_input_dir, f'{filename.split(".")[0]}.nrrd')
-        aggregate_file = os.path.join(aggregates_output_dir, filename)
-        
-        # Call the overlay_scans function with the two files and the output directory
-        underlay_scans(temp_file, aggregate_file, os.path.join(final_aggregates_output_dir, filename))
+def aggregate_case(mask_files: list = None, output_file: str = None, cache: StageCache = None,
+                   label_registry: LabelRegistry = None, max_memory_mb: float = None) -> None:
+    # Check if the output is up to date with its inputs to avoid redundant work (the slab-wise output is identical)
+    key = cache.key(mask_files)
+    if cache.is_fresh(output_file, key):
+        return
+
+    aggregate_scans(mask_files, output_file, label_registry=label_registry, max_memory_mb=max_memory_mb)
+    cache.record(output_file, key)
 
+@profiled_stage('overlay_scans')
 def overlay_scans(send_to_back_path: str, overlay_scan_path: str, output_path: str):
     # Load the segmentation scans as SimpleITK images
-    send_to_back = sitk.ReadImage(send_to_back_path)
-    overlay_scan = sitk.ReadImage(overlay_scan_path)
+    with phase('read'):
+        send_to_back = read_image(send_to_back_path)
+        overlay_scan = read_image(overlay_scan_path)
+
+    combined_image = overlay_images(send_to_back, overlay_scan)
     
+    # Write the combined result to an output file
+    with phase('write'):
+        write_image(combined_image, output_path, use_compression=True)
+
+def overlay_images(send_to_back: sitk.Image, overlay_scan: sitk.Image) -> sitk.Image:
     # Ensure both images have the same orientation, spacing, and origin
-    overlay_scan = sitk.Resample(overlay_scan, send_to_back, sitk.Transform(), sitk.sitkNearestNeighbor, 0, overlay_scan.GetPixelID())
+    with phase('resample'):
+        overlay_scan = resample_like(overlay_scan, send_to_back)
     
-    # Convert the scans to numpy arrays for easier manipulation
-    send_to_back_array = sitk.GetArrayFromImage(send_to_back)
-    overlay_scan_array = sitk.GetArrayFromImage(overlay_scan)
+    # Read-only views of the scans; only the relabelled scan is copied
+    send_to_back_array = sitk.GetArrayViewFromImage(send_to_back)
+    overlay_scan_array = sitk.GetArrayViewFromImage(overlay_scan)
     
-    # Identify unique classes in both scans
-    back_classes = [cls for cls in np.unique(send_to_back_array) if cls != 0]
-    overlay_classes = [cls for cls in np.unique(overlay_scan_array) if cls != 0]
+    with phase('relabel'):
+        # Identify unique classes in both scans
+        back_classes = labels_present(send_to_back_array)
+        overlay_classes = labels_present(overlay_scan_array)
     
-    # Find overlapping classes
-    overlapping_classes = np.intersect1d(back_classes, overlay_classes)
+        # Find overlapping classes
+        overlapping_classes = np.intersect1d(back_classes, overlay_classes)
     
-    # If overlapping classes exist, shift the `send_to_front` class numbers to avoid conflicts
-    if overlapping_classes.size > 0:
-        max_overlay_class = np.max(overlay_classes)
-        shift_amount = max_overlay_class + 1  # Shift `send_to_front` classes to avoid overlap
+        # If overlapping classes exist, shift the `send_to_front` class numbers to avoid conflicts
+        if overlapping_classes.size > 0:
+            max_overlay_class = np.max(overlay_classes)
+            shift_amount = max_overlay_class + 1  # Shift `send_to_front` classes to avoid overlap
         
-        for cls in overlapping_classes:
-            # Shift the class numbers in send_to_front to new, non-overlapping values
-            send_to_back_array[send_to_back_array == cls] += shift_amount
+            # Shift the class numbers in send_to_back to new, non-overlapping values with a single lookup-table pass
+            send_to_back_array = relabel(send_to_back_array, {cls: cls + int(shift_amount) for cls in overlapping_classes.tolist()})
 
-    # Combine the scans: wherever the overlay_scan has a non-zero label, it takes precedence
-    combined_array = np.where(overlay_scan_array != 0, overlay_scan_array, send_to_back_array)
+    with phase('compute'):
+        # Combine the scans: wherever the overlay_scan has a non-zero label, it takes precedence
+        combined_array = np.where(overlay_scan_array != 0, overlay_scan_array, send_to_back_array)
     
-    # Convert the result back to a SimpleITK image
-    combined_image = sitk.GetImageFromArray(combined_array)
+        # Convert the result back to a SimpleITK image
+        combined_image = sitk.GetImageFromArray(combined_array)
     
-    # Copy the metadata (spacing, origin, direction) from the send_to_back scan
-    combined_image.CopyInformation(send_to_back)
-    
-    # Write the combined result to an output file
-    sitk.WriteImage(combined_image, output_path, useCompression=True)
+        # Copy the metadata (spacing, origin, direction) from the send_to_back scan
+        combined_image.CopyInformation(send_to_back)
 
+    return combined_image
+
+@profiled_stage('underlay_scans')
 def underlay_scans(send_to_front_path: str, underlay_scan_path: str, output_path: str) -> None:
     # Load the segmentation scans as SimpleITK images
-    send_to_front = sitk.ReadImage(send_to_front_path)
-    underlay_scan = sitk.ReadImage(underlay_scan_path)
+    with phase('read'):
+        send_to_front = read_image(send_to_front_path)
+        underlay_scan = read_image(underlay_scan_path)
+
+    combined_image = underlay_images(send_to_front, underlay_scan)
     
+    # Write the combined result to an output file
+    with phase('write'):
+        write_image(combined_image, output_path, use_compression=True)
+
+def underlay_images(send_to_front: sitk.Image, underlay_scan: sitk.Image) -> sitk.Image:
     # Ensure both images have the same orientation, spacing, and origin
-    underlay_scan = sitk.Resample(underlay_scan, send_to_front, sitk.Transform(), sitk.sitkNearestNeighbor, 0, underlay_scan.GetPixelID())
+    with phase('resample'):
+        underlay_scan = resample_like(underlay_scan, send_to_front)
     
-    # Convert the scans to numpy arrays for easier manipulation
-    send_to_front_array = sitk.GetArrayFromImage(send_to_front)
-    underlay_scan_array = sitk.GetArrayFromImage(underlay_scan)
+    # Read-only views of the scans; only the relabelled scan is copied
+    send_to_front_array = sitk.GetArrayViewFromImage(send_to_front)
+    underlay_scan_array = sitk.GetArrayViewFromImage(underlay_scan)
         
-    # Identify unique classes in both scans
-    front_classes = [cls for cls in np.unique(send_to_front_array) if cls != 0]
-    underlay_classes = [cls for cls in np.unique(underlay_scan_array) if cls != 0]
+    with phase('relabel'):
+        # Identify unique classes in both scans
+        front_classes = labels_present(send_to_front_array)
+        underlay_classes = labels_present(underlay_scan_array)
     
-    # Find overlapping classes
-    overlapping_classes = np.intersect1d(front_classes, underlay_classes)
+        # Find overlapping classes
+        overlapping_classes = np.intersect1d(front_classes, underlay_classes)
     
-    # If overlapping classes exist, shift the `send_to_front` class numbers to avoid conflicts
-    if overlapping_classes.size > 0:
-        max_underlay_class = np.max(underlay_classes)
-        shift_amount = max_underlay_class + 1  # Shift `send_to_front` classes to avoid overlap
+        # If overlapping classes exist, shift the `send_to_front` class numbers to avoid conflicts
+        if overlapping_classes.size > 0:
+            max_underlay_class = np.max(underlay_classes)
+            shift_amount = max_underlay_class + 1  # Shift `send_to_front` classes to avoid overlap
         
-        for cls in overlapping_classes:
-            # Shift the class numbers in send_to_front to new, non-overlapping values
-            send_to_front_array[send_to_front_array == cls] += shift_amount
+            # Shift the class numbers in send_to_front to new, non-overlapping values with a single lookup-table pass
+            send_to_front_array = relabel(send_to_front_array, {cls: cls + int(shift_amount) for cls in overlapping_classes.tolist()})
 
-    # Combine the scans: wherever the overlay_scan has a non-zero label, it takes precedence
-    combined_array = np.where(send_to_front_array != 0, send_to_front_array, underlay_scan_array)
+    with phase('compute'):
+        # Combine the scans: wherever the overlay_scan has a non-zero label, it takes precedence
+        combined_array = np.where(send_to_front_array != 0, send_to_front_array, underlay_scan_array)
     
-    # Convert the result back to a SimpleITK image
-    combined_image = sitk.GetImageFromArray(combined_array)
+        # Convert the result back to a SimpleITK image
+        combined_image = sitk.GetImageFromArray(combined_array)
     
-    # Copy the metadata (spacing, origin, direction) from the `send_to_front` scan
-    combined_image.CopyInformation(send_to_front)
-    
-    # Write the combined result to an output file
-    sitk.WriteImage(combined_image, output_path, useCompression=True)
+        # Copy the metadata (spacing, origin, direction) from the `send_to_front` scan
+        combined_image.CopyInformation(send_to_front)
+
+    return combined_image
+
+@profiled_stage('aggregate_scans')
+def aggregate_scans(mask_paths: list, output_path: str, policies: list = None, names: list = None,
+                    label_registry: LabelRegistry = None, max_memory_mb: float = None) -> list:
+    """
+    Fuses the masks of one patient with `fuse_images` and writes the aggregate, with its label index sidecar (see
+    Label_Index.py). With a memory ceiling, masks on the same grid are fused slab by slab with `aggregate_slabs` instead.
+
+    Parameters:
+    - mask_paths: list of str, paths to the masks, lowest priority first (default layers: TOTAL, BS, TEMP).
+    - output_path: str, path to save the aggregate.
+    - policies: list of str (optional), the offset policy of every mask (default: those of AGGREGATE_LAYERS).
+    - names: list of str (optional), the model names of the masks (default: those of AGGREGATE_LAYERS).
+    - label_registry: LabelRegistry (optional), maps the classes of every mask to their global IDs.
+    - max_memory_mb: float (optional), memory ceiling of the slab-wise fusion, in MiB.
+
+    Returns:
+    - provenance: list of dict, the layer and source label of every aggregate label.
+    """
+    if max_memory_mb is not None:
+        provenance = aggregate_slabs(mask_paths, output_path, policies, names, label_registry, max_memory_mb)
+        if provenance is not None:
+            return provenance
+
+    with phase('read'):
+        masks = [read_image(mask_path) for mask_path in mask_paths]
+
+    aggregate, provenance = fuse_images(masks, policies, names, label_registry)
+
+    with phase('write'):
+        write_image(aggregate, output_path, use_compression=True)
+
+    with phase('index'):
+        LabelIndex.from_array(sitk.GetArrayViewFromImage(aggregate)).save(output_path)
+
+    return provenance
+
+def fuse_images(masks: list, policies: list = None, names: list = None, label_registry: LabelRegistry = None) -> tuple:
+    """
+    Fuses any number of masks in a single pass with `Label_Maps.fuse_label_maps`: the result is identical to chaining
+    overlay_images (for 'shift_existing' layers) and underlay_images (for 'shift_incoming' layers), without building
+    or writing the intermediate aggregates.
+
+    As in those functions, each merge keeps the grid of the side whose labels are not shifted: an incoming
+    'shift_existing' or 'keep' mask is resampled onto the grid of the masks before it, and for a 'shift_incoming'
+    mask the masks before it are resampled onto its grid.
+
+    With a label registry, the classes of every mask (named after its model) are mapped to their global IDs and no
+    labels are shifted: the fusion is a static lookup table per mask, and the grids follow the policies as above.
+
+    Parameters:
+    - masks: list of sitk.Image, the masks, lowest priority first.
+    - policies: list of str (optional), the offset policy of every mask (default: those of AGGREGATE_LAYERS).
+    - names: list of str (optional), the model names of the masks (default: those of AGGREGATE_LAYERS).
+    - label_registry: LabelRegistry (optional), maps the classes of every model to their global IDs.
+
+    Returns:
+    - aggregate: sitk.Image, the fused mask.
+    - provenance: list of dict, the layer and source label of every fused label.
+    """
+    policies, names = layer_defaults(len(masks), policies, names)
+
+    # Bring every mask onto the grid of the merge that takes it
+    with phase('resample'):
+        grid = masks[0]
+        aligned = [masks[0]]
+        for mask, policy in zip(masks[1:], policies[1:]):
+            if policy == 'shift_incoming':
+                aligned = [resample_like(previous, mask) for previous in aligned]
+                grid = mask
+                aligned.append(mask)
+            else:
+                aligned.append(resample_like(mask, grid))
+
+    luts = None
+    if label_registry is not None:
+        luts = [label_registry.lut(name) for name in names]
+
+    with phase('compute'):
+        fused, provenance = fuse_label_maps([sitk.GetArrayViewFromImage(mask) for mask in aligned],
+                                            policies if luts is None else ['keep'] * len(masks), names, luts)
+
+        # Convert the result back to a SimpleITK image with the metadata of the grid it was fused on
+        aggregate = sitk.GetImageFromArray(fused)
+        aggregate.CopyInformation(grid)
+
+    return aggregate, provenance
+
+def aggregate_slabs(mask_paths: list, output_path: str, policies: list = None, names: list = None,
+                    label_registry: LabelRegistry = None, max_memory_mb: float = None) -> list:
+    """
+    Slab-wise counterpart of `aggregate_scans` for masks on the same grid: the masks are fused with
+    `Label_Maps.SlabLabelFusion` in z-slabs sized to stay under `max_memory_mb`, reading them twice with shifting
+    policies and once with a label registry. Only the aggregate is held in full (in its label dtype), and the output
+    is identical to that of aggregate_scans.
+
+    Returns:
+    - provenance: list of dict, or None when the masks are on different grids or a label shift wraps around, so the
+      caller must fuse in memory.
+    """
+    policies, names = layer_defaults(len(mask_paths), policies, names)
+    readers = [SlabReader(mask_path) for mask_path in mask_paths]
+    if not all(same_grid(reader, readers[0]) for reader in readers[1:]):
+        return None
+
+    fusion = SlabLabelFusion([reader.dtype for reader in readers], policies if label_registry is None else ['keep'] * len(readers),
+                             names, [label_registry.lut(name) for name in names] if label_registry is not None else None)
+    depth = slab_depth(readers, SLAB_BYTES_PER_VOXEL, max_memory_mb, fusion.result_dtype().itemsize)
+
+    if fusion.needs_plan():
+        with phase('relabel'):
+            for _, slabs in iter_slabs(readers, depth):
+                fusion.count(slabs)
+            fusion.plan()
+        if fusion.wraps:
+            return None
+
+    with phase('compute'):
+        fused = np.zeros(readers[0].GetSize()[::-1], dtype=fusion.result_dtype())
+        for z_start, slabs in iter_slabs(readers, depth):
+            if not fusion.needs_plan():
+                fusion.count(slabs)
+            fusion.fuse(slabs, fused[z_start:z_start + depth])
+        provenance = fusion.provenance()
+
+        # The masks share one grid, so the aggregate takes its metadata from any of them
+        aggregate = readers[0].copy_information(sitk.GetImageFromArray(fused))
+        del fused
+
+    with phase('write'):
+        write_image(aggregate, output_path, use_compression=True)
+
+    with phase('index'):
+        LabelIndex.from_array(sitk.GetArrayViewFromImage(aggregate), depth * readers[0].GetSize()[0] * readers[0].GetSize()[1]).save(output_path)
+
+    return provenance
+
+def layer_defaults(n_masks: int = None, policies: list = None, names: list = None) -> tuple:
+    # Masks beyond the default layers are drawn on top, shifting the labels they collide with
+    default_layers = list(AGGREGATE_LAYERS) + [(str(k), 'shift_existing') for k in range(len(AGGREGATE_LAYERS), n_masks)]
+    if policies is None:
+        policies = [policy for _, policy in default_layers[:n_masks]]
+    if names is None:
+        names = [name for name, _ in default_layers[:n_masks]]
+    return policies, names
+
+def resample_like(image: sitk.Image, reference: sitk.Image, tolerance: float = 1e-4) -> sitk.Image:
+    """
+    Nearest neighbour resampling of a label map onto the grid of a reference image, equivalent to
+    `sitk.Resample(image, reference, sitk.Transform(), sitk.sitkNearestNeighbor, 0, image.GetPixelID())`.
+
+    Masks predicted from the same input already share its grid, so the resampling is skipped when the sizes match and
+    the spacings, origins and directions agree within `tolerance`. When only the spacing, origin or size differ, the
+    resampling is separable along the axes: the per-axis source indices are computed once per pair of grids, cached,
+    and applied with a single gather. Other cases (e.g. different directions) fall back to sitk.Resample.
+
+    Parameters:
+    - image: sitk.Image, the label map to resample.
+    - reference: sitk.Image, the image whose grid the output takes.
+    - tolerance: float, the largest difference tolerated, as a fraction of a voxel for origins and spacings, and in
+      direction cosines.
+
+    Returns:
+    - resampled: sitk.Image, the label map on the reference grid (image itself when the grids already match).
+    """
+    if same_grid(image, reference, tolerance):
+        return image
+
+    if image.GetNumberOfComponentsPerPixel() != 1 or not np.allclose(image.GetDirection(), reference.GetDirection(), atol=tolerance):
+        return sitk.Resample(image, reference, sitk.Transform(), sitk.sitkNearestNeighbor, 0, image.GetPixelID())
+
+    # Per-axis source indices, in numpy (z, y, x) order, and whether each index falls inside the image
+    axes = nearest_neighbour_index_map(image, reference)[::-1]
+
+    resampled_array = sitk.GetArrayViewFromImage(image)[np.ix_(*[indices for indices, _ in axes])]
+    for axis, (_, inside) in enumerate(axes):
+        if not inside.all():
+            resampled_array[(slice(None),) * axis + (~inside,)] = 0
+
+    resampled = sitk.GetImageFromArray(resampled_array)
+    resampled.CopyInformation(reference)
+    return resampled
+
+def same_grid(image: sitk.Image, reference: sitk.Image, tolerance: float = 1e-4) -> bool:
+    # Same size, and spacing, origin and direction equal within the tolerance
+    if image.GetSize() != reference.GetSize():
+        return False
+    spacing = np.array(reference.GetSpacing())
+    return (np.all(np.abs(np.array(image.GetSpacing()) - spacing) <= tolerance * spacing)
+            and np.all(np.abs(np.array(image.GetOrigin()) - np.array(reference.GetOrigin())) <= tolerance * spacing.min())
+            and np.allclose(image.GetDirection(), reference.GetDirection(), rtol=0, atol=tolerance))
+
+def grid_key(image: sitk.Image) -> tuple:
+    return (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection())
+
+def nearest_neighbour_index_map(image: sitk.Image, reference: sitk.Image) -> list:
+    """
+    Returns, for every axis (x, y, z) of the reference grid, the index of the nearest voxel of `image` and whether it
+    lies inside `image`, for two grids with the same direction. The points are mapped with ITK's own index/physical
+    point conversions and rounded like its nearest neighbour interpolator, so the result matches sitk.Resample.
+    """
+    key = (grid_key(image), grid_key(reference))
+    with _INDEX_MAPS_LOCK:
+        if key in _INDEX_MAPS:
+            _INDEX_MAPS.move_to_end(key)
+            return _INDEX_MAPS[key]
+
+    index_map = []
+    dimension = reference.GetDimension()
+    for axis in range(dimension):
+        continuous = np.empty(reference.GetSize()[axis])
+        for i in range(continuous.size):
+            reference_index = [0.0] * dimension
+            reference_index[axis] = float(i)
+            point = reference.TransformContinuousIndexToPhysicalPoint(reference_index)
+            continuous[i] = image.TransformPhysicalPointToContinuousIndex(point)[axis]
+
+        size = image.GetSize()[axis]
+        inside = (continuous >= -0.5) & (continuous < size - 0.5)
+        indices = np.clip(np.floor(continuous + 0.5), 0, size - 1).astype(np.intp)
+        index_map.append((indices, inside))
+
+    with _INDEX_MAPS_LOCK:
+        _INDEX_MAPS[key] = index_map
+        while len(_INDEX_MAPS) > MAX_CACHED_INDEX_MAPS:
+            _INDEX_MAPS.popitem(last=False)
+    return index_map
 
 if __name__ == '__main__':
     temp_input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Batch 5 - nnUNet - TEMP"
@@ -1,10 +1,15 @@
-from Model_Input_to_Masks import JGHPredictor
-from Masks_to_Aggregates import overlay_scans, underlay_scans
-from Aggregates_to_Filtered_Aggregates import filter_mask
-from Filtered_Aggregates_to_Statistics import extract_baseline_features_InHouse
+from Model_Input_to_Masks import get_predictor
+from Masks_to_Aggregates import aggregate_scans, fuse_images
+from Aggregates_to_Filtered_Aggregates import filter_mask, filter_mask_image
+from Filtered_Aggregates_to_Statistics import extract_baseline_features_InHouse, extract_baseline_features_from_images, statistics_to_rows
 
 import os
 import pandas as pd
+import SimpleITK as sitk
+
+from Image_IO import read_image, write_image
+from Label_Registry import LabelRegistry
+from Profiling import phase, profiled_stage
 
 from typing import List, Union
 
@@ -29,14 +34,13 @@ def Model_Input_Filepath_to_Masks(input_dir: Union[str, List[List[str]]] = None,
     use_folds = (0,)
     checkpoint_name = 'checkpoint_final.pth'    
 
-    predictor = JGHPredictor(use_mirroring, device, model_folder, use_folds, checkpoint_name)
+    predictor = get_predictor(model_folder, use_folds, checkpoint_name, device, use_mirroring)
     predictor.option_0001(input_dir, output_dir)
 
 def Masks_to_Aggregates(temp_input: str = None, bs_input: str = None, total_input: str = None,
                         aggregates_output: str = None) -> None:
     
-    overlay_scans(total_input, bs_input, aggregates_output)
-    underlay_scans(temp_input, aggregates_output, aggregates_output)
+    aggregate_scans([total_input, bs_input, temp_input], aggregates_output)
 
 def Aggregates_to_Filtered_Aggregates(input: str = None, filtered_output: str = None, classes_to_suppress: list = None) -> None:
     
@@ -49,30 +53,78 @@ def Filtered_Aggregates_to_Statistics(mask_path: str, image_path: str, output_cs
 
     stats = extract_baseline_features_InHouse(image_path, mask_path)
 
-    rows = []
-
-    # Create rows for each segment in the mask
-    for segment_id, features in stats.items():
-        row = {
-            'segment': segment_id,
-            'segment_feature': 'size',  # Placeholder, can be updated as needed
-            'cohort': cohort,
-            'site': site,
-            'modality': modality,
-            'model_name': model_name,
-            'patient_id': patient_id,
-            'series_description': os.path.basename(image_path).replace('.nii.gz', ''),
-            'volume': features.get('volume', None),
-            'mean_density': features.get('mean_density', None),
-            'median_density': features.get('median_density', None),
-            'std_dev': features.get('std_dev', None),
-        }
-        rows.append(row)
+    series_description = os.path.basename(image_path).replace('.nii.gz', '')
+    rows = statistics_to_rows(stats, patient_id, series_description, cohort, site, modality, model_name)
 
     # Convert the rows to a DataFrame and save as CSV
     df = pd.DataFrame(rows)
     df.to_csv(output_csv, index=False)
 
+@profiled_stage('Masks_to_Statistics')
+def Masks_to_Statistics(temp_input: str = None, bs_input: str = None, total_input: str = None, image_path: str = None,
+                        output_csv: str = None, classes_to_suppress: list = None,
+                        aggregates_output: str = None, filtered_output: str = None, patient_id: str = None,
+                        cohort: str = 'NSP', site: str = 'JGH', modality: str = 'CT',
+                        model_name = 'TotalSegmentatorV2[total, brain_structures]_InHouseTemporalis',
+                        label_registry: LabelRegistry = None) -> list:
+    """
+    Fused equivalent of Masks_to_Aggregates -> Aggregates_to_Filtered_Aggregates -> Filtered_Aggregates_to_Statistics
+    for one patient. The label maps and the image stay in memory from the segmentation masks to the statistics rows,
+    and only the outputs that are asked for are written to disk.
+    
+    Parameters:
+    - temp_input, bs_input, total_input: str, paths to the TEMP, BS and TOTAL masks of the patient.
+    - image_path: str, path to the image the masks were predicted from.
+    - output_csv: str (optional), path to save the statistics rows as a CSV file.
+    - classes_to_suppress: list of int (optional), the aggregate classes set to background before statistics.
+    - aggregates_output: str (optional), path to save the aggregated mask.
+    - filtered_output: str (optional), path to save the filtered aggregated mask.
+    - patient_id: str (optional), the patient ID written to the rows (default: derived from the image file name).
+    - cohort, site, modality, model_name: str, descriptive columns written to every row.
+    - label_registry: LabelRegistry (optional), aggregate with fixed global label IDs (classes_to_suppress may then be
+      given as 'MODEL:name') and name the segments in the rows.
+    
+    Returns:
+    - rows: list of dict, one record per segment.
+    """
+    series_description = os.path.basename(image_path).replace('.nii.gz', '')
+    if patient_id is None:
+        patient_id = series_description.split('_')[0]
+
+    with phase('read'):
+        masks = [read_image(total_input), read_image(bs_input), read_image(temp_input)]
+
+    # Aggregate the three masks in one pass: BS over TOTAL, then TEMP over the result
+    aggregate, _ = fuse_images(masks, label_registry=label_registry)
+    del masks
+    if aggregates_output is not None:
+        with phase('write'):
+            write_image(aggregate, aggregates_output, use_compression=True)
+
+    # Suppress the unwanted classes and make the labels continuous
+    with phase('relabel'):
+        if label_registry is not None:
+            filtered = filter_mask_image(aggregate, label_registry.resolve(classes_to_suppress), contiguous=False)
+        else:
+            filtered = filter_mask_image(aggregate, classes_to_suppress)
+    del aggregate
+    if filtered_output is not None:
+        with phase('write'):
+            write_image(filtered, filtered_output, use_compression=True)
+
+    # Extract the statistics against the image
+    with phase('read'):
+        image = read_image(image_path)
+    with phase('compute'):
+        stats = extract_baseline_features_from_images(image, filtered)
+    rows = statistics_to_rows(stats, patient_id, series_description, cohort, site, modality, model_name,
+                              label_registry.names() if label_registry is not None else None)
+
+    if output_csv is not None:
+        pd.DataFrame(rows).to_csv(output_csv, index=False)
+
+    return rows
+
 if __name__ == "__main__":
     patient_database = r"C:\Users\joshua.onichino\Dropbox\Head\Patient Database Test"
     patient_id = r"HK20240048470101"
@@ -100,17 +152,11 @@ if __name__ == "__main__":
             Model_Input_Filepath_to_Masks(input_dir=[[nifti_path]], output_dir=[cranial_mask], model=model)
 
     patient_dir = os.path.join(patient_database, patient_id)
-    Masks_to_Aggregates(temp_input=os.path.join(patient_dir, f'{patient_id}_TEMP.nrrd'), 
+    Masks_to_Statistics(temp_input=os.path.join(patient_dir, f'{patient_id}_TEMP.nrrd'),
                         bs_input=os.path.join(patient_dir, f'{patient_id}_BS.nii.gz'),
                         total_input=os.path.join(patient_dir, f'{patient_id}_TOTAL.nii.gz'),
-                        aggregates_output=os.path.join(patient_dir, f'{patient_id}_AGG.nii.gz'))
-
-    patient_dir = os.path.join(patient_database, patient_id)
-    Aggregates_to_Filtered_Aggregates(input=os.path.join(patient_dir, f'{patient_id}_AGG.nii.gz'),
-                                      filtered_output=os.path.join(patient_dir, f'{patient_id}_FIL_AGG.nii.gz'),
-                                      classes_to_suppress=[22,28])
-
-    patient_dir = os.path.join(patient_database, patient_id)
-    Filtered_Aggregates_to_Statistics(mask_path=os.path.join(patient_dir, f'{patient_id}_FIL_AGG.nii.gz'),
-                                      image_path=os.path.join(patient_dir, f'{patient_id}.nii.gz'), 
-                                      output_csv=os.path.join(patient_dir, 'Aggregated_Statistics.csv'))
\ No newline at end of file
+                        image_path=os.path.join(patient_dir, f'{patient_id}.nii.gz'),
+                        output_csv=os.path.join(patient_dir, 'Aggregated_Statistics.csv'),
+                        classes_to_suppress=[22,28],
+                        filtered_output=os.path.join(patient_dir, f'{patient_id}_FIL_AGG.nii.gz'),
+                        patient_id=patient_id)
\ No newline at end of file
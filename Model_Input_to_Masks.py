@@ -2,11 +2,25 @@ from nnunetv2.paths import nnUNet_results
 import torch
 from batchgenerators.utilities.file_and_folder_operations import join
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
 
+import multiprocessing
 import os
+import queue
+import threading
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import zip_longest
 from typing import Tuple, Union, List
 
-def NRRD_to_Temporal_Masks(input_dir: str = None, temp_output_dir: str = None) -> None:
+from Stage_Cache import StageCache
+
+# Initialized predictors, keyed by (model_folder, use_folds, checkpoint_name, device), so weights load once per process
+_PREDICTORS = {}
+_PREDICTORS_LOCK = threading.Lock()
+
+def NRRD_to_Temporal_Masks(input_dir: str = None, temp_output_dir: str = None, num_parts: int = 1, part_id: int = 0) -> None:
 
     if not os.path.exists(temp_output_dir):
         os.mkdir(temp_output_dir)
@@ -18,10 +32,10 @@ def NRRD_to_Temporal_Masks(input_dir: str = None, temp_output_dir: str = None) -
     use_folds = (0,1,2,3,4)
     checkpoint_name = 'checkpoint_final.pth'
 
-    predictor = JGHPredictor(use_mirroring, device, model_folder, use_folds, checkpoint_name)
-    predictor.option_0001(input_dir, temp_output_dir)
+    predictor = get_predictor(model_folder, use_folds, checkpoint_name, device, use_mirroring)
+    predictor.option_0001(input_dir, temp_output_dir, num_parts, part_id)
 
-def NIfTI_to_Total_Masks(input_dir: str = None, total_output_dir: str = None) -> None:
+def NIfTI_to_Total_Masks(input_dir: str = None, total_output_dir: str = None, num_parts: int = 1, part_id: int = 0) -> None:
     if not os.path.exists(total_output_dir):
         os.mkdir(total_output_dir)
 
@@ -31,10 +45,10 @@ def NIfTI_to_Total_Masks(input_dir: str = None, total_output_dir: str = None) ->
     use_folds = (0,)
     checkpoint_name = 'checkpoint_final.pth'
 
-    predictor = JGHPredictor(use_mirroring, device, model_folder, use_folds, checkpoint_name)
-    predictor.option_0001(input_dir, output_dir)
+    predictor = get_predictor(model_folder, use_folds, checkpoint_name, device, use_mirroring)
+    predictor.option_0001(input_dir, total_output_dir, num_parts, part_id)
 
-def NIfTI_to_Neuroanatomy_Masks(input_dir: str = None, total_output_dir: str = None) -> None:
+def NIfTI_to_Neuroanatomy_Masks(input_dir: str = None, total_output_dir: str = None, num_parts: int = 1, part_id: int = 0) -> None:
     if not os.path.exists(total_output_dir):
         os.mkdir(total_output_dir)
 
@@ -44,8 +58,287 @@ def NIfTI_to_Neuroanatomy_Masks(input_dir: str = None, total_output_dir: str = N
     use_folds = (0,)
     checkpoint_name = 'checkpoint_final.pth'
 
-    predictor = JGHPredictor(use_mirroring, device, model_folder, use_folds, checkpoint_name)
-    predictor.option_0001(input_dir, output_dir)
+    predictor = get_predictor(model_folder, use_folds, checkpoint_name, device, use_mirroring)
+    predictor.option_0001(input_dir, total_output_dir, num_parts, part_id)
+
+def get_predictor(model_folder: str = None, use_folds: Tuple = None, checkpoint_name: str = None, device: str = 'GPU',
+                  use_mirroring: bool = False, save_probabilities: bool = False) -> 'JGHPredictor':
+    """
+    Returns the initialized JGHPredictor for a model, creating it (and loading its checkpoints) only on first use.
+    Predictors are cached per process, keyed by every setting (model_folder, use_folds, checkpoint_name, device,
+    use_mirroring, save_probabilities), and a cached predictor is never reconfigured: concurrent callers with
+    different settings get different instances, at the cost of loading the weights once per combination.
+    
+    Parameters:
+    - model_folder: str, the trained model folder, relative to nnUNet_results.
+    - use_folds: tuple of int, the folds to ensemble.
+    - checkpoint_name: str, the checkpoint file name (e.g., 'checkpoint_final.pth').
+    - device: str, 'GPU' or 'CPU'.
+    - use_mirroring: bool, test-time mirroring.
+    - save_probabilities: bool, also export the softmax probabilities.
+    
+    Returns:
+    - predictor: JGHPredictor, shared by every caller with the same key.
+    """
+    key = predictor_key(model_folder, use_folds, checkpoint_name, device, use_mirroring, save_probabilities)
+
+    with _PREDICTORS_LOCK:
+        predictor = _PREDICTORS.get(key)
+        if predictor is None:
+            predictor = JGHPredictor(use_mirroring, device, model_folder, use_folds, checkpoint_name, save_probabilities)
+            _PREDICTORS[key] = predictor
+    return predictor
+
+def evict_predictor(model_folder: str = None, use_folds: Tuple = None, checkpoint_name: str = None, device: str = 'GPU') -> bool:
+    # Drop the cached predictors of one model (whatever their mirroring and probability export), returns whether any was cached
+    model_key = predictor_key(model_folder, use_folds, checkpoint_name, device)[:4]
+    with _PREDICTORS_LOCK:
+        evicted = [_PREDICTORS.pop(key) for key in list(_PREDICTORS) if key[:4] == model_key]
+    release_device_memory()
+    return bool(evicted)
+
+def clear_predictors() -> None:
+    # Drop every cached predictor
+    with _PREDICTORS_LOCK:
+        _PREDICTORS.clear()
+    release_device_memory()
+
+def predictor_key(model_folder: str = None, use_folds: Tuple = None, checkpoint_name: str = None, device: str = 'GPU',
+                  use_mirroring: bool = False, save_probabilities: bool = False) -> tuple:
+    return (model_folder, tuple(use_folds) if use_folds is not None else None, checkpoint_name, device, bool(use_mirroring),
+            bool(save_probabilities))
+
+def case_in_shard(case_id: str = None, num_parts: int = 1, part_id: int = 0) -> bool:
+    """
+    Deterministically assigns a case to one of `num_parts` shards from a hash of its case ID.
+
+    Unlike splitting a sorted folder listing, the assignment of a case never depends on which other cases are present,
+    so N nodes can each process part_id = 0..N-1 of the same batch folder without coordination, and the TEMP, TOTAL
+    and BS masks of a patient are always predicted by the same node.
+    """
+    if not 0 <= part_id < num_parts:
+        raise ValueError(f'part_id must be in [0, {num_parts}), got {part_id}')
+    return zlib.crc32(case_id.encode('utf-8')) % num_parts == part_id
+
+def release_device_memory() -> None:
+    # Hand the memory of evicted networks back to the GPU
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+# Model settings of the three segmentation stages, as used by the stage functions above
+MODEL_CONFIGURATIONS = {
+    'TEMP': {'model_folder': r'Dataset005_TemporalisBatch3\nnUNetTrainer__nnUNetPlans__2d',
+             'use_folds': (0,1,2,3,4), 'checkpoint_name': 'checkpoint_final.pth', 'use_mirroring': True},
+    'TOTAL': {'model_folder': r"Dataset294_TotalSegmentator_part4_muscles_1559subj\nnUNetTrainerNoMirroring__nnUNetPlans__3d_fullres",
+              'use_folds': (0,), 'checkpoint_name': 'checkpoint_final.pth', 'use_mirroring': False},
+    'BS': {'model_folder': r"Dataset409_neuro_550subj\nnUNetTrainer_DASegOrd0__nnUNetPlans__3d_fullres_high",
+           'use_folds': (0,), 'checkpoint_name': 'checkpoint_final.pth', 'use_mirroring': False},
+}
+
+def Model_Inputs_to_All_Masks(nrrd_input_dir: str = None, nifti_input_dir: str = None, temp_output_dir: str = None,
+                              total_output_dir: str = None, bs_output_dir: str = None, device: str = 'GPU', **scheduler_options) -> None:
+    """
+    Runs the TEMP, TOTAL and BS segmentation stages (NRRD_to_Temporal_Masks, NIfTI_to_Total_Masks and
+    NIfTI_to_Neuroanatomy_Masks) together through one shared scheduler, see Model_Inputs_to_Masks.
+    """
+    jobs = [dict(MODEL_CONFIGURATIONS['TEMP'], input_dir=nrrd_input_dir, output_dir=temp_output_dir),
+            dict(MODEL_CONFIGURATIONS['TOTAL'], input_dir=nifti_input_dir, output_dir=total_output_dir),
+            dict(MODEL_CONFIGURATIONS['BS'], input_dir=nifti_input_dir, output_dir=bs_output_dir)]
+    Model_Inputs_to_Masks(jobs, device, **scheduler_options)
+
+def Model_Inputs_to_Masks(jobs: List[dict] = None, device: str = 'GPU', num_processes_preprocessing: int = None,
+                          num_processes_segmentation_export: int = None, inference_threads: int = None,
+                          total_cores: int = None, max_queued_per_model: int = 2, num_parts: int = 1, part_id: int = 0) -> None:
+    """
+    Runs several segmentation models over their input folders (or explicit lists of files) concurrently. This is the
+    one mask prediction scheduler: the stage functions above and the pipeline runner's device batches both use it.
+
+    All models share one preprocessing process pool and one export process pool. Cases of the different models are
+    interleaved, and each preprocessed case is handed to its model's inference thread as soon as it is ready, so the
+    throughput follows the slowest model instead of the sum of all of them. On the GPU the inference threads take turns
+    on the device; on the CPU they run at the same time, each inference call with the process-wide number of torch
+    threads of plan_core_budget. Export failures, including those of recording a mask, are raised at the end.
+    Every model runs in this process, so the models cannot get different numbers of torch threads.
+    
+    Parameters:
+    - jobs: list of dict, one per model, with keys input_dir, output_dir, model_folder, use_folds, checkpoint_name
+      and optionally use_mirroring; input_dir and output_dir are folders, or lists of input file lists and of
+      truncated output files (as JGHPredictor.list_cases).
+    - device: str, 'GPU' or 'CPU'.
+    - num_processes_preprocessing, num_processes_segmentation_export, inference_threads: int (optional), override the
+      core budget.
+    - total_cores: int (optional), the cores available to the scheduler (default: all).
+    - max_queued_per_model: int, preprocessed cases waiting for inference, per model; bounds the memory in use.
+    - num_parts, part_id: int, only predict the cases of shard part_id out of num_parts (see case_in_shard).
+    """
+    budget = plan_core_budget(len(jobs), device, total_cores)
+    num_processes_preprocessing = num_processes_preprocessing or budget['num_processes_preprocessing']
+    num_processes_segmentation_export = num_processes_segmentation_export or budget['num_processes_segmentation_export']
+    inference_threads = inference_threads or budget['inference_threads']
+
+    # Load every model once and list the cases it still has to predict
+    predictors = []
+    cases = []
+    for job_id, job in enumerate(jobs):
+        if not isinstance(job['input_dir'], list) and not os.path.exists(job['output_dir']):
+            os.mkdir(job['output_dir'])
+
+        predictor = get_predictor(job['model_folder'], job['use_folds'], job['checkpoint_name'], device, job.get('use_mirroring', False))
+        predictors.append(predictor)
+        cases.append([(job_id, image_files, output_file) for image_files, output_file in predictor.list_cases(job['input_dir'], job['output_dir'], num_parts, part_id)])
+
+    # Interleave the cases of the different models so that every model is fed from the start
+    cases = [case for round_robin in zip_longest(*cases) for case in round_robin if case is not None]
+    if not cases:
+        return
+
+    if device != 'GPU':
+        torch.set_num_threads(inference_threads)
+    device_lock = threading.Lock() if device == 'GPU' else None
+    inference_queues = [queue.Queue(maxsize=max_queued_per_model) for _ in jobs]
+    export_slots = threading.BoundedSemaphore(2 * num_processes_segmentation_export)
+    export_broken = threading.Event()
+    export_futures = []
+    errors = []
+
+    # Spawned workers, like nnU-Net's own pools, so that no CUDA state is forked into them
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=num_processes_preprocessing, mp_context=context) as preprocessing_pool, \
+         ProcessPoolExecutor(max_workers=num_processes_segmentation_export, mp_context=context) as export_pool:
+
+        def inference_worker(job_id: int) -> None:
+            jgh_predictor = predictors[job_id]
+            predictor = jgh_predictor.predictor
+            while True:
+                item = inference_queues[job_id].get()
+                if item is None:
+                    return
+                data, properties, image_files, output_file = item
+                if export_broken.is_set():
+                    # Keep draining the queue so that the main thread never blocks on it, but predict nothing more
+                    errors.append((output_file, BrokenProcessPool('the export pool is broken, case not predicted')))
+                    continue
+                try:
+                    if device_lock is not None:
+                        with device_lock:
+                            prediction = predictor.predict_logits_from_preprocessed_data(data).cpu()
+                    else:
+                        prediction = predictor.predict_logits_from_preprocessed_data(data).cpu()
+                    del data
+
+                    # Bound the number of predictions waiting for export, they are full-size logits
+                    export_slots.acquire()
+                    try:
+                        future = export_pool.submit(export_prediction_from_logits, prediction, properties,
+                                                    predictor.configuration_manager, predictor.plans_manager,
+                                                    predictor.dataset_json, output_file, False)
+                    except BaseException as error:
+                        export_slots.release()
+                        if isinstance(error, BrokenProcessPool):
+                            export_broken.set()
+                        raise
+                    future.add_done_callback(lambda done, image_files=image_files, output_file=output_file:
+                                             exported(done, jgh_predictor, image_files, output_file))
+                    export_futures.append(future)
+                except Exception as error:
+                    errors.append((output_file, error))
+
+        def exported(future, jgh_predictor: 'JGHPredictor', image_files: List[str], output_file: str) -> None:
+            # Free the export slot, and record the mask in the stage manifest once it is on disk. Exceptions raised by a
+            # done callback are only logged by concurrent.futures, so failures are collected here
+            export_slots.release()
+            try:
+                error = future.exception()
+                if error is None:
+                    jgh_predictor.record_case(image_files, output_file)
+                elif isinstance(error, BrokenProcessPool):
+                    export_broken.set()
+            except Exception as error:
+                errors.append((output_file, error))
+
+        inference_threads = [threading.Thread(target=inference_worker, args=(job_id,), daemon=True) for job_id in range(len(jobs))]
+        for thread in inference_threads:
+            thread.start()
+
+        # Keep the preprocessing pool busy, and hand every case to inference as soon as it is preprocessed
+        remaining = iter(cases)
+        running = {}
+        while True:
+            # No new cases once the export pool is broken, they could not be saved
+            while len(running) < 2 * num_processes_preprocessing and not export_broken.is_set():
+                case = next(remaining, None)
+                if case is None:
+                    break
+                job_id, image_files, output_file = case
+                predictor = predictors[job_id].predictor
+                future = preprocessing_pool.submit(preprocess_case, image_files, predictor.plans_manager,
+                                                   predictor.configuration_manager, predictor.dataset_json)
+                running[future] = case
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job_id, image_files, output_file = running.pop(future)
+                try:
+                    data, properties = future.result()
+                except Exception as error:
+                    errors.append((output_file, error))
+                    continue
+                data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+                inference_queues[job_id].put((data, properties, image_files, output_file))
+
+        # Let the inference threads drain their queues, then wait for the exports
+        for inference_queue in inference_queues:
+            inference_queue.put(None)
+        for thread in inference_threads:
+            thread.join()
+        for future in export_futures:
+            try:
+                future.result()
+            except Exception as error:
+                errors.append((None, error))
+
+    if errors:
+        output_file, error = errors[0]
+        raise RuntimeError(f'{len(errors)} case(s) failed, first failure for {output_file}') from error
+
+def preprocess_case(image_files: List[str], plans_manager, configuration_manager, dataset_json: dict) -> tuple:
+    # Runs in the shared preprocessing pool, with the plans of the model the case belongs to
+    preprocessor = configuration_manager.preprocessor_class(verbose=False)
+    data, _, properties = preprocessor.run_case(image_files, None, plans_manager, configuration_manager, dataset_json)
+    return data, properties
+
+def plan_core_budget(n_models: int = 1, device: str = 'GPU', total_cores: int = None) -> dict:
+    """
+    Splits the available cores between preprocessing, export and inference.
+
+    With a GPU the inference runs on the device, so the cores go to the preprocessing and export pools. On the CPU
+    half of the cores go to inference and the rest to the pools. The torch thread count is one setting for the
+    whole process, and each of the n_models inference threads runs its calls with that many threads at the same
+    time, so it is half of the cores divided by n_models.
+    
+    Returns:
+    - budget: dict with num_processes_preprocessing, num_processes_segmentation_export and inference_threads (the
+      torch threads of the process).
+    """
+    total_cores = total_cores or os.cpu_count() or 1
+    n_models = max(n_models, 1)
+
+    if device == 'GPU':
+        inference_threads = 1
+        pool_cores = max(total_cores - 1, 2)
+    else:
+        inference_threads = max((total_cores // 2) // n_models, 1)
+        pool_cores = max(total_cores - inference_threads * n_models, 2)
+
+    # Preprocessing (resampling, normalization) is heavier than export, give it the larger share
+    num_processes_preprocessing = max((pool_cores * 2) // 3, 1)
+    num_processes_segmentation_export = max(pool_cores - num_processes_preprocessing, 1)
+
+    return {'num_processes_preprocessing': num_processes_preprocessing,
+            'num_processes_segmentation_export': num_processes_segmentation_export,
+            'inference_threads': inference_threads}
 
 class JGHPredictor(object):
     def __init__(self, 
@@ -63,6 +356,7 @@ class JGHPredictor(object):
         self.checkpoint_name = checkpoint_name
 
         self.save_probabilities = save_probabilities
+        self.stage_caches = {}
 
         # Instantiate the nnUNetPredictor
         self.predictor = nnUNetPredictor(tile_step_size=0.5,
@@ -78,20 +372,65 @@ class JGHPredictor(object):
         self.predictor.initialize_from_trained_model_folder(join(nnUNet_results, self.model_folder),
                                                             use_folds=self.use_folds,
                                                             checkpoint_name=self.checkpoint_name)
-    
-    def option_0001(self, input_dir: Union[str, List[List[str]]] = None, output_dir: Union[str, List[str]] = None):
+
+    def list_cases(self, input_dir: Union[str, List[List[str]]] = None, output_dir: Union[str, List[str]] = None,
+                   num_parts: int = 1, part_id: int = 0) -> List[tuple]:
+        # The (input files, truncated output file) pairs that still have to be predicted
+        list_of_lists, output_files, _ = self.predictor._manage_input_and_output_lists(input_dir, output_dir, None, True, 0, 1,
+                                                                                       self.save_probabilities)
+        cases = list(zip(list_of_lists, output_files))
+
+        # Keep the cases of this shard only
+        if num_parts > 1:
+            cases = [(image_files, output_file) for image_files, output_file in cases
+                     if case_in_shard(os.path.basename(output_file), num_parts, part_id)]
+
+        # Skip the masks that are up to date with their input images and with this model
+        return [(image_files, output_file) for image_files, output_file in cases
+                if not self.case_is_fresh(image_files, output_file)]
+
+    def stage_cache(self, output_dir: str = None) -> StageCache:
+        # One manifest per output folder, keyed by the model, its folds, the content of its checkpoints and mirroring
+        if output_dir not in self.stage_caches:
+            cache = StageCache(output_dir, 'predict_masks')
+            checkpoints = [join(nnUNet_results, self.model_folder, f'fold_{fold}', self.checkpoint_name) for fold in self.use_folds]
+            cache.params = {'model_folder': self.model_folder, 'use_folds': list(self.use_folds), 'checkpoint_name': self.checkpoint_name,
+                            'checkpoints': [cache.content_hash(checkpoint) for checkpoint in checkpoints]}
+            self.stage_caches[output_dir] = cache
+        return self.stage_caches[output_dir]
+
+    def case_is_fresh(self, image_files: List[str] = None, output_file: str = None) -> bool:
+        cache = self.stage_cache(os.path.dirname(output_file))
+        return cache.is_fresh(output_file + self.predictor.dataset_json['file_ending'], cache.key(image_files, use_mirroring=self.use_mirroring))
+
+    def record_case(self, image_files: List[str] = None, output_file: str = None) -> None:
+        cache = self.stage_cache(os.path.dirname(output_file))
+        cache.record(output_file + self.predictor.dataset_json['file_ending'], cache.key(image_files, use_mirroring=self.use_mirroring))
+
+    def option_0001(self, input_dir: Union[str, List[List[str]]] = None, output_dir: Union[str, List[str]] = None,
+                    num_parts: int = 1, part_id: int = 0):
         # Guarantee the output directory exists
         if not isinstance(input_dir, list):
             if not os.path.exists(output_dir):
                 os.mkdir(output_dir)
 
+        # Predict only the outdated cases (of this shard, when sharded across nodes), from explicit lists of files
+        cases = self.list_cases(input_dir, output_dir, num_parts, part_id)
+        if not cases:
+            return
+        input_dir = [image_files for image_files, _ in cases]
+        output_dir = [output_file for _, output_file in cases]
+
         # Option 1 - Specified input and output folders
         self.predictor.predict_from_files(input_dir,
                                           output_dir,
-                                          save_probabilities=self.save_probabilities, overwrite=False,
+                                          save_probabilities=self.save_probabilities, overwrite=True,
                                           num_processes_preprocessing=2, num_processes_segmentation_export=2,
                                           folder_with_segs_from_prev_stage=None, num_parts=1, part_id=0)
 
+        for image_files, output_file in cases:
+            self.record_case(image_files, output_file)
+
 if __name__ == "__main__":
     input_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Batch 5 - nnUNet - TOTAL"
     output_dir = r"C:\Users\joshua.onichino\Dropbox\Head\Batch 5 - Cranial Anatomy 1"
@@ -0,0 +1,441 @@
+import argparse
+import heapq
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List
+
+import DCM_to_Model_Input
+import Masks_to_Aggregates
+import Aggregates_to_Filtered_Aggregates
+import Filtered_Aggregates_to_Statistics
+from DICOM_Index import DICOMIndex
+from Image_IO import NPY_ENDING, configure_compression, is_image_file, split_image_ending
+from Label_Registry import LabelRegistry
+from Profiling import enable_profiling, summarize_profile
+from Stage_Cache import enable_adoption
+
+# The eight stages of DCM_to_Statistics as a DAG over per-patient artifacts: stage -> (name, stages it depends on)
+STAGES = {
+    1: ('DICOM to NIfTI', ()),
+    2: ('DICOM to NRRD', ()),
+    3: ('TEMP masks', (2,)),
+    4: ('TOTAL masks', (1,)),
+    5: ('BS masks', (1,)),
+    6: ('Aggregates', (3, 4, 5)),
+    7: ('Filtered aggregates', (6,)),
+    8: ('Statistics', (7, 1)),
+}
+
+# Mask prediction stages run on the inference device, with their model from Model_Input_to_Masks.MODEL_CONFIGURATIONS
+MODEL_STAGES = {3: 'TEMP', 4: 'TOTAL', 5: 'BS'}
+
+# Classes suppressed in stage 7 by default. They are positions in the contiguous aggregate, so they name no global
+# label ID: with a label registry, nothing is suppressed unless --suppress names the classes
+DEFAULT_SUPPRESSED_CLASSES = [22, 28]
+
+def pipeline_paths(work_dir: str = None, output_csv: str = None) -> dict:
+    # Folder layout of one batch, named like the folders of DCM_to_Statistics
+    return {
+        'nifti': os.path.join(work_dir, 'nnUNet - NIfTI'),
+        'nrrd': os.path.join(work_dir, 'nnUNet - NRRD'),
+        'TEMP': os.path.join(work_dir, 'TEMP'),
+        'TOTAL': os.path.join(work_dir, 'TOTAL'),
+        'BS': os.path.join(work_dir, 'NEURO'),
+        'final_aggregates': os.path.join(work_dir, 'Aggregates - FINAL'),
+        'filtered': os.path.join(work_dir, 'Aggregates - FILTERED'),
+        'statistics': output_csv or os.path.join(work_dir, 'STATISTICS.csv'),
+    }
+
+# File endings of the aggregates and filtered aggregates, which only later stages read: NIfTI, or the memory-mappable
+# .npy intermediate format of Image_IO, which is read without decompressing
+INTERMEDIATE_ENDINGS = {'nifti': '.nii.gz', 'npy': NPY_ENDING}
+
+def stage_artifact(stage: int = None, patient_id: str = None, paths: dict = None, intermediate_ending: str = '.nii.gz') -> str:
+    # The file a stage produces for one patient
+    artifacts = {
+        1: os.path.join(paths['nifti'], f'{patient_id}_0000.nii.gz'),
+        2: os.path.join(paths['nrrd'], f'{patient_id}_0000.nrrd'),
+        3: os.path.join(paths['TEMP'], f'{patient_id}.nrrd'),
+        4: os.path.join(paths['TOTAL'], f'{patient_id}.nii.gz'),
+        5: os.path.join(paths['BS'], f'{patient_id}.nii.gz'),
+        6: os.path.join(paths['final_aggregates'], f'{patient_id}{intermediate_ending}'),
+        7: os.path.join(paths['filtered'], f'{patient_id}{intermediate_ending}'),
+        8: paths['statistics'],
+    }
+    return artifacts[stage]
+
+class PipelineTask(object):
+    # One unit of work: one or more stages (DICOM conversions are fused into one decode) for one patient
+    def __init__(self, stages: tuple = None, patient_id: str = None, order: int = 0) -> None:
+        self.stages = stages
+        self.patient_id = patient_id
+        self.order = order
+
+        self.dependencies = set()
+        self.dependents = set()
+        self.on_device = stages[0] in MODEL_STAGES
+
+    def priority(self) -> tuple:
+        # Later stages first, then patients in order, so that the first patients flow through to statistics early
+        return (-max(self.stages), self.order)
+
+    def __lt__(self, other: 'PipelineTask') -> bool:
+        return self.priority() < other.priority()
+
+    def __repr__(self) -> str:
+        return f'{self.patient_id}: {", ".join(STAGES[stage][0] for stage in self.stages)}'
+
+class PipelineRunner(object):
+    """
+    Runs the DCM_to_Statistics stages as a DAG over per-patient artifacts.
+
+    Every (stage, patient) pair is a task that starts as soon as the artifacts it depends on exist: a patient moves on
+    to aggregation and statistics as soon as its three masks are predicted, without waiting for the rest of the batch.
+    CPU stages run in a thread pool; mask prediction runs on the inference device, one model at a time, batching the
+    patients that are ready for the same model. Stages that are not selected are assumed to be done already, and a
+    patient is skipped for a stage whose unselected inputs are missing. Every stage keeps its stage cache, so
+    rerunning the pipeline only recomputes what is outdated. With a memory ceiling, aggregation, filtering and
+    statistics process each volume in z-slabs sized to keep every CPU task under it. With the 'npy' intermediate
+    format, the aggregates and filtered aggregates are written uncompressed and memory-mapped by the next stage
+    (Image_IO.py converts them to NIfTI for export). With radiomics features, the statistics are extracted with
+    PyRadiomics, radiomics_workers segments at a time per patient. With save_histograms, statistics also save the
+    per-label HU histograms of every patient next to its filtered mask (Label_Histograms.py queries them for the cohort).
+    With a statistics dataset, the rows go to a Parquet dataset partitioned by cohort, site and model instead of the CSV.
+    When `series` is set (see watch), only those patients are run, each converted from its own series folder and UID.
+    """
+    def __init__(self, dcm_dir: str = None, work_dir: str = None, stages: List[int] = None, num_workers: int = 4,
+                 device: str = 'GPU', classes_to_suppress: list = None, output_csv: str = None, device_batch_size: int = 8,
+                 cohort: str = 'NSP', site: str = 'JGH', modality: str = 'CT',
+                 model_name = 'TotalSegmentatorV2[total, brain_structures]_InHouseTemporalis', label_registry: LabelRegistry = None,
+                 max_memory_mb: float = None, intermediate_format: str = 'nifti', radiomics_features: dict = None,
+                 radiomics_workers: int = 1, save_histograms: bool = False, statistics_dataset: str = None) -> None:
+        self.dcm_dir = dcm_dir
+        self.work_dir = work_dir
+        self.stages = sorted(set(stages or STAGES))
+        self.num_workers = num_workers
+        self.device = device
+        self.label_registry = label_registry
+        self.classes_to_suppress = label_registry.resolve(classes_to_suppress) if label_registry is not None else classes_to_suppress
+        self.contiguous = label_registry is None
+        self.max_memory_mb = max_memory_mb
+        self.intermediate_ending = INTERMEDIATE_ENDINGS[intermediate_format]
+        self.radiomics_features = radiomics_features
+        self.radiomics_workers = radiomics_workers
+        self.save_histograms = save_histograms
+        self.statistics_dataset = statistics_dataset
+        self.device_batch_size = device_batch_size
+        self.row_columns = {'cohort': cohort, 'site': site, 'modality': modality, 'model_name': model_name}
+
+        self.paths = pipeline_paths(work_dir, output_csv)
+        for key, path in self.paths.items():
+            if key != 'statistics' and not os.path.exists(path):
+                os.makedirs(path)
+
+        # Stage caches are shared by all tasks of a stage, and are the same as those of the folder-level stages
+        self.conversion_caches = DCM_to_Model_Input.conversion_stage_caches({'nifti': self.paths['nifti'], 'nrrd': self.paths['nrrd']})
+        self.aggregate_cache = Masks_to_Aggregates.aggregate_stage_cache(self.paths['final_aggregates'], label_registry)
+        self.filter_cache = Aggregates_to_Filtered_Aggregates.filter_stage_cache(self.paths['filtered'], self.classes_to_suppress, self.contiguous)
+        self.statistics_writer = None
+        self.statistics_lock = threading.Lock()
+
+        # Patient -> (series folder, series UID) of the patients to run, instead of the <case>/DICOM/EXP00000 folders
+        self.series = None
+        self.failed_patients = set()
+
+    def artifact(self, stage: int = None, patient_id: str = None) -> str:
+        return stage_artifact(stage, patient_id, self.paths, self.intermediate_ending)
+
+    def patients(self) -> List[str]:
+        # Patients are the selected series, the DICOM case folders, or the converted images when the conversion stages are not run
+        if self.series is not None:
+            return sorted(self.series)
+        if self.dcm_dir is not None and os.path.isdir(self.dcm_dir):
+            return sorted(filename for filename in os.listdir(self.dcm_dir) if not filename.startswith('.'))
+        return sorted(split_image_ending(filename)[0][:-len('_0000')] for filename in os.listdir(self.paths['nifti'])
+                      if is_image_file(filename) and filename.endswith('_0000.nii.gz'))
+
+    def series_source(self, patient_id: str = None) -> tuple:
+        # The (series folder, series UID) a patient is converted from
+        if self.series is not None:
+            return self.series[patient_id]
+        return os.path.join(self.dcm_dir, patient_id, 'DICOM', 'EXP00000'), None
+
+    def build_tasks(self) -> List[PipelineTask]:
+        tasks = []
+        for order, patient_id in enumerate(self.patients()):
+            by_stage = {}
+            conversions = tuple(stage for stage in (1, 2) if stage in self.stages)
+            if conversions:
+                task = PipelineTask(conversions, patient_id, order)
+                tasks.append(task)
+                for stage in conversions:
+                    by_stage[stage] = task
+
+            for stage in self.stages:
+                if stage in (1, 2):
+                    continue
+                task = PipelineTask((stage,), patient_id, order)
+
+                # Depend on the selected upstream stages; unselected ones must already have produced their artifact
+                missing = [upstream for upstream in STAGES[stage][1]
+                           if upstream not in by_stage and not os.path.exists(self.artifact(upstream, patient_id))]
+                if missing:
+                    print(f'{patient_id}: skipping {STAGES[stage][0]}, missing {", ".join(STAGES[m][0] for m in missing)}')
+                    continue
+
+                for upstream in STAGES[stage][1]:
+                    if upstream in by_stage:
+                        task.dependencies.add(by_stage[upstream])
+                        by_stage[upstream].dependents.add(task)
+                tasks.append(task)
+                by_stage[stage] = task
+        return tasks
+
+    def run(self) -> int:
+        """
+        Runs every selected stage for every patient, returns the number of failed tasks.
+        """
+        tasks = self.build_tasks()
+        if 8 in self.stages:
+            self.statistics_writer = Filtered_Aggregates_to_Statistics.open_statistics_writer(
+                self.paths['statistics'], self.statistics_dataset,
+                columns=Filtered_Aggregates_to_Statistics.StatisticsCSVWriter.columns_for(self.label_registry is not None, self.radiomics_features),
+                partition={'cohort': self.row_columns['cohort'], 'site': self.row_columns['site'], 'model_name': self.row_columns['model_name']})
+
+        ready = [task for task in tasks if not task.dependencies]
+        heapq.heapify(ready)
+        device_ready = {}
+        running = {}
+        device_busy = False
+        failures = []
+        dropped = set()
+
+        def complete(task: PipelineTask) -> None:
+            for dependent in task.dependents:
+                dependent.dependencies.discard(task)
+                if not dependent.dependencies:
+                    heapq.heappush(ready, dependent)
+
+        def fail(task: PipelineTask, error: Exception) -> None:
+            # Everything downstream of a failed task is dropped for this patient (it never becomes ready)
+            print(f'{task} failed: {error!r}')
+            failures.append(task)
+            stack = list(task.dependents)
+            while stack:
+                dependent = stack.pop()
+                if dependent not in dropped:
+                    dropped.add(dependent)
+                    stack.extend(dependent.dependents)
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as cpu_pool, ThreadPoolExecutor(max_workers=1) as device_pool:
+            while ready or running or any(device_ready.values()):
+                # Hand out every ready CPU task, and park the device tasks by model
+                while ready:
+                    task = heapq.heappop(ready)
+                    if task.on_device:
+                        device_ready.setdefault(task.stages[0], []).append(task)
+                    else:
+                        running[cpu_pool.submit(self.run_task, task)] = [task]
+
+                # Keep the device busy with a batch of the model that has waited the longest
+                if not device_busy and any(device_ready.values()):
+                    stage = min((waiting[0].order, stage) for stage, waiting in device_ready.items() if waiting)[1]
+                    batch = device_ready[stage][:self.device_batch_size]
+                    device_ready[stage] = device_ready[stage][self.device_batch_size:]
+                    running[device_pool.submit(self.run_device_batch, stage, batch)] = batch
+                    device_busy = True
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = running.pop(future)
+                    if batch[0].on_device:
+                        device_busy = False
+                    try:
+                        future.result()
+                    except Exception as error:
+                        for task in batch:
+                            fail(task, error)
+                        continue
+                    for task in batch:
+                        complete(task)
+
+        if self.statistics_writer is not None:
+            self.statistics_writer.close()
+        self.failed_patients = {task.patient_id for task in failures}
+
+        print(f'Pipeline finished: {len(tasks) - len(failures) - len(dropped)} tasks done, {len(failures)} failed, '
+              f'{len(dropped)} skipped downstream of a failure')
+        return len(failures)
+
+    def run_task(self, task: PipelineTask) -> None:
+        patient_id = task.patient_id
+        stage = task.stages[0]
+
+        if stage in (1, 2):
+            # Decode the series once for every selected format
+            output_dirs = {'nifti': self.paths['nifti']} if 1 in task.stages else {}
+            if 2 in task.stages:
+                output_dirs['nrrd'] = self.paths['nrrd']
+            dcm_dir, series_uid = self.series_source(patient_id)
+            outdated = DCM_to_Model_Input.outdated_outputs(dcm_dir, patient_id, output_dirs,
+                                                           {desired: self.conversion_caches[desired] for desired in output_dirs}, series_uid)
+            if outdated:
+                DCM_to_Model_Input.convert_DCM_series(dcm_dir, [nnUNet_file for _, nnUNet_file, _ in outdated], series_uid)
+                DCM_to_Model_Input.record_outputs(outdated)
+
+        elif stage == 6:
+            Masks_to_Aggregates.aggregate_case([self.artifact(mask_stage, patient_id) for mask_stage in (4, 5, 3)],
+                                               self.artifact(6, patient_id), self.aggregate_cache, self.label_registry,
+                                               self.max_memory_mb)
+
+        elif stage == 7:
+            Aggregates_to_Filtered_Aggregates.filter_case(self.artifact(6, patient_id), self.artifact(7, patient_id),
+                                                          self.classes_to_suppress, self.filter_cache, self.contiguous, self.max_memory_mb)
+
+        elif stage == 8:
+            if patient_id in self.statistics_writer.completed:
+                return
+            rows = Filtered_Aggregates_to_Statistics.patient_statistics_rows(patient_id, self.artifact(7, patient_id),
+                                                                             self.artifact(1, patient_id), **self.row_columns,
+                                                                             segment_names=self.label_registry.names() if self.label_registry else None,
+                                                                             max_memory_mb=self.max_memory_mb,
+                                                                             radiomics_features=self.radiomics_features,
+                                                                             radiomics_workers=self.radiomics_workers,
+                                                                             save_histograms=self.save_histograms)
+            with self.statistics_lock:
+                self.statistics_writer.write_patient(patient_id, rows)
+
+    def run_device_batch(self, stage: int = None, batch: List[PipelineTask] = None) -> None:
+        # Imported here so that the CPU-only stages can run without the nnU-Net / torch stack
+        import Model_Input_to_Masks
+
+        # The batch goes through the shared mask scheduler, with the patients of the batch as explicit file lists
+        model = MODEL_STAGES[stage]
+        input_stage = STAGES[stage][1][0]
+        job = dict(Model_Input_to_Masks.MODEL_CONFIGURATIONS[model],
+                   input_dir=[[self.artifact(input_stage, task.patient_id)] for task in batch],
+                   output_dir=[os.path.join(self.paths[model], task.patient_id) for task in batch])
+        Model_Input_to_Masks.Model_Inputs_to_Masks([job], self.device)
+
+def watch(runner: PipelineRunner = None, index: DICOMIndex = None, poll_seconds: float = 30, quiet_seconds: float = 60,
+          modality: str = 'CT', min_slices: int = 20, once: bool = False) -> None:
+    """
+    Incremental ingestion: polls the watch folder through its DICOM index, and runs the pipeline for the studies whose
+    series are complete (unchanged for quiet_seconds) and were not ingested yet, with the selected series of each.
+
+    Parameters:
+    - runner: PipelineRunner, the runner of the batch (its work folder accumulates every ingested patient).
+    - index: DICOMIndex, the index of the watch folder.
+    - poll_seconds: float, the time between two scans.
+    - quiet_seconds: float, how long the files of a case must be unchanged before it is ingested.
+    - modality, min_slices: the series to select in each study (see DICOM_Index.select_series).
+    - once: bool, scan and run once instead of polling forever.
+    """
+    while True:
+        start = time.perf_counter()
+        changes = index.scan(quiet_seconds)
+        selected = index.ready_series(quiet_seconds, modality, min_slices)
+        if changes or selected:
+            print(f'Scan: {changes} files changed, {len(selected)} new studies ready ({time.perf_counter() - start:.2f} s)')
+
+        if selected:
+            runner.series = {series['patient_id']: (series['directory'], series['series_uid']) for series in selected}
+            runner.run()
+            # Failed studies are recorded too, and are queued again only once forgotten (DICOM_Index.py --forget)
+            for series in selected:
+                index.mark_ingested(series, 'failed' if series['patient_id'] in runner.failed_patients else 'done')
+
+        if once:
+            return
+        time.sleep(poll_seconds)
+
+def parse_stages(values: List[str] = None) -> List[int]:
+    # Accepts stage numbers and ranges, e.g. ['1-5', '8']
+    stages = set()
+    for value in values or []:
+        for part in value.split(','):
+            if '-' in part:
+                first, last = part.split('-')
+                stages.update(range(int(first), int(last) + 1))
+            elif part:
+                stages.add(int(part))
+    unknown = stages - set(STAGES)
+    if unknown:
+        raise argparse.ArgumentTypeError(f'Unknown stages {sorted(unknown)}, expected 1-8')
+    return sorted(stages)
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='Run the DICOM to statistics pipeline, or a subset of its stages, per patient.',
+                                     epilog='Stages: ' + '; '.join(f'{stage} = {name}' for stage, (name, _) in STAGES.items()))
+    parser.add_argument('--dcm-dir', help='folder with one <case>/DICOM/EXP00000 series per patient (needed for stages 1-2), or the watch folder')
+    parser.add_argument('--watch', action='store_true', help='ingest new studies of the DICOM folder as they arrive, in any layout (needs --index)')
+    parser.add_argument('--index', help='DICOM index file of the watch folder (see DICOM_Index.py)')
+    parser.add_argument('--poll-seconds', type=float, default=30, help='time between two scans of the watch folder')
+    parser.add_argument('--quiet-seconds', type=float, default=60, help='a case is ingested once its files are unchanged for this long')
+    parser.add_argument('--min-slices', type=int, default=20, help='smallest series selected in a study (skips localizers)')
+    parser.add_argument('--once', action='store_true', help='with --watch, scan and run once, then exit')
+    parser.add_argument('--work-dir', required=True, help='folder that holds the intermediate folders of the batch')
+    parser.add_argument('--stages', nargs='*', default=['1-8'], help='stages to run, e.g. 1-8 (default) or 6 7 8')
+    parser.add_argument('--workers', type=int, default=4, help='CPU stage tasks run concurrently')
+    parser.add_argument('--device', default='GPU', choices=['GPU', 'CPU'], help='inference device for stages 3-5')
+    parser.add_argument('--device-batch-size', type=int, default=8, help='patients per mask prediction call')
+    parser.add_argument('--suppress', nargs='*',
+                        help='aggregate classes suppressed in stage 7 (default 22 28; with a label registry, global IDs or MODEL:name, and none by default)')
+    parser.add_argument('--label-registry', help='label registry file (see Label_Registry.py): aggregate with fixed global label IDs')
+    parser.add_argument('--max-memory-mb', type=float, help='memory ceiling per CPU task: stages 6-8 then process each volume in z-slabs')
+    parser.add_argument('--intermediate-format', default='nifti', choices=sorted(INTERMEDIATE_ENDINGS),
+                        help='format of the aggregates and filtered aggregates (npy: uncompressed, memory-mapped by the next stage)')
+    parser.add_argument('--compression-level', type=int, help='compression level of every compressed output, 1 (fastest) to 9 (smallest)')
+    parser.add_argument('--compression-threads', type=int, help='threads that compress each .nii.gz output (parallel gzip)')
+    parser.add_argument('--radiomics', nargs='+', metavar='CLASS[:FEATURE,...]',
+                        help='extract the statistics with PyRadiomics, with these feature classes (e.g. firstorder shape glcm:Contrast,Correlation)')
+    parser.add_argument('--radiomics-workers', type=int, default=1, help='segments extracted in parallel per patient with PyRadiomics')
+    parser.add_argument('--histograms', action='store_true', help='also save the per-label HU histograms in stage 8, next to the filtered masks (see Label_Histograms.py)')
+    parser.add_argument('--statistics-dataset', help='write the statistics to this Parquet dataset folder instead of a CSV (see Statistics_Store.py)')
+    parser.add_argument('--output-csv', help='statistics CSV (default: <work-dir>/STATISTICS.csv)')
+    parser.add_argument('--cohort', default='NSP')
+    parser.add_argument('--site', default='JGH')
+    parser.add_argument('--modality', default='CT')
+    parser.add_argument('--adopt-existing-outputs', action='store_true',
+                        help='one-off migration: take the existing outputs that no stage manifest records as up to date instead of recomputing them')
+    parser.add_argument('--profile', help='append per-stage, per-patient timings to this JSON lines log and print a summary')
+    args = parser.parse_args(argv)
+
+    stages = parse_stages(args.stages)
+    if {1, 2} & set(stages) and not args.dcm_dir:
+        parser.error('--dcm-dir is required to run stages 1-2')
+    if args.watch and not (args.dcm_dir and args.index and {1, 2} & set(stages)):
+        parser.error('--watch needs --dcm-dir, --index and the conversion stages')
+
+    label_registry = LabelRegistry.load(args.label_registry) if args.label_registry else None
+    if args.suppress is None:
+        classes_to_suppress = [] if label_registry is not None else DEFAULT_SUPPRESSED_CLASSES
+    else:
+        classes_to_suppress = args.suppress if label_registry is not None else [int(cls) for cls in args.suppress]
+
+    runner = PipelineRunner(args.dcm_dir, args.work_dir, stages, args.workers, args.device, classes_to_suppress, args.output_csv,
+                            args.device_batch_size, args.cohort, args.site, args.modality, label_registry=label_registry,
+                            max_memory_mb=args.max_memory_mb, intermediate_format=args.intermediate_format,
+                            radiomics_features=Filtered_Aggregates_to_Statistics.parse_radiomics_features(args.radiomics) if args.radiomics else None,
+                            radiomics_workers=args.radiomics_workers, save_histograms=args.histograms,
+                            statistics_dataset=args.statistics_dataset)
+    configure_compression(args.compression_level, args.compression_threads)
+    enable_adoption(args.adopt_existing_outputs)
+    if args.profile:
+        enable_profiling(args.profile)
+    if args.watch:
+        with DICOMIndex(args.index, args.dcm_dir) as index:
+            watch(runner, index, args.poll_seconds, args.quiet_seconds, args.modality, args.min_slices, args.once)
+        return 1 if runner.failed_patients else 0
+    failures = runner.run()
+    if args.profile and os.path.exists(args.profile):
+        print(summarize_profile(args.profile).to_string(float_format='{:.3f}'.format))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+import argparse
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List
+
+import pandas as pd
+
+# Profiling is switched on by this environment variable (the path of the JSON lines log), so that worker processes
+# started by the process pools of the stages inherit it
+PROFILE_LOG_VARIABLE = 'PIPELINE_PROFILE_LOG'
+
+_LOG_LOCK = threading.Lock()
+_CONTEXT = threading.local()
+
+def enable_profiling(log_path: str = None) -> None:
+    """
+    Records every profiled stage call of this process and of the worker processes it starts to log_path.
+    """
+    os.environ[PROFILE_LOG_VARIABLE] = os.path.abspath(log_path)
+
+def disable_profiling() -> None:
+    os.environ.pop(PROFILE_LOG_VARIABLE, None)
+
+def profiling_enabled() -> bool:
+    return bool(os.environ.get(PROFILE_LOG_VARIABLE))
+
+def profiled_stage(stage: str = None, patient_argument: str = None) -> Callable:
+    """
+    Decorator that records one structured log entry per call of a stage function: patient, wall time, CPU time,
+    memory, bytes read and written, and the same measures for every phase (read, resample, relabel, compute,
+    write, ...) opened inside the call with `phase`. Does nothing unless profiling is enabled.
+
+    Memory is the change of the resident memory of the process over the call (rss_delta_mb, sampled at entry and
+    exit, so temporaries freed before the call returns are not counted), and the high-water mark of the whole
+    process so far (process_peak_rss_mb), which is not per patient: it repeats the largest patient of the worker.
+    CPU time (cpu_s) is that of the whole process, so it includes the threads a stage starts (ITK filters, GDCM
+    decoding, parallel gzip), but not its worker processes (e.g. those of PyRadiomics extraction). The CPU and memory figures also include the stages running
+    concurrently in other threads of the process.
+
+    Parameters:
+    - stage: str, the stage name written to the log.
+    - patient_argument: str (optional), the argument whose file name names the patient (default: the first path argument).
+    """
+    def decorator(function: Callable) -> Callable:
+        parameters = list(inspect.signature(function).parameters)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiling_enabled():
+                return function(*args, **kwargs)
+
+            arguments = dict(zip(parameters, args), **kwargs)
+            if patient_argument is not None:
+                arguments = {patient_argument: arguments.get(patient_argument)}
+            record = {'stage': stage, 'patient_id': patient_from_arguments(arguments), 'pid': os.getpid(), 'phases': {}}
+            # Each call on the stack keeps the phases open inside it, so that its bytes go to its own phases
+            stack = context_stack()
+            stack.append((record, []))
+            start_wall, start_cpu = time.perf_counter(), time.process_time()
+            start_rss = current_rss_bytes()
+            record['bytes_read'] = record['bytes_written'] = 0
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stack.pop()
+                record['wall_s'] = time.perf_counter() - start_wall
+                record['cpu_s'] = time.process_time() - start_cpu
+                record['rss_delta_mb'] = (current_rss_bytes() - start_rss) / 2 ** 20
+                record['process_peak_rss_mb'] = peak_rss_bytes() / 2 ** 20
+                record['time'] = time.time()
+                write_record(record)
+        return wrapper
+    return decorator
+
+@contextmanager
+def phase(name: str = None):
+    """
+    Times one phase of the innermost profiled stage call of this thread; nested phases are timed independently.
+    Repeated phases of the same name within one call are summed.
+    """
+    stack = context_stack()
+    if not stack:
+        yield
+        return
+
+    record, phases = stack[-1]
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    phases.append(name)
+    try:
+        yield
+    finally:
+        phases.pop()
+        entry = record['phases'].setdefault(name, {'wall_s': 0.0, 'cpu_s': 0.0, 'bytes_read': 0, 'bytes_written': 0})
+        entry['wall_s'] += time.perf_counter() - start_wall
+        entry['cpu_s'] += time.process_time() - start_cpu
+
+def record_io(direction: str = 'read', n_bytes: int = 0) -> None:
+    # Credits bytes read or written to the innermost stage call and to the innermost phase opened inside that call
+    # (not one opened by an enclosing call), called by the Image_IO helpers
+    stack = context_stack()
+    if not stack:
+        return
+    record, phases = stack[-1]
+    record[f'bytes_{direction}'] += n_bytes
+    if phases:
+        entry = record['phases'].setdefault(phases[-1], {'wall_s': 0.0, 'cpu_s': 0.0, 'bytes_read': 0, 'bytes_written': 0})
+        entry[f'bytes_{direction}'] += n_bytes
+
+def context_stack() -> list:
+    if not hasattr(_CONTEXT, 'stack'):
+        _CONTEXT.stack = []
+    return _CONTEXT.stack
+
+def patient_from_arguments(arguments: dict) -> str:
+    # The patient is named by the first path argument of the stage: /a/b/PATIENT_0000.nii.gz -> PATIENT
+    for value in arguments.values():
+        if isinstance(value, (list, tuple)) and value:
+            value = value[0]
+        if isinstance(value, str) and (os.sep in value or '.' in value):
+            name = os.path.basename(value.rstrip(os.sep)).split('.')[0]
+            return name[:-len('_0000')] if name.endswith('_0000') else name
+    return None
+
+def current_rss_bytes() -> int:
+    # Resident memory of this process now
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return 0
+
+def peak_rss_bytes() -> int:
+    # High-water mark of the resident memory of this process over its whole lifetime (not per stage call)
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)
+    except ImportError:
+        return 0
+
+def write_record(record: dict) -> None:
+    log_path = os.environ.get(PROFILE_LOG_VARIABLE)
+    if not log_path:
+        return
+    with _LOG_LOCK:
+        with open(log_path, 'a') as log:
+            log.write(json.dumps(record) + '\n')
+
+def load_profile(log_path: str = None) -> tuple:
+    """
+    Loads a profile log as two DataFrames: one row per stage call, and one row per phase of each call.
+    """
+    calls, phases = [], []
+    with open(log_path, 'r') as log:
+        for line in log:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            for name, measures in record.pop('phases', {}).items():
+                phases.append(dict(measures, stage=record['stage'], patient_id=record['patient_id'], phase=name))
+            calls.append(record)
+    return pd.DataFrame(calls), pd.DataFrame(phases)
+
+def summarize_profile(log_path: str = None, percentiles: List[float] = (0.5, 0.9, 0.99)) -> pd.DataFrame:
+    """
+    Summarizes a profile log: count, total and percentiles of wall time per stage and per phase, with the mean
+    CPU time, bytes read and written, the largest resident memory growth of a call (max_rss_delta_mb) and the
+    largest process high-water mark seen by the stage (process_peak_rss_mb, a process-wide figure, not per patient).
+    """
+    calls, phases = load_profile(log_path)
+    if calls.empty:
+        return pd.DataFrame()
+
+    calls = calls.assign(phase='(total)')
+    rows = pd.concat([calls, phases], ignore_index=True) if not phases.empty else calls
+
+    summary = rows.groupby(['stage', 'phase'])['wall_s'].describe(percentiles=list(percentiles))
+    summary = summary.drop(columns=['mean', 'std', 'min'])
+    summary.insert(1, 'total_s', rows.groupby(['stage', 'phase'])['wall_s'].sum())
+    summary['mean_cpu_s'] = rows.groupby(['stage', 'phase'])['cpu_s'].mean()
+    summary['mean_mb_read'] = rows.groupby(['stage', 'phase'])['bytes_read'].mean() / 2 ** 20
+    summary['mean_mb_written'] = rows.groupby(['stage', 'phase'])['bytes_written'].mean() / 2 ** 20
+    stages = summary.index.get_level_values('stage')
+    for column, summary_column in (('rss_delta_mb', 'max_rss_delta_mb'), ('process_peak_rss_mb', 'process_peak_rss_mb')):
+        if column in calls:
+            summary[summary_column] = calls.groupby('stage')[column].max().reindex(stages).values
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the per-stage and per-phase summary of a profile log.')
+    parser.add_argument('log_path')
+    parser.add_argument('--csv', help='also save the summary as CSV')
+    args = parser.parse_args()
+
+    summary = summarize_profile(args.log_path)
+    print(summary.to_string(float_format='{:.3f}'.format))
+    if args.csv:
+        summary.to_csv(args.csv)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Iterable
+
+# Name of the manifest kept in every output folder (hidden, so folder listings of images skip it)
+MANIFEST_NAME = '.manifest.jsonl'
+
+# Adoption of unrecorded outputs is switched on by this environment variable, so that worker processes inherit it
+ADOPT_OUTPUTS_VARIABLE = 'PIPELINE_ADOPT_UNRECORDED_OUTPUTS'
+
+class StageCache(object):
+    """
+    Manifest-backed cache of the outputs of one stage in one output folder.
+
+    Each output is recorded with a key: a hash of the stage name, its parameters (model folder, folds, suppressed
+    classes, output format, ...) and the content of its inputs. An output is only reused when its key is unchanged
+    and the file is still the one that was recorded, so a changed parameter, checkpoint or upstream mask recomputes
+    exactly the affected outputs, and downstream stages follow because their inputs' content changed.
+
+    Content hashes are memoized by (size, modification time), so unchanged inputs are hashed once. The manifest is
+    append-only JSON lines (the last entry for a path wins), so recording one output costs one small append.
+    Directories (e.g. DICOM series) are fingerprinted from the names, sizes and modification times of their files.
+
+    Outputs written before a folder had a manifest are recomputed, since nothing says which inputs, parameters or
+    checkpoints they came from. The one-off migration `enable_adoption` instead records them as they are.
+    """
+    def __init__(self, output_dir: str = None, stage: str = None, params: dict = None) -> None:
+        self.output_dir = output_dir
+        self.stage = stage
+        self.params = params or {}
+
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.outputs = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+        # Replay the manifest
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest:
+                for line in manifest:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line from a crash
+                    if entry.get('type') == 'output':
+                        self.outputs[entry['path']] = entry
+                    elif entry.get('type') == 'hash':
+                        self.hashes[entry['path']] = entry
+
+    def key(self, inputs: Iterable[str] = (), **extra_params) -> str:
+        # Hash of the stage, its parameters and the content of every input
+        description = {'stage': self.stage,
+                       'params': dict(self.params, **extra_params),
+                       'inputs': [self.content_hash(path) for path in inputs]}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def is_fresh(self, output_path: str = None, key: str = None) -> bool:
+        # The output exists, was recorded with the same key, and has not been modified since
+        entry = self.outputs.get(os.path.basename(output_path))
+        if entry is None and adoption_enabled() and os.path.exists(output_path):
+            self.record(output_path, key)
+            return True
+        if entry is None or entry['key'] != key or not os.path.exists(output_path):
+            return False
+        return entry['stat'] == file_stat(output_path)
+
+    def record(self, output_path: str = None, key: str = None) -> None:
+        entry = {'type': 'output', 'path': os.path.basename(output_path), 'key': key, 'stat': file_stat(output_path)}
+        self.append(entry)
+        self.outputs[entry['path']] = entry
+
+    def content_hash(self, path: str = None) -> str:
+        if path is None or not os.path.exists(path):
+            return None
+        if os.path.isdir(path):
+            return directory_fingerprint(path)
+
+        # Reuse the memoized hash while the file is unchanged
+        path = os.path.abspath(path)
+        stat = file_stat(path)
+        entry = self.hashes.get(path)
+        if entry is not None and entry['stat'] == stat:
+            return entry['sha256']
+
+        entry = {'type': 'hash', 'path': path, 'stat': stat, 'sha256': file_sha256(path)}
+        self.append(entry)
+        self.hashes[path] = entry
+        return entry['sha256']
+
+    def append(self, entry: dict) -> None:
+        with self.lock:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(self.manifest_path, 'a') as manifest:
+                manifest.write(json.dumps(entry) + '\n')
+                manifest.flush()
+                os.fsync(manifest.fileno())
+
+def enable_adoption(enabled: bool = True) -> None:
+    """
+    Migration from the outputs of a version without stage manifests, for this process and the workers it starts:
+    every existing output that no manifest records is taken as fresh and recorded under the current key, whatever
+    inputs, parameters or checkpoints it was actually computed with. Only use it when they are known to match.
+    """
+    if enabled:
+        os.environ[ADOPT_OUTPUTS_VARIABLE] = '1'
+    else:
+        os.environ.pop(ADOPT_OUTPUTS_VARIABLE, None)
+
+def adoption_enabled() -> bool:
+    return bool(os.environ.get(ADOPT_OUTPUTS_VARIABLE))
+
+def file_stat(path: str = None) -> list:
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def file_sha256(path: str = None, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def directory_fingerprint(path: str = None) -> str:
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for filename in sorted(files):
+            file_path = os.path.join(root, filename)
+            digest.update(f'{os.path.relpath(file_path, path)}|{file_stat(file_path)}\n'.encode('utf-8'))
+    return digest.hexdigest()
@@ -0,0 +1,222 @@
+import argparse
+import os
+import threading
+from typing import Iterable, List, Union
+from urllib.parse import quote, unquote
+
+import pandas as pd
+
+# Partition columns of the statistics dataset, outermost first: <dataset>/cohort=NSP/site=JGH/model_name=.../<patient>.parquet
+PARTITION_COLUMNS = ('cohort', 'site', 'model_name')
+
+# Repeated string columns, stored dictionary-encoded (pandas categoricals when read)
+DICTIONARY_COLUMNS = ('cohort', 'site', 'modality', 'model_name', 'patient_id', 'series_description', 'segment_feature', 'segment_name')
+
+# File ending of the patient files, and of the markers of patients that have no segments
+PATIENT_FILE_ENDING = '.parquet'
+EMPTY_PATIENT_ENDING = '.empty'
+
+class ParquetStatisticsWriter(object):
+    """
+    Statistics sink that writes a Parquet dataset instead of a flat CSV, with the interface of StatisticsCSVWriter.
+
+    Every patient is one Parquet file in a hive-style partition folder per cohort, site and model, so batches written
+    to the same dataset folder combine without concatenating anything, and a query for a site, model or patient only
+    opens the files of that partition or patient (see query_statistics). The repeated string columns are
+    dictionary-encoded. Patient files are written atomically, so a patient whose file exists is complete: resuming
+    lists the files of the partition the run writes to (or of the whole dataset) instead of reading a progress sidecar.
+
+    Requires pyarrow.
+    """
+    def __init__(self, dataset_dir: str = None, resume: bool = True, columns: list = None, partition: dict = None) -> None:
+        """
+        Parameters:
+        - dataset_dir: str, the dataset folder, shared by every batch.
+        - resume: bool, skip the patients already written by a previous run (default True).
+        - columns: list of str, the statistics columns (those of StatisticsCSVWriter).
+        - partition: dict (optional), the cohort, site and model_name of the run, so that resuming only considers the
+          patients of that partition (the same patient IDs may exist in other batches).
+        """
+        import pyarrow as pa
+
+        self.dataset_dir = dataset_dir
+        self.columns = list(columns)
+        self.schema = pa.schema([(column, column_type(column)) for column in self.columns if column not in PARTITION_COLUMNS])
+        self.scope_dir = partition_dir(dataset_dir, partition) if partition is not None else dataset_dir
+        os.makedirs(self.scope_dir, exist_ok=True)
+
+        # Recover the completed patients (or start over: their files are replaced as they are rewritten)
+        self.completed = set(completed_patients(self.scope_dir)) if resume else set()
+
+    def write_patient(self, patient_id: str = None, rows: list = None) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not rows:
+            # Marker file, so a patient without segments is not recomputed on resume
+            open(os.path.join(self.scope_dir, f'.{patient_id}{EMPTY_PATIENT_ENDING}'), 'w').close()
+            self.completed.add(patient_id)
+            return
+
+        # One file per partition the rows fall in (normally a single one)
+        df = pd.DataFrame(rows, columns=self.columns)
+        for partition, partition_rows in df.groupby(list(PARTITION_COLUMNS), sort=False, dropna=False):
+            directory = partition_dir(self.dataset_dir, dict(zip(PARTITION_COLUMNS, partition)))
+            os.makedirs(directory, exist_ok=True)
+            table = pa.Table.from_pandas(partition_rows.drop(columns=list(PARTITION_COLUMNS)), schema=self.schema, preserve_index=False)
+
+            output_path = os.path.join(directory, f'{patient_id}{PATIENT_FILE_ENDING}')
+            temporary_path = os.path.join(directory, f'.{patient_id}.tmp-{os.getpid()}-{threading.get_ident()}{PATIENT_FILE_ENDING}')
+            try:
+                pq.write_table(table, temporary_path, use_dictionary=[column for column in DICTIONARY_COLUMNS if column in table.column_names])
+                os.replace(temporary_path, output_path)
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+        self.completed.add(patient_id)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+def column_type(column: str = None):
+    # Arrow type of a statistics column: dictionary-encoded strings, integer segment IDs, float features
+    import pyarrow as pa
+    if column in DICTIONARY_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    if column == 'segment':
+        return pa.int64()
+    return pa.float64()
+
+def partition_dir(dataset_dir: str = None, partition: dict = None) -> str:
+    # Partition values are URI-encoded (model names contain brackets, commas and spaces), as pyarrow decodes them
+    return os.path.join(dataset_dir, *[f'{column}={quote(str(partition[column]), safe="")}' for column in PARTITION_COLUMNS])
+
+def completed_patients(dataset_dir: str = None) -> List[str]:
+    patients = []
+    for directory, _, filenames in os.walk(dataset_dir):
+        for filename in filenames:
+            if filename.endswith(PATIENT_FILE_ENDING) and not filename.startswith('.'):
+                patients.append(filename[:-len(PATIENT_FILE_ENDING)])
+            elif filename.startswith('.') and filename.endswith(EMPTY_PATIENT_ENDING):
+                patients.append(filename[1:-len(EMPTY_PATIENT_ENDING)])
+    return patients
+
+def statistics_files(dataset_dir: str = None, cohort: Union[str, list] = None, site: Union[str, list] = None,
+                     model_name: Union[str, list] = None, patient_ids: Union[str, list] = None) -> List[str]:
+    """
+    The patient files of a statistics dataset in the given partitions and of the given patients, found from the folder
+    and file names alone (None selects everything).
+    """
+    selected = {'cohort': as_set(cohort), 'site': as_set(site), 'model_name': as_set(model_name)}
+    patient_ids = as_set(patient_ids)
+
+    directories = [dataset_dir]
+    for column in PARTITION_COLUMNS:
+        prefix = f'{column}='
+        directories = [os.path.join(directory, name) for directory in directories if os.path.isdir(directory)
+                       for name in sorted(os.listdir(directory))
+                       if name.startswith(prefix) and (selected[column] is None or unquote(name[len(prefix):]) in selected[column])]
+
+    files = []
+    for directory in directories:
+        if patient_ids is not None:
+            files.extend(path for path in (os.path.join(directory, f'{patient_id}{PATIENT_FILE_ENDING}') for patient_id in sorted(patient_ids))
+                         if os.path.exists(path))
+        else:
+            files.extend(os.path.join(directory, name) for name in sorted(os.listdir(directory))
+                         if name.endswith(PATIENT_FILE_ENDING) and not name.startswith('.'))
+    return files
+
+def query_statistics(dataset_dir: str = None, cohort: Union[str, list] = None, site: Union[str, list] = None,
+                     model_name: Union[str, list] = None, patient_ids: Union[str, list] = None, segments: Iterable[int] = None,
+                     segment_names: Union[str, list] = None, columns: list = None) -> pd.DataFrame:
+    """
+    Reads the statistics rows that match every given filter from a dataset written by ParquetStatisticsWriter, e.g.
+    query_statistics(dataset_dir, site='JGH', segment_names='TOTAL:brainstem', columns=['patient_id', 'volume']).
+
+    Cohort, site, model and patient filters select files by their paths, so only the matching files are opened; the
+    segment filters are pushed down to the Parquet reader.
+
+    Parameters:
+    - dataset_dir: str, the dataset folder.
+    - cohort, site, model_name, patient_ids: str or list of str (optional), the values to keep.
+    - segments: list of int (optional), the segment IDs to keep.
+    - segment_names: str or list of str (optional), the segment names to keep (datasets written with a label registry).
+    - columns: list of str (optional), the columns to read (default all, partition columns included).
+
+    Returns:
+    - statistics: pd.DataFrame, with the string columns as categoricals.
+    """
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    files = statistics_files(dataset_dir, cohort, site, model_name, patient_ids)
+    if not files:
+        return pd.DataFrame(columns=columns)
+
+    partitioning = ds.HivePartitioning.discover(infer_dictionary=True, segment_encoding='uri')
+    dataset = ds.dataset(files, format='parquet', partitioning=partitioning, partition_base_dir=dataset_dir)
+
+    expression = None
+    for column, values in (('segment', as_set(segments)), ('segment_name', as_set(segment_names))):
+        if values is not None:
+            condition = pc.field(column).isin(sorted(values))
+            expression = condition if expression is None else expression & condition
+
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+def import_csv(csv_path: str = None, dataset_dir: str = None, resume: bool = True) -> int:
+    """
+    Adds the rows of a statistics CSV (e.g. from a run before the dataset existed) to a dataset, one file per patient.
+    Returns the number of patients written.
+    """
+    df = pd.read_csv(csv_path, dtype={column: str for column in DICTIONARY_COLUMNS})
+    writer = ParquetStatisticsWriter(dataset_dir, resume=resume, columns=list(df.columns))
+    written = 0
+    with writer:
+        for patient_id, patient_rows in df.groupby('patient_id', sort=False):
+            patient_id = str(patient_id)
+            if patient_id in writer.completed:
+                continue
+            writer.write_patient(patient_id, patient_rows.to_dict('records'))
+            written += 1
+    return written
+
+def as_set(values: Union[str, int, Iterable] = None) -> set:
+    # None (no filter), one value or several values, as a set of values
+    if values is None:
+        return None
+    if isinstance(values, (str, int)):
+        return {values}
+    return set(values)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query a Parquet statistics dataset, or import statistics CSVs into one.')
+    parser.add_argument('dataset_dir')
+    parser.add_argument('--import-csv', nargs='*', default=[], help='statistics CSVs to add to the dataset')
+    parser.add_argument('--cohort', nargs='*')
+    parser.add_argument('--site', nargs='*')
+    parser.add_argument('--model-name', nargs='*')
+    parser.add_argument('--patient-id', nargs='*')
+    parser.add_argument('--segment', nargs='*', type=int)
+    parser.add_argument('--segment-name', nargs='*')
+    parser.add_argument('--columns', nargs='*')
+    parser.add_argument('--output-csv', help='write the query result to this CSV instead of printing it')
+    args = parser.parse_args()
+
+    for csv_path in args.import_csv:
+        print(f'{csv_path}: {import_csv(csv_path, args.dataset_dir)} patients imported')
+
+    if not args.import_csv or any([args.cohort, args.site, args.model_name, args.patient_id, args.segment, args.segment_name]):
+        result = query_statistics(args.dataset_dir, args.cohort, args.site, args.model_name, args.patient_id, args.segment,
+                                  args.segment_name, args.columns)
+        if args.output_csv:
+            result.to_csv(args.output_csv, index=False)
+        else:
+            print(result.to_string())